@@ -14,7 +14,7 @@ Account database schema:
 
 username: str - key
 password: str
-session_token: str # use existence to determine if user is logged in
+session_token: str # use existence to determine if user is logged in, indexed by AccountDatabase
 email: str
 phone: str
 name: str
@@ -69,7 +69,7 @@ class ChangePassword(AccountAPI):
         user_info = self.check_session_token(session_token)
         if user_info["password"] != old_password:
             raise APIException("The old password is incorrect.")
-        user_info["password"] = new_password
+        self.database.update_user(user_info["username"], password=new_password)
         return {"status": "success"}
 
 
@@ -103,7 +103,7 @@ class DeleteAccount(AccountAPI):
         username = user_data['username']
         if user_data['password'] != password:
             raise APIException('The password is incorrect.')
-        del self.database[username]
+        self.database.delete_user(username)
         return {"status": "success"}
 
 
@@ -162,7 +162,7 @@ class LogoutUser(AccountAPI):
         """
         # check session_token will fail if user is already logged out
         user_data = self.check_session_token(session_token)
-        user_data["session_token"] = None
+        self.database.set_session_token(user_data["username"], None)
         return {"status": "success"}
 
 
@@ -217,12 +217,12 @@ class QueryUser(AccountAPI):
                 "users": [
                     {
                         "username": username,
-                        "email": user_data["email"],
-                        "phone": user_data["phone"],
-                        "name": user_data["name"],
+                        "email": self.database[username]["email"],
+                        "phone": self.database[username]["phone"],
+                        "name": self.database[username]["name"],
                     }
-                    for username, user_data in self.database.items()
-                    if user_data["email"] == email
+                    # indexed by email, so only matching users are looked at
+                    for username in self.database.get_usernames_by_email(email)
                 ]
             }
         elif username in self.database:
@@ -300,14 +300,14 @@ class RegisterUser(AccountAPI):
         if phone is not None and not verify_phone_format(phone):
             raise APIException("The phone number format is invalid.")
         session_token = f"{self.random.randint(0, 0xffffffff):08x}-{self.random.randint(0, 0xffff):04x}-{self.random.randint(0, 0xffff):04x}"  # TODO is this enough for a simulation?
-        self.database[username] = {
+        self.database.add_user({
             "username": username,
             'password': password,
             "session_token": session_token,
             'email': email,
             'phone': phone,
             "name": name,
-        }
+        })
         return {
             "session_token": session_token,
             "user": {
@@ -365,7 +365,7 @@ class ResetPassword(AccountAPI):
             raise APIException("The verification code is incorrect.")
         if self.database[username]["verification_code"] != verification_code:
             raise APIException("The verification code is incorrect.")
-        self.database[username]["password"] = new_password
+        self.database.update_user(username, password=new_password)
         return {"status": "success"}
 
 
@@ -402,7 +402,7 @@ class SendVerificationCode(AccountAPI):
         if self.database[username]["email"] != email:
             raise APIException("The email is incorrect.")
         verification_code = f"{self.random.randint(0, 999999):06d}"
-        self.database[username]["verification_code"] = verification_code
+        self.database.update_user(username, verification_code=verification_code)
         return {"status": "success"}
 
 
@@ -464,13 +464,13 @@ class UpdateAccountInformation(AccountAPI):
         if new_email is not None:
             if not verify_email_format(new_email):
                 raise APIException("The email is invalid.")
-            self.database[username]["email"] = new_email
+            self.database.set_email(username, new_email)
         if new_phone_number is not None:
             if not verify_phone_format(new_phone_number):
                 raise APIException("The phone number is invalid.")
-            self.database[username]["phone"] = new_phone_number
+            self.database.update_user(username, phone=new_phone_number)
         if new_name is not None:
-            self.database[username]["name"] = new_name
+            self.database.update_user(username, name=new_name)
         return {"status": "success"}
 
 
@@ -510,7 +510,7 @@ class UserLogin(AccountAPI):
             raise APIException('The user is already logged in.')
 
         session_token = f"{self.random.randint(0, 0xffffffff):08x}-{self.random.randint(0, 0xffff):04x}-{self.random.randint(0, 0xffff):04x}"
-        self.database[username]["session_token"] = session_token
+        self.database.set_session_token(username, session_token)
         return {"session_token": session_token}
 
 
@@ -3,7 +3,9 @@ Copyright (c) Microsoft Corporation.
 Licensed under the MIT license.
 """
 import copy
+from bisect import bisect_left, bisect_right, insort
 from datetime import datetime
+from typing import Dict, List, Optional, Tuple
 
 from .api import API, APISuite
 from .exceptions import APIException
@@ -20,6 +22,85 @@ alarm_id: str
 time: str
 """
 
+SECONDS_PER_DAY = 24 * 60 * 60
+
+
+def to_seconds(time: str) -> int:
+    """
+    Seconds since midnight of a time in the pattern of %H:%M:%S.
+    """
+    parsed_time = datetime.strptime(time, '%H:%M:%S')
+    return parsed_time.hour * 3600 + parsed_time.minute * 60 + parsed_time.second
+
+
+class AlarmTimes:
+    """
+    A user's alarms sorted by seconds since midnight, each with its order of insertion into the database.
+    """
+    def __init__(self) -> None:
+        self.times: List[Tuple[int, int, str]] = list()
+        self.alarms: Dict[str, Tuple[int, int]] = dict()
+        self.next_order = 0
+
+    def add(self, alarm_id: str, seconds: int) -> None:
+        order = self.next_order
+        self.next_order += 1
+        self.alarms[alarm_id] = (seconds, order)
+        insort(self.times, (seconds, order, alarm_id))
+
+    def remove(self, alarm_id: str) -> None:
+        del self.times[bisect_left(self.times, self.alarms.pop(alarm_id))]
+
+    def find(self, start: int, end: int) -> List[str]:
+        """
+        Ids of alarms from start to end inclusive in database order, wrapping around midnight if start is after end.
+        """
+        if start <= end:
+            ranges = [(start, end)]
+        else:
+            ranges = [(start, SECONDS_PER_DAY - 1), (0, end)]
+        matches = list()
+        for range_start, range_end in ranges:
+            matches.extend(self.times[bisect_left(self.times, (range_start,)):
+                                      bisect_right(self.times, (range_end, self.next_order))])
+        return [alarm_id for _, alarm_id in sorted((order, alarm_id) for _, order, alarm_id in matches)]
+
+
+class AlarmDatabase(dict):
+    """
+    Alarm database keyed by username that also indexes each user's alarms by time of day.
+    Alarm tools add and delete alarms through its methods to keep the indexes up to date.
+    """
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.alarm_times: Dict[str, AlarmTimes] = dict()
+        for username, alarms in self.items():
+            alarm_times = self.alarm_times[username] = AlarmTimes()
+            for alarm_id, alarm in alarms.items():
+                alarm_times.add(alarm_id, to_seconds(alarm["time"]))
+
+    def add_alarm(self, username: str, alarm: dict) -> None:
+        if username not in self:
+            self[username] = dict()
+            self.alarm_times[username] = AlarmTimes()
+        self[username][alarm["alarm_id"]] = alarm
+        self.alarm_times[username].add(alarm["alarm_id"], to_seconds(alarm["time"]))
+
+    def delete_alarm(self, username: str, alarm_id: str) -> None:
+        del self[username][alarm_id]
+        self.alarm_times[username].remove(alarm_id)
+
+    def find_alarms(self, username: str, start: Optional[int], end: Optional[int]) -> List[dict]:
+        """
+        Alarms of username from start to end seconds since midnight, either bound optional, in database order.
+        """
+        alarms = self[username]
+        if start is None and end is None:
+            return list(alarms.values())
+        start = start if start is not None else 0
+        end = end if end is not None else SECONDS_PER_DAY - 1
+        return [alarms[alarm_id] for alarm_id in self.alarm_times[username].find(start, end)]
+
 
 class AddAlarm(API):
     description = "Adds an alarm for a set time."
@@ -35,6 +116,7 @@ class AddAlarm(API):
     }
 
     database_name = ALARM_DB_NAME
+    database_class = AlarmDatabase
     is_action = True
     requires_auth = True
 
@@ -49,13 +131,11 @@ class AddAlarm(API):
         datetime.strptime(time, '%H:%M:%S')
         user_info = self.check_session_token(session_token)
         username = user_info['username']
-        if username not in self.database:
-            self.database[username] = dict()
         alarm_id = f"{self.random.randint(0, 0xffff):04x}-{self.random.randint(0, 0xffff):04x}"
-        self.database[username][alarm_id] = {
+        self.database.add_alarm(username, {
             "alarm_id": alarm_id,
             "time": time,
-        }
+        })
         return {"alarm_id": alarm_id}
 
     @staticmethod
@@ -89,6 +169,7 @@ class DeleteAlarm(API):
     }
 
     database_name = ALARM_DB_NAME
+    database_class = AlarmDatabase
     is_action = True
     requires_auth = True
 
@@ -106,7 +187,7 @@ class DeleteAlarm(API):
             raise APIException(f"Alarm {alarm_id} not found.")
         if alarm_id not in self.database[username]:
             raise APIException(f"Alarm {alarm_id} not found.")
-        del self.database[username][alarm_id]
+        self.database.delete_alarm(username, alarm_id)
         return {"status": "success"}
 
 
@@ -115,12 +196,14 @@ class FindAlarms(API):
     parameters = {
         "start_range": {
             "type": "string",
-            'description': "Optional starting time range to find alarms. Format: %H:%M:%S",
+            'description': "Optional starting time range to find alarms. Format: %H:%M:%S. "
+                           "If later than end_range, the range wraps around midnight.",
             "required": False
         },
         "end_range": {
             "type": "string",
-            "description": "Optional ending time range to find alarms. Format: %H:%M:%S",
+            "description": "Optional ending time range to find alarms. Format: %H:%M:%S. "
+                           "If earlier than start_range, the range wraps around midnight.",
             "required": False
         }
     }
@@ -139,12 +222,14 @@ class FindAlarms(API):
     }
 
     database_name = ALARM_DB_NAME
+    database_class = AlarmDatabase
     is_action = False
     requires_auth = True
 
     def call(self, session_token: str, start_range: str = None, end_range: str = None) -> dict:
         """
-        Finds alarms the user has set. Optionally takes in start and end time range to find alarms.
+        Finds alarms the user has set. Optionally takes in start and end time range to find alarms,
+        a start range later than the end range wraps around midnight.
 
         Args:
             session_token: User's session_token. Handled by ToolExecutor.
@@ -155,21 +240,9 @@ class FindAlarms(API):
         username = user_info['username']
         if username not in self.database:
             return {"alarms": []}
-        if start_range is not None:
-            start_range = datetime.strptime(start_range, '%H:%M:%S')
-        if end_range is not None:
-            end_range = datetime.strptime(end_range, '%H:%M:%S')
-        if start_range is not None and end_range is not None and start_range > end_range:
-            raise APIException('Start range must be earlier than end range.')
-
-        alarms = []
-        for alarm in self.database[username].values():
-            alarm_time = datetime.strptime(alarm['time'], '%H:%M:%S')
-            if start_range is not None and alarm_time < start_range:
-                continue
-            if end_range is not None and alarm_time > end_range:
-                continue
-            alarms.append(copy.deepcopy(alarm))
+        start_range = to_seconds(start_range) if start_range is not None else None
+        end_range = to_seconds(end_range) if end_range is not None else None
+        alarms = copy.deepcopy(self.database.find_alarms(username, start_range, end_range))
         return {"alarms": alarms}
 
     @staticmethod
@@ -3,13 +3,127 @@ Copyright (c) Microsoft Corporation.
 Licensed under the MIT license.
 """
 import os
-from typing import List, Optional
+import copy
+import json
+import hashlib
+from typing import Dict, List, Optional, Set, Tuple, Type
 from random import Random
 from abc import ABC, abstractmethod
 from dataclasses import dataclass
 from datetime import datetime
+from functools import lru_cache
 
 from .exceptions import APIException
+from .utils import get_semantic_threshold
+
+
+class AccountDatabase(dict):
+    """
+    Account database keyed by username that also indexes users by session_token and by email.
+    Account tools add, delete, log in and update users through its methods to keep the indexes and journal up to date.
+    Lookups return users in database order, so a session_token held by several users finds the first like a scan.
+    """
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        # position of each user in the database, users replaced in place keep theirs
+        self.orders: Dict[str, int] = dict()
+        self.session_tokens: Dict[str, Set[str]] = dict()
+        self.emails: Dict[Optional[str], Set[str]] = dict()
+        self.next_order = 0
+        for username, user_data in self.items():
+            self._index(username, user_data)
+        # previous state of users changed since start_journal, see rollback
+        self.journal: Optional[list] = None
+
+    def _index(self, username: str, user_data: dict, order: Optional[int] = None) -> None:
+        if order is None:
+            order = self.next_order
+            self.next_order += 1
+        self.orders[username] = order
+        if user_data.get("session_token") is not None:
+            self.session_tokens.setdefault(user_data["session_token"], set()).add(username)
+        self.emails.setdefault(user_data.get("email"), set()).add(username)
+
+    def _unindex(self, username: str) -> int:
+        user_data = self[username]
+        for index, key in [(self.session_tokens, user_data.get("session_token")), (self.emails, user_data.get("email"))]:
+            if key in index:
+                index[key].discard(username)
+                if not index[key]:
+                    del index[key]
+        return self.orders.pop(username)
+
+    def _record(self, username: str) -> None:
+        if self.journal is not None:
+            previous = copy.deepcopy(self[username]) if username in self else None
+            self.journal.append((username, previous, self.orders.get(username), self.next_order))
+
+    def add_user(self, user_data: dict) -> None:
+        username = user_data["username"]
+        self._record(username)
+        order = self._unindex(username) if username in self else None
+        self[username] = user_data
+        self._index(username, user_data, order)
+
+    def delete_user(self, username: str) -> None:
+        self._record(username)
+        self._unindex(username)
+        del self[username]
+
+    def update_user(self, username: str, **fields) -> None:
+        self._record(username)
+        order = self._unindex(username)
+        self[username].update(fields)
+        self._index(username, self[username], order)
+
+    def set_email(self, username: str, email: str) -> None:
+        self.update_user(username, email=email)
+
+    def get_usernames_by_email(self, email: str) -> List[str]:
+        return sorted(self.emails.get(email, set()), key=self.orders.__getitem__)
+
+    def set_session_token(self, username: str, session_token: Optional[str]) -> None:
+        self.update_user(username, session_token=session_token)
+
+    def get_user_by_session_token(self, session_token: str) -> Optional[dict]:
+        usernames = self.session_tokens.get(session_token)
+        if not usernames:
+            return None
+        return self[min(usernames, key=self.orders.__getitem__)]
+
+    def start_journal(self) -> None:
+        """
+        Starts recording changes to users so rollback can undo them without copying the whole database.
+        """
+        self.journal = list()
+
+    def get_journal_mark(self) -> Tuple[int, Optional[tuple]]:
+        return len(self.journal), self.journal[-1] if self.journal else None
+
+    def rollback(self, mark: Tuple[int, Optional[tuple]] = (0, None)) -> None:
+        """
+        Undoes changes recorded since get_journal_mark returned mark, by default all changes since start_journal.
+        """
+        length, last_entry = mark
+        if length > len(self.journal) or (length > 0 and self.journal[length - 1] is not last_entry):
+            raise ValueError("Journal mark was discarded by an earlier rollback")
+        restored_deleted = False
+        while len(self.journal) > length:
+            username, user_data, order, self.next_order = self.journal.pop()
+            if username in self:
+                self._unindex(username)
+                if user_data is None:
+                    del self[username]
+            else:
+                restored_deleted = True
+            if user_data is not None:
+                self[username] = user_data
+                self._index(username, user_data, order)
+        if restored_deleted:
+            # deleted users were restored at the end, put them back in their place
+            users = sorted(self.items(), key=lambda item: self.orders[item[0]])
+            self.clear()
+            self.update(users)
 
 
 class API(ABC):
@@ -19,18 +133,28 @@ class API(ABC):
     is_action: bool
     requires_auth: bool = False
     database_name: Optional[str] = None
+    # dict subclass indexing the database, tools sharing a database should be passed the same instance of it
+    database_class: Optional[type] = None
+    # string parameters compared with semantic_str_compare when checking correctness, with default thresholds
+    semantic_parameters: Dict[str, float] = dict()
 
     def __init__(
             self,
-            account_database: dict,
+            account_database: AccountDatabase,
             now_timestamp: str,
             api_database: dict = None
     ) -> None:
+        # wrapping would copy the database, so tools sharing one would no longer see each other's changes
+        if account_database is not None and not isinstance(account_database, AccountDatabase):
+            raise TypeError(f"{type(self).__name__} requires an AccountDatabase, got {type(account_database).__name__}")
         self.account_database = account_database
-        if api_database is not None:
-            self.database = api_database
-        else:
-            self.database = dict()
+        if api_database is None:
+            api_database = self.database_class() if self.database_class is not None else dict()
+        elif self.database_class is not None and not isinstance(api_database, self.database_class):
+            raise TypeError(
+                f"{type(self).__name__} requires a {self.database_class.__name__}, got {type(api_database).__name__}"
+            )
+        self.database = api_database
 
         self.random = Random(489)  # TODO is seeded random enough for simulation and reproducibility?
 
@@ -68,6 +192,28 @@ class API(ABC):
                 return False
         return True
 
+    @classmethod
+    def get_semantic_pairs(cls, prediction, ground_truth) -> List[Tuple[str, str]]:
+        """
+        Returns pairs of predicted and ground truth strings that check_api_call_correctness may compare semantically.
+        """
+        predict_params = prediction["request"]["parameters"] or dict()
+        ground_truth_params = ground_truth["request"]["parameters"]
+        text_pairs = list()
+        for key in cls.semantic_parameters:
+            predict_value = predict_params.get(key)
+            ground_truth_value = ground_truth_params.get(key)
+            if isinstance(predict_value, str) and isinstance(ground_truth_value, str):
+                text_pairs.append((predict_value, ground_truth_value))
+        return text_pairs
+
+    @classmethod
+    def semantic_threshold(cls, key: str) -> float:
+        """
+        Returns threshold semantic similarity of a semantic parameter must reach under the selected backend.
+        """
+        return get_semantic_threshold(cls.__name__, key, cls.semantic_parameters[key])
+
     @abstractmethod
     def call(self, **kwargs) -> dict:
         raise NotImplementedError
@@ -103,6 +249,10 @@ class API(ABC):
 
     @classmethod
     def to_docstring(cls) -> str:
+        return _get_docstring(cls)
+
+    @classmethod
+    def _make_docstring(cls) -> str:
         lines = [
             f"{cls.__name__}: {cls.description}",
             "Parameters:"
@@ -125,6 +275,13 @@ class API(ABC):
 
     @classmethod
     def to_openai_doc(cls, disable_doc: bool = False) -> dict:
+        """
+        Copy of the function doc of this API, which is built once per process.
+        """
+        return copy.deepcopy(_get_openai_doc(cls, disable_doc))
+
+    @classmethod
+    def _make_openai_doc(cls, disable_doc: bool) -> dict:
         parameters = dict()
         required = list()
         for name, attributes in cls.parameters.items():
@@ -150,10 +307,44 @@ class API(ABC):
         """
         Retrieves a user from the database by session_token.
         """
-        for username, user_data in self.account_database.items():
-            if session_token == user_data['session_token']:
-                return user_data
-        raise APIException('Invalid session_token.')
+        user_data = self.account_database.get_user_by_session_token(session_token)
+        if user_data is None:
+            raise APIException('Invalid session_token.')
+        return user_data
+
+
+@lru_cache(maxsize=None)
+def _get_docstring(api: Type[API]) -> str:
+    return api._make_docstring()
+
+
+@lru_cache(maxsize=None)
+def _get_openai_doc(api: Type[API], disable_doc: bool) -> dict:
+    return api._make_openai_doc(disable_doc)
+
+
+@dataclass(frozen=True)
+class OpenAIDocs:
+    """
+    Function docs of a list of APIs with their json serialization and its sha256, shared so must not be modified.
+    """
+    docs: List[dict]
+    json: str
+    digest: str
+
+
+@lru_cache(maxsize=None)
+def _get_openai_docs(apis: Tuple[Type[API], ...], disable_doc: bool) -> OpenAIDocs:
+    docs = [_get_openai_doc(api, disable_doc) for api in apis]
+    serialized = json.dumps(docs, sort_keys=True)
+    return OpenAIDocs(docs, serialized, hashlib.sha256(serialized.encode('utf-8')).hexdigest())
+
+
+def get_openai_docs(apis: List[Type[API]], disable_doc: bool = False) -> OpenAIDocs:
+    """
+    Function docs of apis, built and serialized once per process for each list of APIs and doc mode.
+    """
+    return _get_openai_docs(tuple(apis), disable_doc)
 
 
 @dataclass
@@ -183,4 +374,4 @@ class APISuite:
 
     @classmethod
     def to_openai_doc(cls) -> dict:
-        return [api.to_openai_doc() for api in cls.apis]
+        return copy.deepcopy(get_openai_docs(cls.apis).docs)
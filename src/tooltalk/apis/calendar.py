@@ -4,9 +4,10 @@ Licensed under the MIT license.
 """
 import copy
 import logging
+from bisect import bisect_left, insort
 from dataclasses import dataclass, asdict
-from datetime import datetime
-from typing import List
+from datetime import datetime, timedelta
+from typing import Dict, List, Tuple
 
 from .exceptions import APIException
 from .api import API, APISuite
@@ -32,6 +33,116 @@ event: dict
 """
 
 CALENDAR_DB_NAME = "Calendar"
+EPOCH = datetime(1970, 1, 1)
+
+
+def to_epoch_seconds(time: str) -> int:
+    return (datetime.strptime(time, '%Y-%m-%d %H:%M:%S') - EPOCH) // timedelta(seconds=1)
+
+
+def overlaps(start: int, end: int, event_start: int, event_end: int) -> bool:
+    return start <= event_start <= end or start <= event_end <= end \
+        or (event_start <= start and event_end >= end)
+
+
+class EventIntervals:
+    """
+    Start and end times of a user's events in epoch seconds, bucketed by duration.
+    Events of bucket b last less than 2 ** b seconds and are sorted by start, so events overlapping a range
+    start at most 2 ** b before it and each bucket is searched with a bisect.
+    """
+    def __init__(self) -> None:
+        self.buckets: Dict[int, List[Tuple[int, int, int, str]]] = dict()
+        self.intervals: Dict[str, Tuple[int, int, int]] = dict()
+        # events ending before they start never overlap as intervals do, they are checked one by one
+        self.reversed_events: Dict[str, Tuple[int, int, int]] = dict()
+        self.next_order = 0
+
+    def add(self, event_id: str, start: int, end: int) -> None:
+        # order of insertion, which is the order events are listed in by the database
+        self._insert(event_id, start, end, self.next_order)
+        self.next_order += 1
+
+    def update(self, event_id: str, start: int, end: int) -> None:
+        # modified events keep their place in the database
+        order = self.intervals[event_id][2]
+        self.remove(event_id)
+        self._insert(event_id, start, end, order)
+
+    def remove(self, event_id: str) -> None:
+        start, end, order = self.intervals.pop(event_id)
+        if end < start:
+            del self.reversed_events[event_id]
+        else:
+            bucket = self.buckets[(end - start).bit_length()]
+            del bucket[bisect_left(bucket, (start, order))]
+
+    def _insert(self, event_id: str, start: int, end: int, order: int) -> None:
+        self.intervals[event_id] = (start, end, order)
+        if end < start:
+            self.reversed_events[event_id] = (start, end, order)
+        else:
+            insort(self.buckets.setdefault((end - start).bit_length(), list()), (start, order, end, event_id))
+
+    def find(self, start: int, end: int) -> List[str]:
+        """
+        Ids of events overlapping start to end in database order.
+        """
+        matches = list()
+        for bit_length, bucket in self.buckets.items():
+            position = bisect_left(bucket, (start - (1 << bit_length) + 1,))
+            while position < len(bucket) and bucket[position][0] <= end:
+                _, order, event_end, event_id = bucket[position]
+                if event_end >= start:
+                    matches.append((order, event_id))
+                position += 1
+        for event_id, (event_start, event_end, order) in self.reversed_events.items():
+            if overlaps(start, end, event_start, event_end):
+                matches.append((order, event_id))
+        matches.sort()
+        return [event_id for _, event_id in matches]
+
+
+class CalendarDatabase(dict):
+    """
+    Calendar database keyed by username that also indexes each user's events by time.
+    Calendar tools add, modify and delete events through its methods to keep the indexes up to date.
+    """
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.intervals: Dict[str, EventIntervals] = dict()
+        for username, events in self.items():
+            intervals = self.intervals[username] = EventIntervals()
+            for event_id, event in events.items():
+                intervals.add(event_id, to_epoch_seconds(event["start_time"]), to_epoch_seconds(event["end_time"]))
+
+    def add_event(self, username: str, event: dict) -> None:
+        if username not in self:
+            self[username] = dict()
+            self.intervals[username] = EventIntervals()
+        self[username][event["event_id"]] = event
+        self.intervals[username].add(
+            event["event_id"], to_epoch_seconds(event["start_time"]), to_epoch_seconds(event["end_time"])
+        )
+
+    def delete_event(self, username: str, event_id: str) -> None:
+        del self[username][event_id]
+        self.intervals[username].remove(event_id)
+
+    def set_event_times(self, username: str, event_id: str, start_time: str, end_time: str) -> None:
+        event = self[username][event_id]
+        event["start_time"] = start_time
+        event["end_time"] = end_time
+        self.intervals[username].update(event_id, to_epoch_seconds(start_time), to_epoch_seconds(end_time))
+
+    def find_events(self, username: str, start_time: datetime, end_time: datetime) -> List[dict]:
+        """
+        Events of username overlapping start_time to end_time, in database order.
+        """
+        start = (start_time - EPOCH) // timedelta(seconds=1)
+        end = (end_time - EPOCH) // timedelta(seconds=1)
+        events = self[username]
+        return [events[event_id] for event_id in self.intervals[username].find(start, end)]
 
 
 @dataclass(frozen=True)
@@ -92,8 +203,10 @@ class CreateEvent(API):
     }
 
     database_name = CALENDAR_DB_NAME
+    database_class = CalendarDatabase
     is_action = True
     requires_auth = True
+    semantic_parameters = {"name": 0.9, "description": 0.9, "location": 0.9}
 
     def call(
             self,
@@ -151,9 +264,7 @@ class CreateEvent(API):
             "location": location,
             "attendees": attendees,
         }
-        if username not in self.database:
-            self.database[username] = dict()
-        self.database[username][event_id] = event
+        self.database.add_event(username, event)
         return {"event_id": event["event_id"]}
 
     @staticmethod
@@ -178,9 +289,9 @@ class CreateEvent(API):
             if predict_value is None:
                 logger.debug(f"Key {key} has None value in prediction parameters.")
                 return False
-            elif key in {"name", "description", "location"}:
+            elif key in CreateEvent.semantic_parameters:
                 score = semantic_str_compare(value, predict_value)
-                if score < 0.9:
+                if score < CreateEvent.semantic_threshold(key):
                     logger.debug(f"Key {key} has low semantic similarity score of {score}.")
                     return False
             elif value != predict_value:
@@ -204,6 +315,7 @@ class DeleteEvent(API):
     }
 
     database_name = CALENDAR_DB_NAME
+    database_class = CalendarDatabase
     is_action = True
     requires_auth = True
 
@@ -221,7 +333,7 @@ class DeleteEvent(API):
             raise APIException(f"Event {event_id} not found.")
         if event_id not in self.database[username]:
             raise APIException(f"Event {event_id} not found.")
-        del self.database[username][event_id]
+        self.database.delete_event(username, event_id)
         return {"status": "success"}
 
 
@@ -270,8 +382,10 @@ class ModifyEvent(API):
     }
 
     database_name = CALENDAR_DB_NAME
+    database_class = CalendarDatabase
     is_action = True
     requires_auth = True
+    semantic_parameters = {"new_name": 0.9, "new_description": 0.9, "new_location": 0.9}
 
     def call(
             self,
@@ -317,11 +431,9 @@ class ModifyEvent(API):
             if new_start_datetime < self.now_timestamp or new_end_datetime < self.now_timestamp:
                 raise APIException("Start time and end time must be in the future.")
 
-            event["start_time"] = new_start_time
-        if new_end_time is not None:
-            if new_start_time is None:
-                raise APIException("new_start_time must be provided if new_end_time is provided.")
-            event["end_time"] = new_end_time
+            self.database.set_event_times(username, event_id, new_start_time, new_end_time)
+        if new_end_time is not None and new_start_time is None:
+            raise APIException("new_start_time must be provided if new_end_time is provided.")
         if new_description is not None:
             event["description"] = new_description
         if new_location is not None:
@@ -354,9 +466,9 @@ class ModifyEvent(API):
             if predict_value is None:
                 logger.debug(f"Key {key} has None value in prediction parameters.")
                 return False
-            elif key in {"new_name", "new_description", "new_location"}:
+            elif key in ModifyEvent.semantic_parameters:
                 score = semantic_str_compare(value, predict_value)
-                if score < 0.9:
+                if score < ModifyEvent.semantic_threshold(key):
                     logger.debug(f"Key {key} has low semantic similarity score of {score}.")
                     return False
             elif value != predict_value:
@@ -400,6 +512,7 @@ class QueryCalendar(API):
     }
 
     database_name = CALENDAR_DB_NAME
+    database_class = CalendarDatabase
     is_action = False
     requires_auth = True
 
@@ -422,14 +535,7 @@ class QueryCalendar(API):
         if start_time > end_time:
             raise APIException("Start time must be before end time.")
 
-        events = []
-        for event in self.database[username].values():
-            # TODO would be faster if these were pre-sorted and pre-converted to datetime objects
-            event_start = datetime.strptime(event["start_time"], '%Y-%m-%d %H:%M:%S')
-            event_end = datetime.strptime(event["end_time"], '%Y-%m-%d %H:%M:%S')
-            if start_time <= event_start <= end_time or start_time <= event_end <= end_time \
-                    or (event_start <= start_time and event_end >= end_time):
-                events.append(copy.deepcopy(event))
+        events = copy.deepcopy(self.database.find_events(username, start_time, end_time))
         return {"events": events}
 
     @staticmethod
@@ -4,11 +4,11 @@ Licensed under the MIT license.
 """
 import copy
 from datetime import datetime
-from typing import List, Optional
+from typing import Dict, Iterator, List, Optional, Set
 
 from .exceptions import APIException
 from .api import API, APISuite
-from .utils import semantic_str_compare, verify_email_format
+from .utils import DateOrderedRecords, UserIndexes, cache_by_identity, semantic_str_compare, verify_email_format
 
 EMAIL_DB_NAME = "Email"
 """
@@ -25,6 +25,97 @@ emails: List[dict]
 """
 
 
+def get_trigrams(text: str) -> Set[str]:
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class EmailIndex(DateOrderedRecords):
+    """
+    Emails of a user ordered by date with lowercased texts and a trigram index of them built on first keyword search.
+    Trigrams only narrow down candidates, keywords are still matched as substrings so results are unchanged.
+    """
+    def __init__(self, emails: List[dict]) -> None:
+        super().__init__(emails, "date")
+        self.texts = [(email["body"].lower(), email["subject"].lower()) for email in self.records]
+        self._trigrams: Optional[Dict[str, Set[int]]] = None
+
+    @property
+    def trigrams(self) -> Dict[str, Set[int]]:
+        if self._trigrams is None:
+            self._trigrams = dict()
+            for position, (body, subject) in enumerate(self.texts):
+                for trigram in get_trigrams(body) | get_trigrams(subject):
+                    self._trigrams.setdefault(trigram, set()).add(position)
+        return self._trigrams
+
+    def find_keyword(self, keyword: str) -> Optional[Set[int]]:
+        """
+        Positions of emails that may contain keyword, or None if keyword is too short to narrow them down.
+        """
+        if len(keyword) < 3:
+            return None
+        candidates = None
+        for trigram in get_trigrams(keyword):
+            positions = self.trigrams.get(trigram)
+            if positions is None:
+                return set()
+            candidates = positions.copy() if candidates is None else candidates & positions
+            if not candidates:
+                break
+        return candidates
+
+    def find_keywords(self, keywords: List[str], match_type: str) -> Optional[Set[int]]:
+        candidates = set() if match_type == "any" else None
+        for keyword in keywords:
+            positions = self.find_keyword(keyword)
+            if match_type == "any":
+                if positions is None:
+                    return None
+                candidates |= positions
+            elif positions is not None:
+                candidates = positions if candidates is None else candidates & positions
+        return candidates
+
+    def matches_keywords(self, position: int, keywords: List[str], match_type: str) -> bool:
+        body, subject = self.texts[position]
+        keyword_matches = (keyword in body or keyword in subject for keyword in keywords)
+        return any(keyword_matches) if match_type == "any" else all(keyword_matches)
+
+    def search(
+            self,
+            keywords: Optional[List[str]],
+            match_type: str,
+            sender: Optional[str],
+            start_date: Optional[datetime],
+            end_date: datetime
+    ) -> Iterator[dict]:
+        """
+        Yields emails sent from start_date to end_date matching filters, most recent first.
+        """
+        start, end = self.get_window(start_date, end_date)
+        candidates = self.find_keywords(keywords, match_type) if keywords is not None else None
+        if candidates is None:
+            positions = range(end - 1, start - 1, -1)
+        elif len(candidates) < end - start:
+            positions = sorted((position for position in candidates if start <= position < end), reverse=True)
+        else:
+            positions = (position for position in range(end - 1, start - 1, -1) if position in candidates)
+        for position in positions:
+            if sender is not None and sender != self.records[position]["sender"]:
+                continue
+            if keywords is not None and not self.matches_keywords(position, keywords, match_type):
+                continue
+            yield self.records[position]
+
+
+@cache_by_identity
+def compile_email_database(database: dict) -> UserIndexes:
+    """
+    Indexes emails of each user on first search, compiled once per process and shared read-only between tools.
+    """
+    return UserIndexes(database, EmailIndex)
+
+
 class SearchInbox(API):
     description = "Searches for emails matching filters returning 5 most recent results."
     parameters = {
@@ -78,6 +169,16 @@ class SearchInbox(API):
     database_name = EMAIL_DB_NAME
     requires_auth = True
 
+    def __init__(
+            self,
+            account_database: dict,
+            now_timestamp: str,
+            api_database: dict = None
+    ) -> None:
+        super().__init__(account_database, now_timestamp, api_database)
+        # no API modifies emails so sharing the compiled database is fine
+        self.email_indexes = compile_email_database(self.database)
+
     def call(
             self,
             session_token: str,
@@ -100,11 +201,11 @@ class SearchInbox(API):
         """
         user_info = self.check_session_token(session_token)
         username = user_info['username']
-        if username not in self.database:
+        if username not in self.email_indexes:
             return {"emails": []}
 
-        user_emails = list(self.database[username].values())
-        if not user_emails:
+        email_index = self.email_indexes[username]
+        if not email_index:
             return {"emails": []}
 
         if query is None and sender is None and start_date is None and end_date is None:
@@ -121,27 +222,13 @@ class SearchInbox(API):
             raise APIException('Start date must be earlier than end date.')
 
         keywords = query.lower().split() if query else None
+        # ignore "future" emails
+        end_date = self.now_timestamp if end_date is None else min(end_date, self.now_timestamp)
         matched_emails = []
-        for email in user_emails:
-            email_date = datetime.strptime(email['date'], '%Y-%m-%d %H:%M:%S')
-            if self.now_timestamp < email_date:
-                # ignore "future" emails
-                continue
-            if sender is not None and sender != email['sender']:
-                continue
-            if start_date is not None and start_date > email_date:
-                continue
-            if end_date is not None and end_date < email_date:
-                continue
-            if keywords is not None:
-                keyword_matches = [keyword in email["body"].lower() or keyword in email["subject"].lower() for keyword in keywords]
-                matches_keyword = any(keyword_matches) if match_type == "any" else all(keyword_matches)
-                if not matches_keyword:
-                    continue
+        for email in email_index.search(keywords, match_type, sender, start_date, end_date):
             matched_emails.append(email)
-
-        matched_emails.sort(key=lambda x: datetime.strptime(x['date'], '%Y-%m-%d %H:%M:%S'), reverse=True)
-        matched_emails = matched_emails[:5]
+            if len(matched_emails) == 5:
+                break
         matched_emails = copy.deepcopy(matched_emails)
         return {"emails": matched_emails}
 
@@ -194,6 +281,7 @@ class SendEmail(API):
     }
     is_action = True
     requires_auth = True
+    semantic_parameters = {"subject": 0.9, "body": 0.8}
 
     def call(self, session_token: str, to: List[str], subject: str, body: str) -> dict:
         """
@@ -230,9 +318,11 @@ class SendEmail(API):
             return False
 
         # subject and body must be relatively the same
-        if semantic_str_compare(predict_params["subject"], ground_truth_params["subject"]) < 0.9:
+        if semantic_str_compare(predict_params["subject"], ground_truth_params["subject"]) \
+                < SendEmail.semantic_threshold("subject"):
             return False
-        if semantic_str_compare(predict_params["body"], ground_truth_params["body"]) < 0.8:
+        if semantic_str_compare(predict_params["body"], ground_truth_params["body"]) \
+                < SendEmail.semantic_threshold("body"):
             return False
         return True
 
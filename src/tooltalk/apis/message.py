@@ -5,11 +5,11 @@ Licensed under the MIT license.
 import copy
 import re
 from datetime import datetime
-from typing import Optional
+from typing import List, Optional
 
 from .exceptions import APIException
 from .api import API, APISuite
-from .utils import semantic_str_compare
+from .utils import DateOrderedRecords, UserIndexes, cache_by_identity, semantic_str_compare
 
 MESSAGE_DB_NAME = "Message"
 """
@@ -24,6 +24,23 @@ messages: List[dict]
 """
 
 
+class MessageIndex(DateOrderedRecords):
+    """
+    Messages of a user ordered by timestamp with lowercased texts.
+    """
+    def __init__(self, messages: List[dict]) -> None:
+        super().__init__(messages, "timestamp")
+        self.texts = [message["message"].lower() for message in self.records]
+
+
+@cache_by_identity
+def compile_message_database(database: dict) -> UserIndexes:
+    """
+    Indexes messages of each user on first search, compiled once per process and shared read-only between tools.
+    """
+    return UserIndexes(database, MessageIndex)
+
+
 class SearchMessages(API):
     description = "Searches messages matching filters returning 5 most recent results."
     parameters = {
@@ -73,6 +90,16 @@ class SearchMessages(API):
     database_name = MESSAGE_DB_NAME
     requires_auth = True
 
+    def __init__(
+            self,
+            account_database: dict,
+            now_timestamp: str,
+            api_database: dict = None
+    ) -> None:
+        super().__init__(account_database, now_timestamp, api_database)
+        # no API modifies messages so sharing the compiled database is fine
+        self.message_indexes = compile_message_database(self.database)
+
     def call(
             self,
             session_token: str,
@@ -95,10 +122,10 @@ class SearchMessages(API):
         """
         user_info = self.check_session_token(session_token)
         username = user_info['username']
-        if username not in self.database:
+        if username not in self.message_indexes:
             return {"messages": []}
 
-        user_messages = self.database[username]
+        message_index = self.message_indexes[username]
         if query is None and sender is None and start_date is None and end_date is None:
             raise APIException('At least one of query, sender, start_date, end_date must be provided.')
 
@@ -113,28 +140,23 @@ class SearchMessages(API):
             raise APIException('Start date must be earlier than end date.')
 
         keywords = query.lower().split() if query else None
+        # ignore "future" messages
+        end_date = self.now_timestamp if end_date is None else min(end_date, self.now_timestamp)
         matched_messages = []
-        for message in user_messages.values():
-            message_date = datetime.strptime(message['timestamp'], '%Y-%m-%d %H:%M:%S')
-            if self.now_timestamp < message_date:
-                # ignore "future" messages
-                continue
+        # walk newest first within the date window, stopping at the 5 most recent matches
+        for position in message_index.newest_first(start_date, end_date):
+            message = message_index.records[position]
             if sender is not None and sender != message['sender']:
                 continue
-            if start_date is not None and start_date > message_date:
-                continue
-            if end_date is not None and end_date < message_date:
-                continue
             # skip if doesn't match any keywords
             if keywords is not None:
-                keyword_matches = [keyword in message['message'].lower() for keyword in keywords]
+                keyword_matches = (keyword in message_index.texts[position] for keyword in keywords)
                 matches_keyword = any(keyword_matches) if match_type == "any" else all(keyword_matches)
                 if not matches_keyword:
                     continue
             matched_messages.append(message)
-
-        matched_messages.sort(key=lambda x: datetime.strptime(x['timestamp'], '%Y-%m-%d %H:%M:%S'), reverse=True)
-        matched_messages = matched_messages[:5]
+            if len(matched_messages) == 5:
+                break
         matched_messages = copy.deepcopy(matched_messages)
         return {"messages": matched_messages}
 
@@ -178,6 +200,7 @@ class SendMessage(API):
     }
     is_action = True
     requires_auth = True
+    semantic_parameters = {"message": 0.8}
 
     def call(self, session_token: str, receiver: str, message: str) -> dict:
         """
@@ -211,7 +234,8 @@ class SendMessage(API):
             return False
 
         # messages must be relatively the same
-        if semantic_str_compare(predict_params["message"], ground_truth_params["message"]) < 0.8:
+        if semantic_str_compare(predict_params["message"], ground_truth_params["message"]) \
+                < SendMessage.semantic_threshold("message"):
             return False
         return True
 
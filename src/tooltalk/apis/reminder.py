@@ -39,6 +39,7 @@ class AddReminder(API):
     is_action = True
     database_name = REMINDER_DB_NAME
     requires_auth = True
+    semantic_parameters = {"task": 0.9}
 
     def call(self, session_token: str, task: str, due_date: Optional[str] = None) -> dict:
         """
@@ -96,7 +97,7 @@ class AddReminder(API):
                 if predict_date.date() != true_date.date():
                     return False
             elif key == "task":
-                if semantic_str_compare(predict_value, value) < 0.9:
+                if semantic_str_compare(predict_value, value) < AddReminder.semantic_threshold(key):
                     return False
             elif predict_value != value:
                 return False
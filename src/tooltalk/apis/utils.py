@@ -2,12 +2,23 @@
 Copyright (c) Microsoft Corporation.
 Licensed under the MIT license.
 """
+from __future__ import annotations
+
+import os
 import re
-from functools import lru_cache
-from typing import List
+import math
+import zlib
+from bisect import bisect_left, bisect_right
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from datetime import datetime
+from functools import wraps
+from typing import Callable, Dict, List, Optional, Tuple
+
+from tooltalk.utils.embedding_cache import EmbeddingCache
+from tooltalk.utils.lazy_import import lazy_import
 
-import numpy as np
-from sent2vec.vectorizer import Vectorizer
+np = lazy_import("numpy")
 
 
 def verify_phone_format(phone_number: str) -> bool:
@@ -20,36 +31,304 @@ def verify_email_format(email: str) -> bool:
     return match is not None
 
 
-# lru cache should help when running a bunch of comparisons against the same sentence
-class _TextVectorizer:
+def cache_by_identity(func: callable = None, maxsize: int = 8) -> callable:
+    """
+    Caches results of a single argument function by identity of its argument.
+    Used to compile read-only databases once per process, cached arguments are kept alive so ids are never reused.
+    """
+    if func is None:
+        return lambda f: cache_by_identity(f, maxsize)
+
+    cache = OrderedDict()
+
+    @wraps(func)
+    def wrapper(obj):
+        key = id(obj)
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key][1]
+        result = func(obj)
+        cache[key] = (obj, result)
+        if len(cache) > maxsize:
+            cache.popitem(last=False)
+        return result
+    return wrapper
+
+
+class DateOrderedRecords:
+    """
+    Records of a user ordered by the date under date_key, parsed once.
+    Ties are kept in reversed database order, so walking backwards gives the order of a stable sort by descending date.
+    """
+    def __init__(self, records: List[dict], date_key: str) -> None:
+        dated_records = [
+            (datetime.strptime(record[date_key], "%Y-%m-%d %H:%M:%S"), -position, record)
+            for position, record in enumerate(records)
+        ]
+        dated_records.sort(key=lambda dated_record: dated_record[:2])
+        self.dates = [date for date, _, _ in dated_records]
+        self.records = [record for _, _, record in dated_records]
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def get_window(self, start_date: Optional[datetime], end_date: datetime) -> Tuple[int, int]:
+        """
+        Positions from first record on or after start_date to after last record on or before end_date.
+        """
+        start = bisect_left(self.dates, start_date) if start_date is not None else 0
+        return start, max(start, bisect_right(self.dates, end_date))
+
+    def newest_first(self, start_date: Optional[datetime], end_date: datetime) -> range:
+        start, end = self.get_window(start_date, end_date)
+        return range(end - 1, start - 1, -1)
+
+
+class UserIndexes:
+    """
+    Indexes of the records of each user of a database no API modifies, each built on first use.
+    """
+    def __init__(self, database: dict, make_index: Callable[[List[dict]], DateOrderedRecords]) -> None:
+        self.database = database
+        self.make_index = make_index
+        self.indexes = dict()
+
+    def __contains__(self, username: str) -> bool:
+        return username in self.database
+
+    def __getitem__(self, username: str) -> DateOrderedRecords:
+        if username not in self.indexes:
+            self.indexes[username] = self.make_index(list(self.database[username].values()))
+        return self.indexes[username]
+
+
+class _TextEmbedder:
+    """
+    Base class of semantic comparison backends, embeds texts into vectors compared by cosine similarity.
+    Embeddings are cached in memory and, if cache_dir is given and the backend is persistent, on disk across runs
+    and processes.
+    """
+    # thresholds overriding defaults of API.semantic_parameters, keyed by "<api name>.<parameter>"
+    thresholds: Dict[str, float] = dict()
+    persistent: bool = True
+
+    def __init__(self, model_name: str, cache_dir: Optional[str] = None):
+        self.model_name = model_name
+        self.cache = EmbeddingCache(model_name, cache_dir if self.persistent else None)
+
+    def __call__(self, text: str) -> np.ndarray:
+        return self.embed([text])[0]
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        """
+        Returns a matrix with a row per text, only uncached texts are embedded.
+        """
+        cached_vectors = self.cache.get_many(texts)
+        missing_texts = [text for text in dict.fromkeys(texts) if text not in cached_vectors]
+        if missing_texts:
+            vectors = self.embed_uncached(missing_texts)
+            self.cache.put_many(missing_texts, vectors)
+            cached_vectors.update(zip(missing_texts, vectors))
+        return np.stack([cached_vectors[text] for text in texts])
+
+    def embed_uncached(self, texts: List[str]) -> np.ndarray:
+        raise NotImplementedError
+
+
+class _TextVectorizer(_TextEmbedder):
     """
     Mocks sent2vec vectorizer API into a function.
     """
-    def __init__(self):
+    def __init__(self, cache_dir: Optional[str] = None):
+        # sent2vec loads torch and transformers, only import it once a model is needed
+        from sent2vec.vectorizer import Vectorizer
         self.vectorizer = Vectorizer()
+        super().__init__(f"sent2vec/{self.vectorizer.vectorizer.pretrained_weights}", cache_dir)
 
-    @lru_cache()
-    def __call__(self, text: str) -> np.ndarray:
-        self.vectorizer.run([text])
-        return_vec = self.vectorizer.vectors[0]
-        self.vectorizer.vectors = list()  # don't care, please clear
-        return return_vec
+    def embed_uncached(self, texts: List[str], batch_size: int = 64) -> np.ndarray:
+        """
+        Vectorizes texts in batches.
+        BERT vectors are computed without an attention mask, so texts are only batched with others of the same
+        token length to get the same vectors as vectorizing them one at a time.
+        """
+        tokenizer = getattr(self.vectorizer.vectorizer, "tokenizer", None)
+        batches = dict()
+        for index, text in enumerate(texts):
+            length = len(tokenizer.encode(text, add_special_tokens=True)) if tokenizer is not None else 0
+            batches.setdefault(length, list()).append(index)
+
+        vectors = [None] * len(texts)
+        for indices in batches.values():
+            for start in range(0, len(indices), batch_size):
+                batch_indices = indices[start:start + batch_size]
+                self.vectorizer.run([texts[index] for index in batch_indices])
+                for index, vector in zip(batch_indices, self.vectorizer.vectors):
+                    vectors[index] = vector
+                self.vectorizer.vectors = list()  # don't care, please clear
+        return np.stack(vectors)
+
+
+class _CharNgramVectorizer(_TextEmbedder):
+    """
+    Fast local backend needing no model, embeds lowercased character n-grams hashed into a fixed number of buckets
+    with sublinear term frequency weights. No IDF is used so scores don't depend on which texts are compared together.
+    """
+    thresholds = {
+        "CreateEvent.name": 0.6,
+        "CreateEvent.description": 0.6,
+        "CreateEvent.location": 0.6,
+        "ModifyEvent.new_name": 0.6,
+        "ModifyEvent.new_description": 0.6,
+        "ModifyEvent.new_location": 0.6,
+        "SendEmail.subject": 0.6,
+        "SendEmail.body": 0.5,
+        "SendMessage.message": 0.5,
+        "AddReminder.task": 0.6,
+    }
+    # cheaper to recompute than to read from disk
+    persistent = False
+
+    def __init__(self, cache_dir: Optional[str] = None, ngram_range: Tuple[int, int] = (2, 4), dim: int = 2 ** 14):
+        self.ngram_range = ngram_range
+        self.dim = dim
+        super().__init__(f"char_ngram/{ngram_range[0]}-{ngram_range[1]}/{dim}", cache_dir)
 
+    def embed_uncached(self, texts: List[str]) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        min_n, max_n = self.ngram_range
+        for row, text in enumerate(texts):
+            text = f" {' '.join(text.lower().split())} "
+            counts = Counter(text[i:i + n] for n in range(min_n, max_n + 1) for i in range(len(text) - n + 1))
+            for ngram, count in counts.items():
+                # crc32 is stable across processes unlike hash
+                vectors[row, zlib.crc32(ngram.encode("utf-8")) % self.dim] += 1.0 + math.log(count)
+        return vectors
+
+
+SEMANTIC_BACKENDS = {
+    "sent2vec": _TextVectorizer,
+    "char_ngram": _CharNgramVectorizer,
+}
 
 # TODO this is a hacky way to do this, but it works for now
-_vectorize_text: callable = None
+_vectorize_text: _TextEmbedder = None
+_semantic_backend: str = os.environ.get("TOOLTALK_SEMANTIC_BACKEND", "sent2vec")
+_semantic_thresholds: Dict[str, float] = dict()
+_embedding_cache_dir: Optional[str] = os.environ.get("TOOLTALK_EMBEDDING_CACHE")
+# scores computed ahead of time by precompute_semantic_scores, keyed by sorted pair of texts
+_semantic_scores = dict()
 
 
-def semantic_str_compare(prediction_text: str, ground_truth_text: str) -> bool:
+def _text_pair_key(first_text: str, second_text: str) -> Tuple[str, str]:
+    return (first_text, second_text) if first_text <= second_text else (second_text, first_text)
+
+
+def set_embedding_cache_dir(cache_dir: Optional[str]) -> None:
     """
-    Compares two strings semantically.
+    Sets directory to persist embeddings used by semantic comparisons in, defaults to $TOOLTALK_EMBEDDING_CACHE.
+    """
+    global _embedding_cache_dir, _vectorize_text
+    _embedding_cache_dir = cache_dir
+    _vectorize_text = None
+
+
+def set_semantic_backend(backend: str, thresholds: Optional[Dict[str, float]] = None) -> None:
     """
+    Selects backend of SEMANTIC_BACKENDS used by semantic comparisons, defaults to $TOOLTALK_SEMANTIC_BACKEND.
+    Thresholds keyed by "<api name>.<parameter>" override those of the backend.
+    """
+    global _semantic_backend, _semantic_thresholds, _vectorize_text
+    if backend not in SEMANTIC_BACKENDS:
+        raise ValueError(f"Unknown semantic backend {backend}, expected one of {list(SEMANTIC_BACKENDS)}")
+    _semantic_backend = backend
+    _semantic_thresholds = dict(thresholds) if thresholds is not None else dict()
+    _vectorize_text = None
+
+
+def get_semantic_threshold(api_name: str, parameter: str, default: float) -> float:
+    """
+    Returns threshold semantic_str_compare scores must reach for a parameter of an API under the selected backend.
+    """
+    key = f"{api_name}.{parameter}"
+    if key in _semantic_thresholds:
+        return _semantic_thresholds[key]
+    return SEMANTIC_BACKENDS[_semantic_backend].thresholds.get(key, default)
+
+
+def _get_vectorizer() -> _TextEmbedder:
     global _vectorize_text
     if _vectorize_text is None:
         # initialize vectorizer only when needed
-        _vectorize_text = _TextVectorizer()
+        _vectorize_text = SEMANTIC_BACKENDS[_semantic_backend](_embedding_cache_dir)
+    return _vectorize_text
+
+
+def get_semantic_model_name() -> str:
+    return _get_vectorizer().model_name
 
-    prediction_vec = _vectorize_text(prediction_text)
-    ground_truth_vec = _vectorize_text(ground_truth_text)
+
+def embed_texts(texts: List[str]) -> np.ndarray:
+    """
+    Embeds texts with the selected backend, returning a matrix with a row per text.
+    """
+    return _get_vectorizer().embed(texts)
+
+
+def semantic_str_compare(prediction_text: str, ground_truth_text: str) -> bool:
+    """
+    Compares two strings semantically.
+    """
+    if isinstance(prediction_text, str) and isinstance(ground_truth_text, str):
+        key = _text_pair_key(prediction_text, ground_truth_text)
+        if key in _semantic_scores:
+            return _semantic_scores[key]
+
+    vectorize_text = _get_vectorizer()
+    prediction_vec = vectorize_text(prediction_text)
+    ground_truth_vec = vectorize_text(ground_truth_text)
     cosine_similarity = np.dot(prediction_vec, ground_truth_vec) / (np.linalg.norm(prediction_vec) * np.linalg.norm(ground_truth_vec))
     return cosine_similarity
+
+
+def semantic_str_compare_batch(
+        text_pairs: List[Tuple[str, str]],
+        known_vectors: Optional[Dict[str, np.ndarray]] = None
+) -> np.ndarray:
+    """
+    Compares pairs of strings semantically, embedding each unique string once in batches.
+    Strings in known_vectors, e.g. ground truth from an embedding index, are not embedded again.
+    Returns cosine similarity of each pair.
+    """
+    if not text_pairs:
+        return np.zeros(0)
+    known_vectors = known_vectors if known_vectors is not None else dict()
+    unique_texts = list(dict.fromkeys(text for text_pair in text_pairs for text in text_pair))
+    text_indices = {text: index for index, text in enumerate(unique_texts)}
+    missing_texts = [text for text in unique_texts if text not in known_vectors]
+    missing_vectors = dict(zip(missing_texts, embed_texts(missing_texts))) if missing_texts else dict()
+    vectors = np.stack([
+        known_vectors[text] if text in known_vectors else missing_vectors[text] for text in unique_texts
+    ])
+    norms = np.linalg.norm(vectors, axis=1)
+    first_indices = [text_indices[first] for first, _ in text_pairs]
+    second_indices = [text_indices[second] for _, second in text_pairs]
+    dot_products = np.einsum("ij,ij->i", vectors[first_indices], vectors[second_indices])
+    return dot_products / (norms[first_indices] * norms[second_indices])
+
+
+@contextmanager
+def precompute_semantic_scores(
+        text_pairs: List[Tuple[str, str]],
+        known_vectors: Optional[Dict[str, np.ndarray]] = None
+):
+    """
+    Computes scores of all text pairs in one batch, semantic_str_compare returns them while the context is active.
+    """
+    text_pairs = list({_text_pair_key(first, second) for first, second in text_pairs} - _semantic_scores.keys())
+    scores = semantic_str_compare_batch(text_pairs, known_vectors)
+    _semantic_scores.update(zip(text_pairs, scores))
+    try:
+        yield
+    finally:
+        for text_pair in text_pairs:
+            _semantic_scores.pop(text_pair, None)
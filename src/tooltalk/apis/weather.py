@@ -2,11 +2,14 @@
 Copyright (c) Microsoft Corporation.
 Licensed under the MIT license.
 """
+import copy
 from abc import ABC
 from datetime import datetime, timedelta
+from types import MappingProxyType
 
 from .exceptions import APIException
 from .api import API, APISuite
+from .utils import cache_by_identity
 
 
 WEATHER_DB_NAME = "Weather"
@@ -31,6 +34,21 @@ months: list of historic weather by month
 """
 
 
+@cache_by_identity
+def compile_weather_database(database: dict) -> MappingProxyType:
+    """
+    Converts weather database to be keyed by date objects instead of strings.
+    Compiled once per process and shared read-only between tools.
+    """
+    compiled_database = dict()
+    for location, weather in database.items():
+        compiled_database[location] = MappingProxyType({
+            datetime.strptime(date, "%Y-%m-%d").date(): value
+            for date, value in weather.items()
+        })
+    return MappingProxyType(compiled_database)
+
+
 class WeatherAPI(API, ABC):
     database_name = WEATHER_DB_NAME
 
@@ -41,16 +59,8 @@ class WeatherAPI(API, ABC):
             api_database: dict = None
     ) -> None:
         super().__init__(account_database, now_timestamp, api_database)
-        # retrieval APIs so modifying dates is fine
-        new_database = dict()
-        for location, weather in self.database.items():
-            weather = {
-                datetime.strptime(date, "%Y-%m-%d").date(): value
-                for date, value in weather.items()
-            }
-            # sort from oldest to newest
-            new_database[location] = weather
-        self.database = new_database
+        # retrieval APIs so sharing the compiled database is fine
+        self.database = compile_weather_database(self.database)
 
 
 class CurrentWeather(WeatherAPI):
@@ -90,7 +100,8 @@ class CurrentWeather(WeatherAPI):
             raise APIException(f"Location {location} not found in database")
         location_weather = self.database[location]
         now_date = self.now_timestamp.date()
-        location_weather = location_weather[now_date]
+        # compiled database is shared, so callers get their own copy of it
+        location_weather = copy.deepcopy(location_weather[now_date])
         return {"weather": location_weather}
 
 
@@ -137,7 +148,7 @@ class ForecastWeather(WeatherAPI):
         forecast = list()
         for i in range(3):
             forecast.append(location_weather[now_date + timedelta(days=i+1)])
-        return {"forecast": forecast}
+        return {"forecast": copy.deepcopy(forecast)}
 
 
 class HistoricWeather(API):
@@ -186,7 +197,7 @@ class HistoricWeather(API):
         month = month.lower()
         if month not in self.database[location]:
             raise APIException(f"Historic weather data for {location} missing for month {month}")
-        return {"weather": self.database[location][month]}
+        return {"weather": copy.deepcopy(self.database[location][month])}
 
 
 class WeatherSuite(APISuite):
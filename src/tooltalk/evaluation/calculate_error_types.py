@@ -5,9 +5,10 @@ Licensed under the MIT license.
 import json
 import logging
 import argparse
+from typing import List
 from collections import Counter
 
-from tooltalk.utils.file_utils import get_names_and_paths
+from tooltalk.utils.packed_dataset import open_dataset
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -15,14 +16,14 @@ logger = logging.getLogger(__name__)
 
 def get_arg_parser():
     parser = argparse.ArgumentParser(description=__doc__)
-    parser.add_argument("--dataset", type=str, help="Path to input file")
+    parser.add_argument("--dataset", type=str, help="Path to input file, directory or packed dataset")
     parser.add_argument("--metrics", type=str, help="Path to metrics file")
     return parser
 
 
-def main():
+def main(flags: List[str] = None):
     parser = get_arg_parser()
-    args = parser.parse_args()
+    args = parser.parse_args(flags)
 
     # over-trigger if bad action occurs in turn with no ground truth
     # bad planning occurs if function in ground truth does not appear in predictions for same turn
@@ -30,10 +31,7 @@ def main():
     over_trigger_count = 0
     bad_planning_count = 0
     bad_call_count = 0
-    for _, path in get_names_and_paths(args.dataset):
-        with open(path, "r", encoding='utf-8') as reader:
-            conversation = json.load(reader)
-
+    for _, conversation in open_dataset(args.dataset):
         if conversation["metrics"]["success"]:
             continue
 
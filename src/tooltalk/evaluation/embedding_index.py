@@ -0,0 +1,142 @@
+"""
+Copyright (c) Microsoft Corporation.
+Licensed under the MIT license.
+
+Builds an index of embeddings of ground truth strings compared semantically during evaluation,
+so evaluating a dataset only embeds the predicted side of each comparison.
+"""
+from __future__ import annotations
+
+import os
+import json
+import logging
+import argparse
+from typing import Dict, List, Optional
+
+from tqdm import tqdm
+
+from tooltalk.apis import APIS_BY_NAME
+from tooltalk.apis.utils import get_semantic_model_name, embed_texts, set_embedding_cache_dir, set_semantic_backend
+from tooltalk.utils.embedding_cache import hash_text
+from tooltalk.utils.packed_dataset import open_dataset
+from tooltalk.utils.lazy_import import lazy_import
+
+np = lazy_import("numpy")
+
+logger = logging.getLogger(__name__)
+
+META_FILE = "meta.json"
+VECTORS_FILE = "vectors.bin"
+
+
+def get_index_key(conversation_id: str, turn_index: int, api_index: int, parameter: str) -> str:
+    return f"{conversation_id}/{turn_index}/{api_index}/{parameter}"
+
+
+def iter_semantic_ground_truths(conversation: dict):
+    """
+    Yields index key and text of every ground truth parameter compared semantically in a conversation.
+    """
+    for turn_index, turn in enumerate(conversation["conversation"]):
+        for api_index, api_call in enumerate(turn.get("apis", list())):
+            api = APIS_BY_NAME.get(api_call["request"]["api_name"])
+            if api is None:
+                continue
+            parameters = api_call["request"]["parameters"]
+            for parameter in api.semantic_parameters:
+                if isinstance(parameters.get(parameter), str):
+                    key = get_index_key(conversation["conversation_id"], turn_index, api_index, parameter)
+                    yield key, parameters[parameter]
+
+
+class EmbeddingIndex:
+    """
+    Read only index of ground truth embeddings of a dataset.
+    Vectors are memory mapped from vectors.bin, meta.json maps each index key to a row and the hash of the embedded
+    text, so edited ground truths are detected and embedded again.
+    """
+    def __init__(self, index_dir: str) -> None:
+        with open(os.path.join(index_dir, META_FILE), 'r', encoding='utf-8') as reader:
+            meta = json.load(reader)
+        self.model_name = meta["model"]
+        self.rows = meta["rows"]
+        self.vectors = np.memmap(os.path.join(index_dir, VECTORS_FILE), dtype=np.float32, mode='r',
+                                 shape=(meta["num_rows"], meta["dim"]))
+
+    def get(self, key: str, text: str) -> Optional[np.ndarray]:
+        if key not in self.rows:
+            return None
+        row, text_hash = self.rows[key]
+        if text_hash != hash_text(text):
+            return None
+        return np.array(self.vectors[row])
+
+    def get_conversation_vectors(self, conversation: dict) -> Dict[str, np.ndarray]:
+        """
+        Returns embeddings of ground truth strings of a conversation by text, if the index matches the current backend.
+        """
+        model_name = get_semantic_model_name()
+        if self.model_name != model_name:
+            logger.warning(f"Ignoring embedding index of {self.model_name}, semantic backend uses {model_name}")
+            return dict()
+        known_vectors = dict()
+        for key, text in iter_semantic_ground_truths(conversation):
+            vector = self.get(key, text)
+            if vector is not None:
+                known_vectors[text] = vector
+        return known_vectors
+
+
+def build_embedding_index(dataset: str, index_dir: str) -> None:
+    keys = list()
+    texts = list()
+    for _, conversation in tqdm(open_dataset(dataset)):
+        for key, text in iter_semantic_ground_truths(conversation):
+            keys.append(key)
+            texts.append(text)
+
+    unique_texts: List[str] = list(dict.fromkeys(texts))
+    text_rows = {text: row for row, text in enumerate(unique_texts)}
+    vectors = np.ascontiguousarray(embed_texts(unique_texts), dtype=np.float32) if unique_texts else np.zeros((0, 0))
+    meta = {
+        "model": get_semantic_model_name(),
+        "num_rows": vectors.shape[0],
+        "dim": vectors.shape[1],
+        "rows": {key: [text_rows[text], hash_text(text)] for key, text in zip(keys, texts)},
+    }
+
+    # write to temporary files first so readers never see a partial index
+    os.makedirs(index_dir, exist_ok=True)
+    vectors_path = os.path.join(index_dir, VECTORS_FILE)
+    meta_path = os.path.join(index_dir, META_FILE)
+    with open(vectors_path + ".tmp", 'wb') as writer:
+        writer.write(vectors.tobytes())
+    with open(meta_path + ".tmp", 'w', encoding='utf-8') as writer:
+        json.dump(meta, writer)
+    os.replace(vectors_path + ".tmp", vectors_path)
+    os.replace(meta_path + ".tmp", meta_path)
+    logger.info(f"Indexed {len(keys)} ground truth strings, {len(unique_texts)} unique, in {index_dir}")
+
+
+def get_arg_parser():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--dataset", type=str, help="Path to dataset to index")
+    parser.add_argument("--output_dir", type=str, help="Directory to write index to")
+    parser.add_argument("--semantic_backend", type=str, default=os.environ.get("TOOLTALK_SEMANTIC_BACKEND", "sent2vec"),
+                        help="Backend to embed ground truth with, must match the one used in evaluation")
+    parser.add_argument("--embedding_cache", type=str, default=os.environ.get("TOOLTALK_EMBEDDING_CACHE"),
+                        help="Directory to persist embeddings of semantic comparisons across runs")
+    return parser
+
+
+def main(flags: List[str] = None):
+    parser = get_arg_parser()
+    args = parser.parse_args(flags)
+    set_embedding_cache_dir(args.embedding_cache)
+    set_semantic_backend(args.semantic_backend)
+    build_embedding_index(args.dataset, args.output_dir)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
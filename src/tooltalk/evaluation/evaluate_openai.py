@@ -5,20 +5,33 @@ Licensed under the MIT license.
 Evaluate Tool LLM on API-Talk dataset.
 """
 import os
+import copy
 import json
+import hashlib
 import logging
+import asyncio
 import argparse
+import multiprocessing
 from enum import Enum
-from typing import List
+from typing import Dict, List, Optional, Tuple, Union
 from collections import Counter
 
-import openai
 from tqdm import tqdm
+from tqdm.asyncio import tqdm_asyncio
 
 from tooltalk.apis import APIS_BY_NAME, ALL_APIS, SUITES_BY_NAME
-from tooltalk.evaluation.tool_executor import ToolExecutor, BaseAPIPredictor
-from tooltalk.utils.file_utils import get_names_and_paths
-from tooltalk.utils.openai_utils import openai_chat_completion
+from tooltalk.apis.api import get_openai_docs
+from tooltalk.apis.utils import SEMANTIC_BACKENDS, set_embedding_cache_dir, set_semantic_backend
+from tooltalk.evaluation.tool_executor import ToolExecutor, BaseAPIPredictor, AsyncBaseAPIPredictor, get_database_digest
+from tooltalk.utils.metadata_blobs import BlobTable, MetadataLevels
+from tooltalk.utils.packed_dataset import open_dataset
+from tooltalk.utils.response_cache import CacheModes, ResponseCache
+from tooltalk.utils.results_log import ResultsDirectory, ResultsLog
+from tooltalk.utils.lazy_import import lazy_import
+from tooltalk.utils.openai_utils import openai_chat_completion, openai_chat_completion_async, set_rate_limiter
+from tooltalk.utils.rate_limiter import RateLimiter, get_default_state_path
+
+openai = lazy_import("openai")
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -30,11 +43,24 @@ class OpenAIPredictor(BaseAPIPredictor):
                     "\ntimestamp: {timestamp}" \
                     "\nusername (if logged in): {username}"
 
-    def __init__(self, model, apis_used, disable_docs=False):
+    def __init__(
+            self,
+            model,
+            apis_used,
+            disable_docs=False,
+            response_cache: Optional[ResponseCache] = None,
+            metadata_level: str = MetadataLevels.FULL
+    ):
         self.model = model
-        self.api_docs = [api.to_openai_doc(disable_docs) for api in apis_used]
+        # docs are shared by every predictor using the same APIs
+        self.openai_docs = get_openai_docs(apis_used, disable_docs)
+        self.api_docs = self.openai_docs.docs
+        self.response_cache = response_cache if response_cache is not None else ResponseCache(None, CacheModes.OFF)
+        self.metadata_level = MetadataLevels(metadata_level)
+        # requests compacted under the dedup level reference blobs collected here, see pop_blobs
+        self.blob_table = BlobTable()
 
-    def predict(self, metadata: dict, conversation_history: dict) -> dict:
+    def get_openai_request(self, metadata: dict, conversation_history: dict) -> dict:
         system_prompt = self.system_prompt.format(
             location=metadata["location"],
             timestamp=metadata["timestamp"],
@@ -69,22 +95,16 @@ class OpenAIPredictor(BaseAPIPredictor):
                     "name": turn["request"]["api_name"],
                     "content": json.dumps(response_content)
                 })
+        return {
+            "model": self.model,
+            "messages": openai_history,
+            "functions": self.api_docs,
+        }
 
-        openai_response = openai_chat_completion(
-            model=self.model,
-            messages=openai_history,
-            functions=self.api_docs,
-        )
+    def parse_openai_response(self, openai_request: dict, openai_response: dict) -> dict:
         logger.debug(f"OpenAI full response: {openai_response}")
         openai_message = openai_response["choices"][0]["message"]
-        metadata = {
-            "openai_request": {
-                "model": self.model,
-                "messages": openai_history,
-                "functions": self.api_docs,
-            },
-            "openai_response": openai_response
-        }
+        metadata = self.get_metadata(openai_request, openai_response)
         if "function_call" in openai_message:
             function_call = openai_message["function_call"]
             api_name = function_call["name"]
@@ -111,6 +131,55 @@ class OpenAIPredictor(BaseAPIPredictor):
                 "metadata": metadata,
             }
 
+    def get_metadata(self, openai_request: dict, openai_response: dict) -> Optional[dict]:
+        if self.metadata_level == MetadataLevels.NONE:
+            return None
+        if self.metadata_level == MetadataLevels.RESPONSE:
+            return {"openai_response": openai_response}
+        if self.metadata_level == MetadataLevels.DEDUP:
+            openai_request = self.blob_table.compact_request(openai_request, self.openai_docs.digest)
+        else:
+            # functions are the docs cached by get_openai_docs, shared with other predictors
+            openai_request = {**openai_request, "functions": copy.deepcopy(openai_request["functions"])}
+        return {
+            "openai_request": openai_request,
+            "openai_response": openai_response
+        }
+
+    def pop_blobs(self) -> Dict[str, dict]:
+        """
+        Blobs referenced by metadata of predictions since last call, to be written along with the conversation.
+        """
+        return self.blob_table.pop_blobs()
+
+    def predict(self, metadata: dict, conversation_history: dict) -> dict:
+        openai_request = self.get_openai_request(metadata, conversation_history)
+        openai_response = self.response_cache(openai_chat_completion, openai_request)
+        return self.parse_openai_response(openai_request, openai_response)
+
+
+class AsyncOpenAIPredictor(AsyncBaseAPIPredictor):
+    """
+    Asynchronous version of OpenAIPredictor so multiple conversations can await OpenAI at once.
+    """
+    def __init__(
+            self,
+            model,
+            apis_used,
+            disable_docs=False,
+            response_cache: Optional[ResponseCache] = None,
+            metadata_level: str = MetadataLevels.FULL
+    ):
+        self.predictor = OpenAIPredictor(model, apis_used, disable_docs, response_cache, metadata_level)
+
+    def pop_blobs(self) -> Dict[str, dict]:
+        return self.predictor.pop_blobs()
+
+    async def predict(self, metadata: dict, conversation_history: dict) -> dict:
+        openai_request = self.predictor.get_openai_request(metadata, conversation_history)
+        openai_response = await self.predictor.response_cache.call_async(openai_chat_completion_async, openai_request)
+        return self.predictor.parse_openai_response(openai_request, openai_response)
+
 
 class EvalModes(str, Enum):
     PREDICT = "predict"
@@ -118,92 +187,355 @@ class EvalModes(str, Enum):
     VALIDATE = "validate"
 
 
+def parse_semantic_threshold(value: str) -> Tuple[str, float]:
+    key, _, threshold = value.partition("=")
+    try:
+        return key, float(threshold)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid semantic threshold {value}, expected <api name>.<parameter>=<value>")
+
+
 def get_arg_parser():
     parser = argparse.ArgumentParser(description=__doc__)
-    parser.add_argument("--dataset", type=str, help="Path to dataset for models to evaluate")
+    parser.add_argument("--dataset", type=str,
+                        help="Path to dataset directory or packed dataset for models to evaluate")
     parser.add_argument("--database", type=str, help="Path to database used in evaluation")
     parser.add_argument("--api_key", type=str, default="openai.key", help="Path to OpenAI API key")
     parser.add_argument("--api_mode", type=str, choices=["exact", "suite", "all"], default="all",
                         help="API mode to use for evaluation, determines which api docs to include")
     parser.add_argument("--model", type=str, default="gpt-4", help="Model to use for generation")
+    parser.add_argument("--api_base", type=str, default=None,
+                        help="Base URL of an OpenAI compatible API, e.g. tooltalk.evaluation.oracle_server")
     parser.add_argument("--output_dir", type=str, help="Path to output model predictions")
     parser.add_argument("--reset", action="store_true", help="reset evaluation writing over any cached results")
+    parser.add_argument("--requests_per_minute", type=float, default=None,
+                        help="Limit on OpenAI requests per minute, shared by all workers")
+    parser.add_argument("--tokens_per_minute", type=float, default=None,
+                        help="Limit on OpenAI tokens per minute, shared by all workers")
+    parser.add_argument("--rate_limit_state", type=str, default=None,
+                        help="File to share rate limits through, e.g. between separate runs using the same key")
+    parser.add_argument("--response_cache", type=str, default=os.environ.get("TOOLTALK_RESPONSE_CACHE"),
+                        help="Directory to record OpenAI responses in and replay them from")
+    parser.add_argument("--response_cache_mode", type=str, choices=[mode.value for mode in CacheModes],
+                        default=None, help="How to use the response cache, read_through if a cache is given")
+    parser.add_argument("--output_format", type=str, choices=["files", "jsonl"], default="files",
+                        help="Write a json file per conversation, or append conversations to a results log")
+    parser.add_argument("--metadata", type=str, choices=[level.value for level in MetadataLevels],
+                        default=MetadataLevels.FULL.value,
+                        help="OpenAI request and response kept with each prediction, dedup stores each distinct "
+                             "function docs and message history once in .tooltalk/blobs.jsonl of the output directory")
+    parser.add_argument("--fsync_interval", type=float, default=5.0,
+                        help="Seconds between syncing the results log to disk")
     parser.add_argument("--disable_documentation", action="store_true",
                         help="disabled documentation sent to GPT-4 replacing with empty strings")
     parser.add_argument("--modes", choices=list(EvalModes), type=str, nargs='+', default=list(EvalModes),
                         help="Evaluation modes")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of worker processes to evaluate conversations with")
+    parser.add_argument("--concurrency", type=int, default=1,
+                        help="Number of conversations to keep in flight on an asyncio event loop")
+    parser.add_argument("--embedding_cache", type=str, default=os.environ.get("TOOLTALK_EMBEDDING_CACHE"),
+                        help="Directory to persist embeddings of semantic comparisons across runs")
+    parser.add_argument("--embedding_index", type=str, default=None,
+                        help="Ground truth embedding index of the dataset built by tooltalk.evaluation.embedding_index")
+    parser.add_argument("--semantic_backend", type=str, choices=list(SEMANTIC_BACKENDS),
+                        default=os.environ.get("TOOLTALK_SEMANTIC_BACKEND", "sent2vec"),
+                        help="Backend used to compare strings semantically")
+    parser.add_argument("--semantic_threshold", type=parse_semantic_threshold, nargs='+', default=list(),
+                        help="Thresholds overriding those of the semantic backend, as <api name>.<parameter>=<value>")
 
     return parser
 
 
+def get_apis_used(conversation: dict, api_mode: str) -> list:
+    if api_mode == "exact":
+        return [APIS_BY_NAME[api_name] for api_name in conversation["apis_used"]]
+    elif api_mode == "suite":
+        return [api for suite_name in conversation["suites_used"] for api in SUITES_BY_NAME[suite_name].apis]
+    elif api_mode == "all":
+        return ALL_APIS
+    else:
+        raise ValueError(f"Invalid api mode: {api_mode}")
+
+
+def get_cache_key(conversation: dict, database_digest: str, args) -> str:
+    """
+    Hashes everything predictions depend on, the conversation, model, prompt, API docs shown and databases tools run on.
+    Predictions are only reused if their key is unchanged, conversations stored without predicting are never reused
+    once predicting.
+    """
+    apis_used = get_apis_used(conversation, args.api_mode)
+    config = {
+        "conversation": conversation,
+        "model": args.model,
+        "system_prompt": OpenAIPredictor.system_prompt,
+        "api_docs": get_openai_docs(apis_used, args.disable_documentation).digest,
+        "databases": database_digest,
+        "predict": EvalModes.PREDICT in args.modes,
+    }
+    return hashlib.sha256(json.dumps(config, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def get_evaluation_key(args) -> str:
+    """
+    Hashes the settings evaluation depends on, reused predictions are evaluated again if their key changed.
+    """
+    config = {
+        "modes": sorted(args.modes),
+        "semantic_backend": args.semantic_backend,
+        "semantic_threshold": sorted(args.semantic_threshold),
+    }
+    return hashlib.sha256(json.dumps(config, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def open_results(args) -> Union[ResultsDirectory, ResultsLog]:
+    if args.output_format == "jsonl":
+        return ResultsLog(args.output_dir, writable=True, fsync_interval=args.fsync_interval)
+    return ResultsDirectory(args.output_dir)
+
+
+def finish_conversation(file_name: str, conversation: dict, tool_executor: ToolExecutor, args) -> dict:
+    """
+    Evaluates and validates predictions if requested.
+    """
+    if EvalModes.EVALUATE in args.modes:
+        logger.info("Running evaluation...")
+        conversation = tool_executor.evaluate_predictions(conversation)
+        logger.info(f"Conversation {file_name} pass: {conversation['metrics']['success']}")
+
+        if EvalModes.VALIDATE in args.modes:
+            logger.info("Validating evaluation...")
+            for turn in conversation["conversation"]:
+                if "predictions" not in turn:
+                    continue
+                for prediction in turn["predictions"]:
+                    if prediction["role"] == "api":
+                        assert "match" in prediction
+                        assert "bad_action" in prediction
+    return conversation
+
+
+def write_conversation(
+        results,
+        file_name: str,
+        conversation: dict,
+        blobs: Dict[str, dict],
+        cache_key: str,
+        args
+) -> Optional[dict]:
+    """
+    Writes conversation and the metadata blobs it references to results, returning its metrics if it was evaluated.
+    """
+    metrics = conversation["metrics"] if EvalModes.EVALUATE in args.modes else None
+    results.write(file_name, conversation, metrics, cache_key, blobs, get_evaluation_key(args))
+    return metrics
+
+
+def open_response_cache(args) -> ResponseCache:
+    mode = args.response_cache_mode
+    if mode is None:
+        mode = CacheModes.READ_THROUGH if args.response_cache is not None else CacheModes.OFF
+    return ResponseCache(args.response_cache, mode)
+
+
+def process_conversation_file(
+        file_name: str,
+        conversation: dict,
+        predict: bool,
+        tool_executor: ToolExecutor,
+        response_cache: ResponseCache,
+        args
+) -> Tuple[dict, Dict[str, dict]]:
+    """
+    Runs prediction, unless reusing the predictions in conversation, and evaluation for a single conversation file.
+    Returns the conversation with the metadata blobs it references.
+    """
+    logger.info(f"Running {file_name}")
+
+    blobs = dict()
+    if predict:
+        logger.info("Running prediction...")
+        predictor_func = OpenAIPredictor(
+            model=args.model,
+            apis_used=get_apis_used(conversation, args.api_mode),
+            disable_docs=args.disable_documentation,
+            response_cache=response_cache,
+            metadata_level=args.metadata
+        )
+        conversation = tool_executor.run_conversation(conversation, predictor_func)
+        blobs = predictor_func.pop_blobs()
+    return finish_conversation(file_name, conversation, tool_executor, args), blobs
+
+
+async def process_conversation_file_async(
+        file_name: str,
+        conversation: dict,
+        predict: bool,
+        tool_executors: asyncio.Queue,
+        response_cache: ResponseCache,
+        results,
+        cache_key: str,
+        args
+) -> Optional[dict]:
+    """
+    Asynchronous version of process_conversation_file, borrowing a free executor from tool_executors.
+    Writes conversation to results as soon as it finishes, returning its metrics if it was evaluated.
+    """
+    tool_executor = await tool_executors.get()
+    try:
+        logger.info(f"Running {file_name}")
+
+        blobs = dict()
+        if predict:
+            logger.info("Running prediction...")
+            predictor_func = AsyncOpenAIPredictor(
+                model=args.model,
+                apis_used=get_apis_used(conversation, args.api_mode),
+                disable_docs=args.disable_documentation,
+                response_cache=response_cache,
+                metadata_level=args.metadata
+            )
+            conversation = await tool_executor.run_conversation_async(conversation, predictor_func)
+            blobs = predictor_func.pop_blobs()
+        conversation = finish_conversation(file_name, conversation, tool_executor, args)
+        return write_conversation(results, file_name, conversation, blobs, cache_key, args)
+    finally:
+        tool_executors.put_nowait(tool_executor)
+
+
+async def process_conversation_files_async(
+        pending: List[Tuple[str, dict, bool]],
+        results,
+        cache_keys: dict,
+        args
+) -> List[Optional[dict]]:
+    """
+    Processes file names, conversations and whether to predict them on a single event loop, each in flight
+    conversation holding its own executor.
+    """
+    tool_executors = asyncio.Queue()
+    for _ in range(args.concurrency):
+        tool_executors.put_nowait(ToolExecutor(init_database_dir=args.database, embedding_index=args.embedding_index))
+    response_cache = open_response_cache(args)
+    return await tqdm_asyncio.gather(*[
+        process_conversation_file_async(
+            file_name, conversation, predict, tool_executors, response_cache, results, cache_keys[file_name], args
+        )
+        for file_name, conversation, predict in pending
+    ])
+
+
+def configure_openai(args, openai_key: str) -> None:
+    openai.api_key = openai_key
+    if args.api_base is not None:
+        openai.api_base = args.api_base
+    set_rate_limiter(RateLimiter(args.requests_per_minute, args.tokens_per_minute, args.rate_limit_state))
+
+
+def configure_semantic_comparisons(args) -> None:
+    set_embedding_cache_dir(args.embedding_cache)
+    set_semantic_backend(args.semantic_backend, dict(args.semantic_threshold))
+
+
+# each worker process owns its own executor, semantic comparison models are likewise loaded once per process
+_worker_args = None
+_worker_tool_executor = None
+_worker_response_cache = None
+
+
+def _init_worker(args, openai_key: str) -> None:
+    global _worker_args, _worker_tool_executor, _worker_response_cache
+    configure_openai(args, openai_key)
+    configure_semantic_comparisons(args)
+    _worker_args = args
+    _worker_tool_executor = ToolExecutor(init_database_dir=args.database, embedding_index=args.embedding_index)
+    _worker_response_cache = open_response_cache(args)
+
+
+def _process_conversation_file_in_worker(item: Tuple[str, dict, bool]) -> Tuple[str, Tuple[dict, Dict[str, dict]]]:
+    # results are written by the parent process, the only writer of the output
+    file_name, conversation, predict = item
+    return file_name, process_conversation_file(
+        file_name, conversation, predict, _worker_tool_executor, _worker_response_cache, _worker_args
+    )
+
+
 def main(flags: List[str] = None):
     parser = get_arg_parser()
     args = parser.parse_args(flags)
+    if args.workers > 1 and args.concurrency > 1:
+        parser.error("--workers and --concurrency cannot be combined")
+    if args.response_cache_mode not in (None, CacheModes.OFF) and args.response_cache is None:
+        parser.error(f"--response_cache_mode {args.response_cache_mode} requires --response_cache")
 
-    # get api key
+    # get api key, not needed when only replaying recorded responses
     openai_key = os.environ.get("OPENAI_KEY", None)
-    if openai_key is None:
+    if openai_key is None and os.path.exists(args.api_key):
         with open(args.api_key, "r") as f:
             openai_key = f.read().strip()
-    openai.api_key = openai_key
+    temporary_rate_limit_state = args.workers > 1 and args.rate_limit_state is None
+    if temporary_rate_limit_state:
+        # workers share rate limits through a file
+        args.rate_limit_state = get_default_state_path()
+    configure_openai(args, openai_key)
+    configure_semantic_comparisons(args)
 
     total_metrics = Counter()
-    os.makedirs(args.output_dir, exist_ok=True)
-    tool_executor = ToolExecutor(init_database_dir=args.database)
-    for file_name, file_path in tqdm(get_names_and_paths(args.dataset)):
-        output_file_path = os.path.join(args.output_dir, file_name)
-        if os.path.exists(output_file_path) and not args.reset:
-            logger.info(f"Skipping {file_name} because it already exists")
-            with open(output_file_path, 'r', encoding='utf-8') as reader:
-                conversation_with_metrics = json.load(reader)
-            total_metrics += conversation_with_metrics["metrics"]
-            total_metrics["num_conversations"] += 1
-            continue
-
-        logger.info(f"Running {file_name}")
-        with open(file_path, 'r', encoding='utf-8') as reader:
-            conversation = json.load(reader)
+    dataset = open_dataset(args.dataset)
+    results = open_results(args)
+    if args.reset:
+        results.reset()
+    metrics_by_name = dict()
+    cache_keys = dict()
+    # file names with the conversation to process and whether it needs predicting, each loaded once
+    pending = list()
+    database_digest = get_database_digest(args.database)
+    evaluation_key = get_evaluation_key(args)
+    for file_name in dataset.names:
+        conversation = dataset.load(file_name)
+        cache_keys[file_name] = get_cache_key(conversation, database_digest, args)
+        if args.reset or results.get_cache_key(file_name) != cache_keys[file_name]:
+            pending.append((file_name, conversation, EvalModes.PREDICT in args.modes))
+        elif results.get_evaluation_key(file_name) != evaluation_key:
+            logger.info(f"Evaluating {file_name} again because evaluation settings changed")
+            pending.append((file_name, results.load(file_name), False))
+        else:
+            logger.info(f"Skipping {file_name} because its inputs are unchanged")
+            metrics_by_name[file_name] = results.get_metrics(file_name)
 
-        if EvalModes.PREDICT in args.modes:
-            logger.info("Running prediction...")
-            if args.api_mode == "exact":
-                apis_used = [APIS_BY_NAME[api_name] for api_name in conversation["apis_used"]]
-            elif args.api_mode == "suite":
-                apis_used = [
-                    api for suite_name in conversation["suites_used"] for api in SUITES_BY_NAME[suite_name].apis
-                ]
-            elif args.api_mode == "all":
-                apis_used = ALL_APIS
-            else:
-                raise ValueError(f"Invalid api mode: {args.api_mode}")
-
-            predictor_func = OpenAIPredictor(
-                model=args.model,
-                apis_used=apis_used,
-                disable_docs=args.disable_documentation
-            )
-            conversation = tool_executor.run_conversation(conversation, predictor_func)
+    try:
+        if args.workers > 1:
+            with multiprocessing.Pool(args.workers, initializer=_init_worker, initargs=(args, openai_key)) as pool:
+                finished = pool.imap(_process_conversation_file_in_worker, pending)
+                for file_name, (conversation, blobs) in tqdm(finished, total=len(pending)):
+                    metrics_by_name[file_name] = write_conversation(
+                        results, file_name, conversation, blobs, cache_keys[file_name], args
+                    )
+        elif args.concurrency > 1:
+            all_metrics = asyncio.run(process_conversation_files_async(pending, results, cache_keys, args))
+            metrics_by_name.update(zip([file_name for file_name, _, _ in pending], all_metrics))
+        else:
+            tool_executor = ToolExecutor(init_database_dir=args.database, embedding_index=args.embedding_index)
+            response_cache = open_response_cache(args)
+            for file_name, conversation, predict in tqdm(pending):
+                conversation, blobs = process_conversation_file(
+                    file_name, conversation, predict, tool_executor, response_cache, args
+                )
+                metrics_by_name[file_name] = write_conversation(
+                    results, file_name, conversation, blobs, cache_keys[file_name], args
+                )
+    finally:
+        results.close()
+        if temporary_rate_limit_state and os.path.exists(args.rate_limit_state):
+            os.remove(args.rate_limit_state)
 
-        if EvalModes.EVALUATE in args.modes:
-            logger.info("Running evaluation...")
-            conversation = tool_executor.evaluate_predictions(conversation)
-            logger.info(f"Conversation {file_name} pass: {conversation['metrics']['success']}")
-            total_metrics += conversation["metrics"]
+    # sum in dataset order so totals don't depend on which conversations were resumed
+    for file_name in dataset.names:
+        metrics = metrics_by_name[file_name]
+        if metrics is not None:
+            total_metrics += metrics
             total_metrics["num_conversations"] += 1
 
-            if EvalModes.VALIDATE in args.modes:
-                logger.info("Validating evaluation...")
-                for turn in conversation["conversation"]:
-                    if "predictions" not in turn:
-                        continue
-                    for prediction in turn["predictions"]:
-                        if prediction["role"] == "api":
-                            assert "match" in prediction
-                            assert "bad_action" in prediction
-
-        with open(output_file_path, 'w', encoding='utf-8') as writer:
-            json.dump(conversation, writer, indent=4)
-
     logger.info("Finished processing conversations")
     if EvalModes.EVALUATE in args.modes:
         metrics = {
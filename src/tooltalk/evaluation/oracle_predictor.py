@@ -0,0 +1,63 @@
+"""
+Copyright (c) Microsoft Corporation.
+Licensed under the MIT license.
+"""
+import copy
+
+from tooltalk.evaluation.tool_executor import BaseAPIPredictor
+
+
+class OraclePredictor(BaseAPIPredictor):
+    """
+    Stores entire conversation, then determines conversation state from conversation_history.
+    It then passes in the next, correct API call based off of ground truth.
+
+    aka it produces oracle predictions for testing purposes.
+    """
+
+    def __init__(self, conversation: dict):
+        self.conversation = conversation
+
+    def predict(self, metadata: dict, conversation_history: dict) -> dict:
+        assert metadata == self.conversation["metadata"]
+        turn_index = 0
+        api_index = 0
+        for turn in conversation_history:
+            # ignore api calls
+            if turn["role"] == "assistant" or turn["role"] == "user":
+                api_index = 0
+                turn_index += 1
+            elif turn["role"] == "api":
+                api_index += 1
+            else:
+                raise ValueError(f"Unknown role {turn['role']}")
+
+        if len(self.conversation["conversation"]) <= turn_index:
+            raise ValueError("Conversation history is longer than ground truth conversation")
+
+        turn = self.conversation["conversation"][turn_index]
+
+        if "apis" in turn:
+            if len(turn["apis"]) < api_index:
+                raise ValueError("Current api history is longer than ground truth api history")
+            elif len(turn["apis"]) == api_index:
+                return {
+                    "role": "assistant",
+                    "text": turn["text"]
+                }
+            else:
+                parameters = copy.deepcopy(turn["apis"][api_index]["request"]["parameters"])
+                if "session_token" in parameters:
+                    del parameters["session_token"]
+                return {
+                    "role": "api",
+                    "request": {
+                        "api_name": turn["apis"][api_index]["request"]["api_name"],
+                        "parameters": parameters
+                    }
+                }
+        else:
+            return {
+                "role": "assistant",
+                "text": turn["text"]
+            }
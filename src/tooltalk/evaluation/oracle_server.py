@@ -0,0 +1,218 @@
+"""
+Copyright (c) Microsoft Corporation.
+Licensed under the MIT license.
+
+Local stand-in for the OpenAI chat completions API answering with ground truth of a dataset,
+for benchmarking evaluation offline. Latency, jitter and rate limits can be injected.
+
+python -m tooltalk.evaluation.oracle_server --dataset data/tooltalk --port 8000
+python -m tooltalk.evaluation.evaluate_openai --api_base http://localhost:8000/v1 ...
+"""
+import json
+import time
+import random
+import logging
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Optional, Tuple
+
+from tooltalk.evaluation.evaluate_openai import OpenAIPredictor
+from tooltalk.evaluation.oracle_predictor import OraclePredictor
+from tooltalk.utils.packed_dataset import open_dataset
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimit:
+    """
+    Token bucket allowing requests_per_minute requests on average with bursts of up to burst requests.
+    """
+    def __init__(self, requests_per_minute: float, burst: int) -> None:
+        self.rate = requests_per_minute / 60
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> float:
+        """
+        Takes a token if available returning 0, otherwise returns seconds until one is.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            return (1 - self.tokens) / self.rate
+
+
+class OracleCompletions:
+    """
+    Answers chat completion requests of OpenAIPredictor with the next ground truth turn of their conversation.
+    Conversations are identified by their system prompt and user turns.
+    """
+    def __init__(self, dataset: str) -> None:
+        self.conversations = dict()
+        for _, conversation in open_dataset(dataset):
+            self.conversations.setdefault(self.get_conversation_key(conversation), list()).append(conversation)
+
+    @staticmethod
+    def get_conversation_key(conversation: dict) -> Tuple[str, str]:
+        metadata = conversation["metadata"]
+        system_prompt = OpenAIPredictor.system_prompt.format(
+            location=metadata["location"],
+            timestamp=metadata["timestamp"],
+            username=metadata.get("username")
+        )
+        return system_prompt, conversation["conversation"][0]["text"]
+
+    def find_conversation(self, messages: List[dict]) -> Optional[dict]:
+        user_texts = [message["content"] for message in messages if message["role"] == "user"]
+        candidates = self.conversations.get((messages[0]["content"], user_texts[0]), list())
+        for conversation in candidates:
+            ground_truth_texts = [turn["text"] for turn in conversation["conversation"] if turn["role"] == "user"]
+            if ground_truth_texts[:len(user_texts)] == user_texts:
+                return conversation
+        return None
+
+    @staticmethod
+    def get_conversation_history(messages: List[dict]) -> List[dict]:
+        """
+        Recovers the roles of conversation history from OpenAI messages, which is all OraclePredictor looks at.
+        """
+        conversation_history = list()
+        for message in messages[1:]:
+            if message["role"] == "assistant" and message.get("function_call") is not None:
+                conversation_history.append({"role": "api"})
+            elif message["role"] in ("user", "assistant"):
+                conversation_history.append({"role": message["role"], "text": message["content"]})
+        return conversation_history
+
+    def __call__(self, request: dict) -> dict:
+        messages = request["messages"]
+        conversation = self.find_conversation(messages)
+        if conversation is None:
+            raise KeyError("No conversation in dataset matches request")
+        prediction = OraclePredictor(conversation).predict(
+            conversation["metadata"], self.get_conversation_history(messages)
+        )
+        if prediction["role"] == "api":
+            message = {
+                "role": "assistant",
+                "content": None,
+                "function_call": {
+                    "name": prediction["request"]["api_name"],
+                    "arguments": json.dumps(prediction["request"]["parameters"])
+                }
+            }
+            finish_reason = "function_call"
+        else:
+            message = {"role": "assistant", "content": prediction["text"]}
+            finish_reason = "stop"
+
+        # rough token counts, enough to exercise token budgets
+        prompt_tokens = len(json.dumps(messages)) // 4 + len(json.dumps(request.get("functions", list()))) // 4
+        completion_tokens = len(json.dumps(message)) // 4
+        return {
+            "id": f"chatcmpl-oracle-{random.getrandbits(64):016x}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request["model"],
+            "choices": [{"index": 0, "message": message, "finish_reason": finish_reason}],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens
+            }
+        }
+
+
+def make_handler(completions: OracleCompletions, args, rate_limit: Optional[RateLimit]):
+    class OracleHandler(BaseHTTPRequestHandler):
+        def send_json(self, status: int, body: dict, headers: dict = None) -> None:
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for key, value in (headers or dict()).items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def send_error_json(self, status: int, message: str, error_type: str, headers: dict = None) -> None:
+            self.send_json(status, {"error": {"message": message, "type": error_type, "param": None, "code": None}},
+                           headers)
+
+        def do_POST(self) -> None:
+            if not self.path.rstrip("/").endswith("/chat/completions"):
+                self.send_error_json(404, f"Unknown path {self.path}", "invalid_request_error")
+                return
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length))
+
+            retry_after = rate_limit.acquire() if rate_limit is not None else 0.0
+            if retry_after == 0.0 and random.random() < args.rate_limit_probability:
+                retry_after = args.retry_after
+            if retry_after > 0:
+                self.send_error_json(429, "Rate limit reached for requests", "requests",
+                                     {"Retry-After": f"{retry_after:.3f}"})
+                return
+
+            time.sleep(max(0.0, args.latency + random.uniform(-args.jitter, args.jitter)))
+            try:
+                response = completions(request)
+            except (KeyError, IndexError, ValueError) as error:
+                self.send_error_json(400, str(error), "invalid_request_error")
+                return
+            self.send_json(200, response)
+
+        def log_message(self, format: str, *log_args) -> None:
+            logger.debug(format % log_args)
+
+    return OracleHandler
+
+
+def get_arg_parser():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dataset", type=str, help="Path to dataset directory or packed dataset to answer from")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Host to listen on")
+    parser.add_argument("--port", type=int, default=8000, help="Port to listen on")
+    parser.add_argument("--latency", type=float, default=0.0, help="Mean seconds to wait before answering")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Latency varies uniformly by up to this many seconds")
+    parser.add_argument("--requests_per_minute", type=float, default=None,
+                        help="Answer requests over this rate with 429 rate limit errors")
+    parser.add_argument("--burst", type=int, default=1, help="Requests allowed at once under --requests_per_minute")
+    parser.add_argument("--rate_limit_probability", type=float, default=0.0,
+                        help="Probability of answering any request with a 429 rate limit error")
+    parser.add_argument("--retry_after", type=float, default=1.0,
+                        help="Retry-After seconds sent with randomly injected rate limit errors")
+    return parser
+
+
+def make_server(args) -> ThreadingHTTPServer:
+    completions = OracleCompletions(args.dataset)
+    rate_limit = RateLimit(args.requests_per_minute, args.burst) if args.requests_per_minute else None
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(completions, args, rate_limit))
+    server.daemon_threads = True
+    return server
+
+
+def main(flags: List[str] = None):
+    parser = get_arg_parser()
+    args = parser.parse_args(flags)
+    server = make_server(args)
+    logger.info(f"Serving oracle completions of {args.dataset} on http://{args.host}:{server.server_port}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
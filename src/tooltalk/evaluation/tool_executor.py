@@ -3,20 +3,56 @@ Copyright (c) Microsoft Corporation.
 Licensed under the MIT license.
 """
 import json
+import hashlib
 import logging
 import os
-from typing import List
+import pickle
+from typing import Generator, List, Tuple
 from datetime import datetime
-from collections import deque
+from functools import lru_cache
 from abc import ABC, abstractmethod
 
 from tooltalk.apis import ALL_APIS
+from tooltalk.apis.api import AccountDatabase
+from tooltalk.apis.utils import precompute_semantic_scores
 from tooltalk.apis.account import ACCOUNT_DB_NAME, DeleteAccount, UserLogin, LogoutUser, RegisterUser
+from tooltalk.evaluation.embedding_index import EmbeddingIndex
 from tooltalk.utils.file_utils import get_names_and_paths
 
 logger = logging.getLogger(__name__)
 
 
+@lru_cache()
+def load_databases(init_database_dir: str) -> Tuple[dict, dict]:
+    """
+    Parses databases in a directory, returning paths and contents of databases by name.
+    Cached so executors in the same process share the parsed databases, which must never be modified.
+    """
+    database_files = dict()
+    databases = dict()
+    for file_name, file_path in get_names_and_paths(init_database_dir):
+        database_name, ext = os.path.splitext(file_name)
+        if ext == ".json":
+            database_files[database_name] = file_path
+            with open(file_path, 'r', encoding='utf-8') as reader:
+                databases[database_name] = json.load(reader)
+    return database_files, databases
+
+
+@lru_cache()
+def get_database_digest(init_database_dir: str) -> str:
+    """
+    Hashes the contents of the databases load_databases parses from a directory.
+    """
+    digest = hashlib.sha256()
+    for file_name, file_path in sorted(get_names_and_paths(init_database_dir)):
+        if os.path.splitext(file_name)[1] == ".json":
+            with open(file_path, 'rb') as reader:
+                contents = reader.read()
+            digest.update(f"{file_name}:{len(contents)}:".encode("utf-8") + contents)
+    return digest.hexdigest()
+
+
 class ToolExecutor:
     """
     Handles execution of tools and maintains state of databases when simulating conversations.
@@ -26,45 +62,132 @@ class ToolExecutor:
             init_database_dir: str = None,
             ignore_list: List[str] = None,
             account_database: str = ACCOUNT_DB_NAME,
+            embedding_index: str = None,
     ) -> None:
         self.databases = dict()
-        self.database_files = dict()
         self.account_database = account_database
         self.ignore_list = ignore_list if ignore_list is not None else list()
         self.session_token = None
 
-        for file_name, file_path in get_names_and_paths(init_database_dir):
-            database_name, ext = os.path.splitext(file_name)
-            if ext == ".json":
-                self.database_files[database_name] = file_path
-                with open(file_path, 'r', encoding='utf-8') as reader:
-                    self.databases[database_name] = json.load(reader)
-        if self.account_database not in self.databases:
+        # databases are parsed once, tools only ever see working copies of the mutable ones
+        self.database_files, self.init_databases = load_databases(init_database_dir)
+        if self.account_database not in self.init_databases:
             raise ValueError(f"Account database {self.account_database} not found")
+        self.init_databases = self.init_databases.copy()
+        self.init_databases[self.account_database] = AccountDatabase(self.init_databases[self.account_database])
 
         self.apis = {api.__name__: api for api in ALL_APIS if api.__name__ not in self.ignore_list}
+        for api in self.apis.values():
+            # indexed once here so working copies restored from snapshots come with their indexes
+            if api.database_class is not None and api.database_name in self.init_databases \
+                    and not isinstance(self.init_databases[api.database_name], api.database_class):
+                self.init_databases[api.database_name] = api.database_class(self.init_databases[api.database_name])
         self.inited_tools = dict()
+        self.random_states = dict()
         self.now_timestamp = None
+        # precomputed ground truth embeddings, see tooltalk.evaluation.embedding_index
+        self.embedding_index = EmbeddingIndex(embedding_index) if embedding_index is not None else None
+
+        # databases no action can modify are shared as is, the rest are copied from a pickled snapshot on first use
+        mutable_databases = {api.database_name for api in self.apis.values() if api.is_action}
+        self.database_snapshots = {
+            database_name: pickle.dumps(database, protocol=pickle.HIGHEST_PROTOCOL)
+            for database_name, database in self.init_databases.items()
+            if database_name in mutable_databases and database_name != self.account_database
+        }
+        # every conversation logs a user in, so rather than copying all users each time the account database is
+        # copied once and the changes journaled since are rolled back
+        self.account_working_copy = pickle.loads(
+            pickle.dumps(self.init_databases[self.account_database], protocol=pickle.HIGHEST_PROTOCOL)
+        )
+        self.account_working_copy.start_journal()
+        self.databases[self.account_database] = self.account_working_copy
+        # pickles working copies were restored from, and working copies actions may have changed since
+        self.database_sources = self.database_snapshots
+        self.dirty_databases = set()
 
     def reset_executor(self):
         """
         Reset all tools and databases to their initial state.
+        Changed working copies are dropped and lazily restored from the initial databases by get_database,
+        except for the account database whose changes are rolled back.
         """
-        self.databases = dict()
-        for database_name, file_path in self.database_files.items():
-            with open(file_path, 'r', encoding='utf-8') as reader:
-                self.databases[database_name] = json.load(reader)
+        self.account_working_copy.rollback()
+        self.restore_databases(self.database_snapshots)
         self.inited_tools = dict()
+        self.random_states = dict()
         self.now_timestamp = None
         self.session_token = None
 
+    def save_state(self) -> dict:
+        """
+        Checkpoints databases, session and the random state of tools so simulation can later resume from here.
+        """
+        random_states = self.random_states.copy()
+        for tool_name, tool in self.inited_tools.items():
+            random_states[tool_name] = tool.random.getstate()
+        # only databases changed since the last checkpoint are pickled, the rest keep the pickle they came from
+        database_sources = self.database_sources.copy()
+        for database_name in self.dirty_databases:
+            database_sources[database_name] = pickle.dumps(
+                self.databases[database_name], protocol=pickle.HIGHEST_PROTOCOL
+            )
+        self.database_sources = database_sources
+        self.dirty_databases = set()
+        return {
+            "databases": database_sources,
+            "account_journal": self.account_working_copy.get_journal_mark(),
+            "random_states": random_states,
+            "now_timestamp": self.now_timestamp,
+            "session_token": self.session_token,
+        }
+
+    def load_state(self, state: dict) -> None:
+        """
+        Restores a checkpoint created by save_state.
+        Restoring a checkpoint discards those saved after it, whose account changes are rolled back.
+        """
+        self.account_working_copy.rollback(state["account_journal"])
+        self.restore_databases(state["databases"])
+        self.inited_tools = dict()
+        self.random_states = state["random_states"].copy()
+        self.now_timestamp = state["now_timestamp"]
+        self.session_token = state["session_token"]
+
+    def restore_databases(self, database_sources: dict) -> None:
+        """
+        Restores working copies from pickles by database name, keeping those unchanged since they were restored from
+        the same pickle, and lazily unpickling the rest in get_database.
+        """
+        self.databases = {
+            database_name: database
+            for database_name, database in self.databases.items()
+            if database_name not in self.dirty_databases
+            and self.database_sources.get(database_name) is database_sources.get(database_name)
+        }
+        self.database_sources = database_sources
+        self.dirty_databases = set()
+
+    def get_database(self, database_name: str):
+        """
+        Returns working copy of a database, copying it from its snapshot if this is its first use since reset.
+        """
+        if database_name in self.databases:
+            return self.databases[database_name]
+        if database_name in self.database_sources:
+            database = pickle.loads(self.database_sources[database_name])
+        else:
+            database = self.init_databases.get(database_name)
+        self.databases[database_name] = database
+        return database
+
     def get_init_tool(self, tool_name: str):
         if tool_name in self.inited_tools:
             return self.inited_tools[tool_name]
         cls = self.apis[tool_name]
-        account_db = self.databases.get(self.account_database)
+        account_db = self.get_database(self.account_database)
         if cls.database_name is not None:
-            database = self.databases.get(cls.database_name)
+            database = self.get_database(cls.database_name)
             tool = cls(
                 account_database=account_db,
                 now_timestamp=self.now_timestamp,
@@ -75,6 +198,9 @@ class ToolExecutor:
                 account_database=account_db,
                 now_timestamp=self.now_timestamp,
             )
+        if tool_name in self.random_states:
+            # resume random id generation from checkpoint
+            tool.random.setstate(self.random_states[tool_name])
 
         self.inited_tools[tool_name] = tool
         return tool
@@ -109,6 +235,8 @@ class ToolExecutor:
             return request, response
 
         # execute tool
+        if tool.is_action and tool.database_name in self.database_sources:
+            self.dirty_databases.add(tool.database_name)
         response = tool(**parameters)
 
         # capture session_token and simulate login and logout
@@ -165,46 +293,62 @@ class ToolExecutor:
                 ground_truths.extend(turn["apis"])
 
         # remove ground truth as they get matched to predictions
+        # only ground truths with the same api name can match, so bucket them preserving order
+        ground_truths_by_name = dict()
+        for index, ground_truth in enumerate(ground_truths):
+            ground_truths_by_name.setdefault(ground_truth["request"]["api_name"], list()).append((index, ground_truth))
+        # identical predictions, e.g. repeated calls, reuse comparisons
+        comparisons = dict()
         match_count = 0
         action_count = 0
         valid_action_count = 0
         bad_action_count = 0
-        current_ground_truths = deque(ground_truths)
+        # embed all strings that may be compared semantically at once
+        text_pairs = list()
         for prediction in predictions:
-            is_match = False
-            new_ground_truths = deque()
-            while current_ground_truths:
-                ground_truth = current_ground_truths.popleft()
-                if self.compare_api_calls(prediction, ground_truth):
-                    # don't add back in ground truth that matches
-                    is_match = True
-                    ground_truth["match"] = True
-                    break
+            api_name = prediction["request"]["api_name"]
+            for _, ground_truth in ground_truths_by_name.get(api_name, list()):
+                text_pairs.extend(self.apis[api_name].get_semantic_pairs(prediction, ground_truth))
+        known_vectors = None
+        if self.embedding_index is not None and text_pairs:
+            known_vectors = self.embedding_index.get_conversation_vectors(conversation_with_predictions)
+        with precompute_semantic_scores(text_pairs, known_vectors):
+            for prediction in predictions:
+                is_match = False
+                prediction_key = json.dumps({
+                    "request": prediction["request"],
+                    "response": prediction["response"],
+                    "exception": prediction["exception"],
+                }, sort_keys=True)
+                current_ground_truths = ground_truths_by_name.get(prediction["request"]["api_name"], list())
+                for position, (index, ground_truth) in enumerate(current_ground_truths):
+                    if (prediction_key, index) not in comparisons:
+                        comparisons[prediction_key, index] = self.compare_api_calls(prediction, ground_truth)
+                    if comparisons[prediction_key, index]:
+                        # remove ground truth that matches
+                        is_match = True
+                        ground_truth["match"] = True
+                        del current_ground_truths[position]
+                        break
                 else:
-                    new_ground_truths.append(ground_truth)
-            else:
-                logger.debug(f"Failed {json.dumps(prediction, indent=4)}")
-
-            # alter prediction data
-            is_action = self.is_action(prediction["request"]["api_name"])
-            is_successful = prediction["exception"] is None
-            is_bad_action = not is_match and is_action and is_successful
-            prediction["match"] = is_match
-            prediction["bad_action"] = is_bad_action
+                    logger.debug(f"Failed {json.dumps(prediction, indent=4)}")
 
-            # add back in ground truths that don't match
-            while current_ground_truths:
-                new_ground_truths.append(current_ground_truths.popleft())
-            current_ground_truths = new_ground_truths
+                # alter prediction data
+                is_action = self.is_action(prediction["request"]["api_name"])
+                is_successful = prediction["exception"] is None
+                is_bad_action = not is_match and is_action and is_successful
+                prediction["match"] = is_match
+                prediction["bad_action"] = is_bad_action
 
-            # update counters
-            match_count += is_match
-            action_count += is_action
-            valid_action_count += is_action and is_match
-            bad_action_count += is_bad_action
+                # update counters
+                match_count += is_match
+                action_count += is_action
+                valid_action_count += is_action and is_match
+                bad_action_count += is_bad_action
 
-        for ground_truth in current_ground_truths:
-            ground_truth["match"] = False
+        for current_ground_truths in ground_truths_by_name.values():
+            for _, ground_truth in current_ground_truths:
+                ground_truth["match"] = False
 
         precision = match_count / len(predictions) if len(predictions) > 0 else 0
         recall = match_count / len(ground_truths)
@@ -236,26 +380,33 @@ class ToolExecutor:
         self.now_timestamp = datetime.strptime(metadata["timestamp"], "%Y-%m-%d %H:%M:%S")
 
         # setting these should never fail, if it does it's a bug in the dataset
+        account_database = self.get_database(self.account_database)
         if "session_token" in user_data:
             username = user_data["username"]
             self.session_token = user_data["session_token"]
-            self.databases[self.account_database][username]["session_token"] = user_data["session_token"]
+            account_database.set_session_token(username, user_data["session_token"])
         if "verification_code" in user_data:
             username = user_data["username"]
-            self.databases[self.account_database][username]["verification_code"] = user_data["verification_code"]
+            account_database.update_user(username, verification_code=user_data["verification_code"])
 
+        self.replay_api_history(api_history)
+
+    def replay_api_history(self, api_history: list) -> None:
         for api in api_history:
             # this should also never fail, if it does it's a bug in dataset
             self.execute_tool(**api["request"])
 
-    def run_conversation(self, conversation: dict, predict_func: callable):
+    def simulate_conversation(self, conversation: dict) -> Generator[Tuple[dict, list], dict, dict]:
         """
-        Simulates a conversation, calling prediction function
+        Simulates a conversation as a generator, yielding metadata and conversation history whenever a prediction
+        is needed and expecting that prediction to be sent back. Returns the conversation with predictions.
         """
         metadata = conversation["metadata"]
         user_data = conversation.get("user")
         ground_truth_history = list()
         api_history = list()
+        checkpoint = None
+        replayed_count = 0
 
         for turn in conversation["conversation"]:
             if turn["role"] == "user":
@@ -269,11 +420,18 @@ class ToolExecutor:
                 raise ValueError(f"turn role must be user or assistant, instead got {turn['role']}")
 
             # other turns should be the assistant and could contain API calls
-            self.init_conversation_state(metadata, api_history, user_data)
+            # resume from state after previous ground truth turn, only replaying apis added since
+            if checkpoint is None:
+                self.init_conversation_state(metadata, api_history, user_data)
+            else:
+                self.load_state(checkpoint)
+                self.replay_api_history(api_history[replayed_count:])
+            replayed_count = len(api_history)
+            checkpoint = self.save_state()
             predictions = list()
             current_history = ground_truth_history.copy()
             while True:
-                prediction = predict_func(metadata, current_history)
+                prediction = yield metadata, current_history
                 if prediction["role"] == "assistant":
                     # done with predicting apis
                     predictions.append(prediction)
@@ -318,6 +476,30 @@ class ToolExecutor:
 
         return conversation
 
+    def run_conversation(self, conversation: dict, predict_func: callable):
+        """
+        Simulates a conversation, calling prediction function
+        """
+        simulation = self.simulate_conversation(conversation)
+        try:
+            prediction_inputs = next(simulation)
+            while True:
+                prediction_inputs = simulation.send(predict_func(*prediction_inputs))
+        except StopIteration as stop:
+            return stop.value
+
+    async def run_conversation_async(self, conversation: dict, predict_func: callable):
+        """
+        Simulates a conversation, awaiting asynchronous prediction function
+        """
+        simulation = self.simulate_conversation(conversation)
+        try:
+            prediction_inputs = next(simulation)
+            while True:
+                prediction_inputs = simulation.send(await predict_func(*prediction_inputs))
+        except StopIteration as stop:
+            return stop.value
+
 
 class BaseAPIPredictor(ABC):
     @abstractmethod
@@ -331,3 +513,17 @@ class BaseAPIPredictor(ABC):
     def __call__(self, metadata: dict, conversation_history: dict) -> dict:
         """Simple wrapper for convenience."""
         return self.predict(metadata, conversation_history)
+
+
+class AsyncBaseAPIPredictor(ABC):
+    @abstractmethod
+    def __init__(self, function_docs: List[dict], *args, **kwargs):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def predict(self, metadata: dict, conversation_history: dict) -> dict:
+        raise NotImplementedError
+
+    async def __call__(self, metadata: dict, conversation_history: dict) -> dict:
+        """Simple wrapper for convenience."""
+        return await self.predict(metadata, conversation_history)
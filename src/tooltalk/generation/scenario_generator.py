@@ -13,13 +13,15 @@ import argparse
 from itertools import combinations
 from typing import Optional, List
 
-import openai
 from tqdm import tqdm
 
 from tooltalk.apis import ALL_SUITES
 from tooltalk.utils.file_utils import chunkify
+from tooltalk.utils.lazy_import import lazy_import
 from tooltalk.utils.openai_utils import openai_completion
 
+openai = lazy_import("openai")
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
@@ -0,0 +1,173 @@
+"""
+Copyright (c) Microsoft Corporation.
+Licensed under the MIT license.
+
+Persistent cache of text embeddings shared between evaluation runs and worker processes.
+"""
+from __future__ import annotations
+
+import os
+import json
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+from tooltalk.utils.lazy_import import lazy_import
+
+np = lazy_import("numpy")
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    # no advisory locks on Windows, concurrent writers may then duplicate entries
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+def hash_text(text: str) -> str:
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+
+class EmbeddingStore:
+    """
+    Append only on-disk store of embeddings for a single model.
+
+    Vectors are appended as float32 rows to vectors.bin and only then recorded in keys.txt as "<text hash> <row>",
+    so any key a reader sees has its vector written. Readers memory map vectors.bin and never take locks,
+    writers serialize appends with an exclusive lock on a lock file.
+    """
+    def __init__(self, cache_dir: str, model_name: str) -> None:
+        self.model_name = model_name
+        self.store_dir = os.path.join(cache_dir, hash_text(model_name))
+        os.makedirs(self.store_dir, exist_ok=True)
+        self.meta_path = os.path.join(self.store_dir, "meta.json")
+        self.keys_path = os.path.join(self.store_dir, "keys.txt")
+        self.vectors_path = os.path.join(self.store_dir, "vectors.bin")
+        self.lock_path = os.path.join(self.store_dir, "lock")
+
+        self.dim = None
+        self.rows = dict()
+        self.keys_offset = 0
+        self.vectors = None
+
+    def _load_meta(self) -> None:
+        if self.dim is None and os.path.exists(self.meta_path):
+            with open(self.meta_path, 'r', encoding='utf-8') as reader:
+                meta = json.load(reader)
+            if meta["model"] != self.model_name:
+                raise ValueError(f"Embedding store {self.store_dir} belongs to model {meta['model']}")
+            self.dim = meta["dim"]
+
+    def refresh(self) -> None:
+        """
+        Reads keys appended since last refresh.
+        """
+        self._load_meta()
+        if not os.path.exists(self.keys_path):
+            return
+        with open(self.keys_path, 'rb') as reader:
+            reader.seek(self.keys_offset)
+            data = reader.read()
+        # ignore trailing partial line of a write in progress
+        complete = data[:data.rfind(b"\n") + 1]
+        for line in complete.decode("utf-8").splitlines():
+            key, row = line.split()
+            self.rows[key] = int(row)
+        self.keys_offset += len(complete)
+
+    def _get_vectors(self, row: int) -> np.ndarray:
+        if self.vectors is None or row >= self.vectors.shape[0]:
+            num_rows = os.path.getsize(self.vectors_path) // (4 * self.dim)
+            self.vectors = np.memmap(self.vectors_path, dtype=np.float32, mode='r', shape=(num_rows, self.dim))
+        return self.vectors
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        if key not in self.rows:
+            return None
+        row = self.rows[key]
+        return np.array(self._get_vectors(row)[row])
+
+    def put_many(self, keys: List[str], vectors: np.ndarray) -> None:
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        with open(self.lock_path, 'a') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                self.refresh()
+                if self.dim is None:
+                    self.dim = vectors.shape[1]
+                    with open(self.meta_path, 'w', encoding='utf-8') as writer:
+                        json.dump({"model": self.model_name, "dim": self.dim}, writer)
+                new_indices = dict()
+                for index, key in enumerate(keys):
+                    if key not in self.rows:
+                        new_indices[key] = index
+                if not new_indices:
+                    return
+
+                with open(self.vectors_path, 'ab') as writer:
+                    # drop partial row left by an interrupted writer
+                    row_bytes = 4 * self.dim
+                    start_row = writer.tell() // row_bytes
+                    writer.truncate(start_row * row_bytes)
+                    writer.seek(start_row * row_bytes)
+                    writer.write(vectors[list(new_indices.values())].tobytes())
+                    writer.flush()
+                    os.fsync(writer.fileno())
+                with open(self.keys_path, 'a', encoding='utf-8') as writer:
+                    for row, key in enumerate(new_indices, start_row):
+                        writer.write(f"{key} {row}\n")
+                self.refresh()
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+class EmbeddingCache:
+    """
+    Bounded in memory LRU cache of embeddings in front of an optional on-disk EmbeddingStore.
+    """
+    def __init__(self, model_name: str, cache_dir: Optional[str] = None, max_entries: int = 4096) -> None:
+        self.max_entries = max_entries
+        self.memory = OrderedDict()
+        self.store = EmbeddingStore(cache_dir, model_name) if cache_dir is not None else None
+        if self.store is not None:
+            self.store.refresh()
+
+    def get_many(self, texts: List[str]) -> Dict[str, np.ndarray]:
+        """
+        Returns cached embeddings of texts, texts missing from the cache are left out.
+        """
+        found = dict()
+        missing_keys = dict()
+        for text in texts:
+            if text in self.memory:
+                self.memory.move_to_end(text)
+                found[text] = self.memory[text]
+            elif self.store is not None:
+                missing_keys[text] = hash_text(text)
+
+        if missing_keys:
+            if any(key not in self.store.rows for key in missing_keys.values()):
+                # other processes may have added them since
+                self.store.refresh()
+            for text, key in missing_keys.items():
+                vector = self.store.get(key)
+                if vector is not None:
+                    found[text] = vector
+                    self._remember(text, vector)
+        return found
+
+    def put_many(self, texts: List[str], vectors: np.ndarray) -> None:
+        for text, vector in zip(texts, vectors):
+            self._remember(text, vector)
+        if self.store is not None and texts:
+            self.store.put_many([hash_text(text) for text in texts], vectors)
+
+    def _remember(self, text: str, vector: np.ndarray) -> None:
+        self.memory[text] = vector
+        self.memory.move_to_end(text)
+        if len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
@@ -0,0 +1,33 @@
+"""
+Copyright (c) Microsoft Corporation.
+Licensed under the MIT license.
+
+Defers importing heavy dependencies until they are first used.
+"""
+import importlib
+from types import ModuleType
+
+
+class LazyModule(ModuleType):
+    """
+    Stands in for a module, importing it on first attribute access.
+    Setting attributes, e.g. openai.api_key, is forwarded to the imported module.
+    """
+    def __init__(self, name: str) -> None:
+        super().__init__(name)
+        self.__dict__["_module"] = None
+
+    def _load(self) -> ModuleType:
+        if self._module is None:
+            self.__dict__["_module"] = importlib.import_module(self.__name__)
+        return self._module
+
+    def __getattr__(self, name: str):
+        return getattr(self._load(), name)
+
+    def __setattr__(self, name: str, value) -> None:
+        setattr(self._load(), name, value)
+
+
+def lazy_import(name: str) -> ModuleType:
+    return LazyModule(name)
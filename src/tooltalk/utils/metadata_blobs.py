@@ -0,0 +1,180 @@
+"""
+Copyright (c) Microsoft Corporation.
+Licensed under the MIT license.
+
+Content addressed storage of prediction metadata, so function docs and message histories repeated by every call
+of a conversation are written once instead of once per call.
+"""
+import os
+import json
+import hashlib
+from enum import Enum
+from typing import Dict, List, Optional
+
+BLOBS_FILE = "blobs.jsonl"
+
+
+class MetadataLevels(str, Enum):
+    """
+    How much of each OpenAI call is kept in prediction metadata.
+
+    full: request and response
+    dedup: response and request, with its functions and messages replaced by keys of blobs
+    response: only the response
+    none: nothing
+    """
+    FULL = "full"
+    DEDUP = "dedup"
+    RESPONSE = "response"
+    NONE = "none"
+
+
+def hash_blob(blob) -> str:
+    return hashlib.sha256(json.dumps(blob, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class BlobTable:
+    """
+    Blobs of the requests of one predictor, keyed by hash.
+
+    Functions are stored as a single blob. Messages are stored as a chain, each blob holding the messages added since
+    the longest history stored before along with the key of that history, so a conversation's messages take linear
+    rather than quadratic space. Keys of message histories are chained hashes of their messages, so equal histories
+    have equal keys however they were split.
+    """
+    def __init__(self) -> None:
+        self.blobs: Dict[str, dict] = dict()
+        self.functions_keys: Dict[int, str] = dict()
+
+    def add_functions(self, functions: List[dict], key: Optional[str] = None) -> str:
+        # functions are the same list for every call of a predictor, hash it once unless its hash is known
+        if id(functions) not in self.functions_keys:
+            key = key if key is not None else hash_blob(functions)
+            self.blobs[key] = {"functions": functions}
+            self.functions_keys[id(functions)] = key
+        return self.functions_keys[id(functions)]
+
+    def add_messages(self, messages: List[dict]) -> Optional[str]:
+        keys = list()
+        key = None
+        for message in messages:
+            key = hashlib.sha256(f"{key}:{json.dumps(message, sort_keys=True)}".encode("utf-8")).hexdigest()
+            keys.append(key)
+        if key is None or key in self.blobs:
+            return key
+        # longest history already stored, hashes are chained so this only compares keys
+        start = len(keys) - 1
+        while start > 0 and keys[start - 1] not in self.blobs:
+            start -= 1
+        self.blobs[key] = {
+            "prefix": keys[start - 1] if start > 0 else None,
+            "messages": messages[start:]
+        }
+        return key
+
+    def compact_request(self, request: dict, functions_key: Optional[str] = None) -> dict:
+        compact = {key: value for key, value in request.items() if key not in ("messages", "functions")}
+        compact["messages_blob"] = self.add_messages(request["messages"])
+        if "functions" in request:
+            compact["functions_blob"] = self.add_functions(request["functions"], functions_key)
+        return compact
+
+    def pop_blobs(self) -> Dict[str, dict]:
+        """
+        Returns blobs added since last call, leaving keys in place so later requests still reference them.
+        """
+        blobs = {key: blob for key, blob in self.blobs.items() if blob is not None}
+        self.blobs = dict.fromkeys(self.blobs)
+        return blobs
+
+
+def expand_messages(key: Optional[str], blobs: Dict[str, dict]) -> List[dict]:
+    chunks = list()
+    while key is not None:
+        blob = blobs[key]
+        chunks.append(blob["messages"])
+        key = blob["prefix"]
+    return [message for chunk in reversed(chunks) for message in chunk]
+
+
+def expand_openai_request(request: dict, blobs: Dict[str, dict]) -> dict:
+    """
+    Restores the full OpenAI request from a request compacted by BlobTable.
+    """
+    if "messages_blob" not in request:
+        return request
+    expanded = {key: value for key, value in request.items() if key not in ("messages_blob", "functions_blob")}
+    expanded["messages"] = expand_messages(request["messages_blob"], blobs)
+    if "functions_blob" in request:
+        expanded["functions"] = blobs[request["functions_blob"]]["functions"]
+    return expanded
+
+
+def expand_metadata(conversation: dict, blobs: Dict[str, dict]) -> dict:
+    """
+    Restores full OpenAI requests in prediction metadata of conversation in place.
+    """
+    for turn in conversation["conversation"]:
+        for prediction in turn.get("predictions", list()):
+            metadata = prediction.get("metadata")
+            if metadata is not None and "openai_request" in metadata:
+                metadata["openai_request"] = expand_openai_request(metadata["openai_request"], blobs)
+    return conversation
+
+
+class BlobStore:
+    """
+    Append only blobs.jsonl in a directory, one {"key", "blob"} record per line, each key written once.
+    """
+    def __init__(self, blobs_dir: str, writable: bool = False) -> None:
+        self.path = os.path.join(blobs_dir, BLOBS_FILE)
+        self.keys = set()
+        self.writer = None
+        if writable:
+            os.makedirs(blobs_dir, exist_ok=True)
+        if not writable or not os.path.exists(self.path):
+            return
+        size = 0
+        with open(self.path, 'rb') as reader:
+            for line in reader:
+                if not line.endswith(b"\n"):
+                    break
+                self.keys.add(json.loads(line)["key"])
+                size += len(line)
+        if size < os.path.getsize(self.path):
+            # drop partial record of an interrupted write
+            with open(self.path, 'r+b') as writer:
+                writer.truncate(size)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.keys
+
+    def write(self, blobs: Dict[str, dict]) -> None:
+        new_blobs = [(key, blob) for key, blob in blobs.items() if key not in self.keys]
+        if not new_blobs:
+            return
+        if self.writer is None:
+            self.writer = open(self.path, 'ab')
+        for key, blob in new_blobs:
+            self.writer.write(json.dumps({"key": key, "blob": blob}, separators=(',', ':')).encode("utf-8") + b"\n")
+            self.keys.add(key)
+        self.writer.flush()
+
+    def sync(self) -> None:
+        if self.writer is not None:
+            os.fsync(self.writer.fileno())
+
+    def load(self) -> Dict[str, dict]:
+        blobs = dict()
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as reader:
+                for line in reader:
+                    if line.endswith(b"\n"):
+                        record = json.loads(line)
+                        blobs[record["key"]] = record["blob"]
+        return blobs
+
+    def close(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
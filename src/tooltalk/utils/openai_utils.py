@@ -2,27 +2,100 @@
 Copyright (c) Microsoft Corporation.
 Licensed under the MIT license.
 """
+import json
+import asyncio
 import logging
-import time
 from functools import wraps
+from typing import Optional
 
-import openai
+from tooltalk.utils.lazy_import import lazy_import
+from tooltalk.utils.rate_limiter import RateLimiter, get_retry_after
 
+openai = lazy_import("openai")
 logger = logging.getLogger(__name__)
 
 
-def retry_on_limit(func, retries=5, wait=60):
+# limiter shared by every OpenAI call of the process, replaced by set_rate_limiter
+_rate_limiter = RateLimiter()
+
+
+def set_rate_limiter(rate_limiter: RateLimiter) -> None:
+    global _rate_limiter
+    _rate_limiter = rate_limiter
+
+
+def estimate_tokens(request: dict) -> int:
+    """
+    Roughly estimates tokens a request uses before it is sent, about four characters per token.
+    """
+    prompt = request.get("messages", request.get("prompt", ""))
+    prompt_length = len(json.dumps(prompt)) + len(json.dumps(request.get("functions", list())))
+    return prompt_length // 4 + request.get("max_tokens", 0)
+
+
+def get_used_tokens(response) -> Optional[int]:
+    usage = response.get("usage") if isinstance(response, dict) else None
+    return usage.get("total_tokens") if usage else None
+
+
+def rate_limited(func):
+    """
+    Waits for budget of the shared rate limiter before each call, retrying rate limit errors with backoff.
+    """
     @wraps(func)
     def wrapper(*args, **kwargs):
-        for i in range(retries):
+        tokens = estimate_tokens(kwargs)
+        for attempt in range(_rate_limiter.max_retries + 1):
+            _rate_limiter.wait(tokens)
+            try:
+                response = func(*args, **kwargs)
+            except openai.error.RateLimitError as error:
+                if attempt == _rate_limiter.max_retries:
+                    raise
+                wait = _rate_limiter.backoff(attempt, get_retry_after(error.headers))
+                logger.info(f"{error}, retrying in {wait:.1f}s")
+                continue
+            _rate_limiter.record_usage(tokens, get_used_tokens(response))
+            return response
+    return wrapper
+
+
+def async_rate_limited(func):
+    """
+    Asynchronous version of rate_limited, waiting without blocking the event loop.
+    """
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        tokens = estimate_tokens(kwargs)
+        for attempt in range(_rate_limiter.max_retries + 1):
+            wait = _rate_limiter.try_acquire(tokens)
+            while wait > 0:
+                await asyncio.sleep(wait)
+                wait = _rate_limiter.try_acquire(tokens)
             try:
-                return func(*args, **kwargs)
+                response = await func(*args, **kwargs)
             except openai.error.RateLimitError as error:
-                logger.info(str(error))
-                time.sleep(wait)
-        raise openai.error.RateLimitError
+                if attempt == _rate_limiter.max_retries:
+                    raise
+                wait = _rate_limiter.backoff(attempt, get_retry_after(error.headers))
+                logger.info(f"{error}, retrying in {wait:.1f}s")
+                continue
+            _rate_limiter.record_usage(tokens, get_used_tokens(response))
+            return response
     return wrapper
 
 
-openai_chat_completion = retry_on_limit(openai.ChatCompletion.create)
-openai_completion = retry_on_limit(openai.Completion.create)
+# resolve openai functions on call so importing this module doesn't import openai
+@rate_limited
+def openai_chat_completion(*args, **kwargs):
+    return openai.ChatCompletion.create(*args, **kwargs)
+
+
+@rate_limited
+def openai_completion(*args, **kwargs):
+    return openai.Completion.create(*args, **kwargs)
+
+
+@async_rate_limited
+async def openai_chat_completion_async(*args, **kwargs):
+    return await openai.ChatCompletion.acreate(*args, **kwargs)
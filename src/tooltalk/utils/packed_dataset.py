@@ -0,0 +1,174 @@
+"""
+Copyright (c) Microsoft Corporation.
+Licensed under the MIT license.
+
+Packs a dataset directory of conversation files into a few shards with an offset index, so large datasets
+are streamed without opening and parsing a pretty-printed file per conversation.
+
+python -m tooltalk.utils.packed_dataset --input data/tooltalk --output data/tooltalk.packed
+"""
+import os
+import json
+import mmap
+import logging
+import argparse
+from typing import Dict, Iterator, List, Tuple, Union
+
+from tooltalk.utils.file_utils import get_names_and_paths
+from tooltalk.utils.results_log import ResultsLog, is_results_log
+
+logger = logging.getLogger(__name__)
+
+INDEX_FILE = "index.json"
+PACKED_FORMAT = "tooltalk-packed"
+PACKED_VERSION = 1
+
+
+class DirectoryDataset:
+    """
+    Dataset of one json file per conversation, iterated in order of file name. Files other than *.json are ignored.
+    """
+    def __init__(self, path: str) -> None:
+        names_and_paths = get_names_and_paths(path)
+        self.paths = dict(sorted((name, file_path) for name, file_path in names_and_paths if name.endswith(".json")))
+        self.names = list(self.paths)
+        self._names_by_id = None
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def load(self, name: str) -> dict:
+        with open(self.paths[name], 'r', encoding='utf-8') as reader:
+            return json.load(reader)
+
+    def get(self, conversation_id: str) -> dict:
+        if self._names_by_id is None:
+            # no index to look ids up in, so read every conversation once
+            self._names_by_id = {conversation["conversation_id"]: name for name, conversation in self}
+        return self.load(self._names_by_id[conversation_id])
+
+    def __iter__(self) -> Iterator[Tuple[str, dict]]:
+        for name in self.names:
+            yield name, self.load(name)
+
+
+class PackedDataset:
+    """
+    Dataset packed by pack_dataset, iterated in order of file name.
+
+    Each shard holds compact json records back to back, index.json lists every conversation by file name with its
+    conversation_id, shard, offset and length. Shards are memory mapped on first use.
+    """
+    def __init__(self, path: str) -> None:
+        self.path = path
+        with open(os.path.join(path, INDEX_FILE), 'r', encoding='utf-8') as reader:
+            index = json.load(reader)
+        if index.get("format") != PACKED_FORMAT or index.get("version") != PACKED_VERSION:
+            raise ValueError(f"Unsupported packed dataset {path}")
+        self.shards = index["shards"]
+        self.entries = {name: (shard, offset, length) for name, _, shard, offset, length in index["entries"]}
+        self.names = [entry[0] for entry in index["entries"]]
+        self.names_by_id = {conversation_id: name for name, conversation_id, *_ in index["entries"]}
+        self._shard_maps = dict()
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def _get_shard(self, shard: int) -> mmap.mmap:
+        if shard not in self._shard_maps:
+            with open(os.path.join(self.path, self.shards[shard]), 'rb') as reader:
+                self._shard_maps[shard] = mmap.mmap(reader.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._shard_maps[shard]
+
+    def load(self, name: str) -> dict:
+        shard, offset, length = self.entries[name]
+        return json.loads(self._get_shard(shard)[offset:offset + length])
+
+    def get(self, conversation_id: str) -> dict:
+        return self.load(self.names_by_id[conversation_id])
+
+    def __iter__(self) -> Iterator[Tuple[str, dict]]:
+        # names are stored in shard order, so iterating reads each shard sequentially
+        for name in self.names:
+            yield name, self.load(name)
+
+    def close(self) -> None:
+        for shard_map in self._shard_maps.values():
+            shard_map.close()
+        self._shard_maps = dict()
+
+
+def is_packed_dataset(path: str) -> bool:
+    return os.path.isfile(os.path.join(path, INDEX_FILE))
+
+
+def open_dataset(path: str) -> Union[DirectoryDataset, PackedDataset, ResultsLog]:
+    """
+    Opens either a packed dataset, a results log or a directory (or single file) of conversations.
+    """
+    if is_packed_dataset(path):
+        return PackedDataset(path)
+    if is_results_log(path):
+        return ResultsLog(path)
+    return DirectoryDataset(path)
+
+
+def pack_dataset(input_path: str, output_dir: str, shard_size: int = 256 * 1024 * 1024) -> None:
+    """
+    Packs conversations of input_path into shards of about shard_size bytes in output_dir.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    shards: List[str] = list()
+    entries = list()
+    conversation_ids: Dict[str, str] = dict()
+    writer = None
+    try:
+        for name, conversation in open_dataset(input_path):
+            conversation_id = conversation["conversation_id"]
+            if conversation_id in conversation_ids:
+                raise ValueError(f"Conversation id {conversation_id} of {name} already used by "
+                                 f"{conversation_ids[conversation_id]}")
+            conversation_ids[conversation_id] = name
+
+            record = json.dumps(conversation, separators=(',', ':')).encode('utf-8')
+            if writer is None or (writer.tell() > 0 and writer.tell() + len(record) > shard_size):
+                if writer is not None:
+                    writer.close()
+                shards.append(f"shard-{len(shards):05d}.bin")
+                writer = open(os.path.join(output_dir, shards[-1]), 'wb')
+            entries.append([name, conversation_id, len(shards) - 1, writer.tell(), len(record)])
+            writer.write(record)
+    finally:
+        if writer is not None:
+            writer.close()
+
+    # index is written last so a partially packed dataset is never opened
+    index_path = os.path.join(output_dir, INDEX_FILE)
+    with open(index_path + ".tmp", 'w', encoding='utf-8') as writer:
+        json.dump({
+            "format": PACKED_FORMAT,
+            "version": PACKED_VERSION,
+            "shards": shards,
+            "entries": entries
+        }, writer)
+    os.replace(index_path + ".tmp", index_path)
+    logger.info(f"Packed {len(entries)} conversations into {len(shards)} shards in {output_dir}")
+
+
+def get_arg_parser():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--input", type=str, help="Path to dataset directory to pack")
+    parser.add_argument("--output", type=str, help="Directory to write packed dataset to")
+    parser.add_argument("--shard_size_mb", type=int, default=256, help="Approximate size of each shard")
+    return parser
+
+
+def main(flags: List[str] = None):
+    parser = get_arg_parser()
+    args = parser.parse_args(flags)
+    pack_dataset(args.input, args.output, args.shard_size_mb * 1024 * 1024)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,169 @@
+"""
+Copyright (c) Microsoft Corporation.
+Licensed under the MIT license.
+
+Rate limiting of API calls shared between threads, asyncio tasks and processes.
+"""
+import os
+import json
+import time
+import random
+import tempfile
+import threading
+from typing import Callable, Optional
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    # no advisory locks on Windows, processes sharing a state file may then race
+    fcntl = None
+
+
+class RateLimiter:
+    """
+    Token buckets of requests and tokens per minute, each holding at most a minute of budget.
+    A rate limit error blocks every caller sharing the limiter until its retry-after hint or an exponential backoff
+    with jitter has passed.
+
+    State lives in memory, shared by threads and tasks of a process, or in state_path if given, shared by every
+    process using the same file.
+    """
+    def __init__(
+            self,
+            requests_per_minute: Optional[float] = None,
+            tokens_per_minute: Optional[float] = None,
+            state_path: Optional[str] = None,
+            max_retries: int = 8,
+            base_wait: float = 1.0,
+            max_wait: float = 60.0
+    ) -> None:
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.state_path = state_path
+        self.max_retries = max_retries
+        self.base_wait = base_wait
+        self.max_wait = max_wait
+        self.lock = threading.Lock()
+        self.state = self._initial_state()
+
+    def _initial_state(self) -> dict:
+        return {
+            "requests": self.requests_per_minute,
+            "tokens": self.tokens_per_minute,
+            "updated": time.time(),
+            "blocked_until": 0.0
+        }
+
+    def _update(self, func: Callable[[dict, float], float]) -> float:
+        """
+        Applies func to the current state under lock, persisting the state if shared between processes.
+        """
+        with self.lock:
+            if self.state_path is None:
+                return func(self.state, time.time())
+            with open(self.state_path, 'a+', encoding='utf-8') as file:
+                if fcntl is not None:
+                    fcntl.flock(file, fcntl.LOCK_EX)
+                try:
+                    file.seek(0)
+                    data = file.read()
+                    state = json.loads(data) if data else self._initial_state()
+                    result = func(state, time.time())
+                    file.seek(0)
+                    file.truncate()
+                    file.write(json.dumps(state))
+                    file.flush()
+                    return result
+                finally:
+                    if fcntl is not None:
+                        fcntl.flock(file, fcntl.LOCK_UN)
+
+    def _refill(self, state: dict, now: float) -> None:
+        elapsed = max(0.0, now - state["updated"])
+        if self.requests_per_minute is not None:
+            state["requests"] = min(self.requests_per_minute,
+                                    state["requests"] + elapsed * self.requests_per_minute / 60)
+        if self.tokens_per_minute is not None:
+            state["tokens"] = min(self.tokens_per_minute, state["tokens"] + elapsed * self.tokens_per_minute / 60)
+        state["updated"] = max(state["updated"], now)
+
+    def try_acquire(self, tokens: int = 0) -> float:
+        """
+        Takes budget for a request of about tokens tokens, returning 0, or returns seconds to wait before trying again.
+        """
+        def acquire(state: dict, now: float) -> float:
+            if state["blocked_until"] > now:
+                return state["blocked_until"] - now
+            self._refill(state, now)
+            wait = 0.0
+            if self.requests_per_minute is not None and state["requests"] < 1:
+                wait = max(wait, (1 - state["requests"]) * 60 / self.requests_per_minute)
+            if self.tokens_per_minute is not None:
+                # requests larger than the bucket wait for a full bucket and leave it in debt
+                needed = min(tokens, self.tokens_per_minute)
+                if state["tokens"] < needed:
+                    wait = max(wait, (needed - state["tokens"]) * 60 / self.tokens_per_minute)
+            if wait > 0:
+                return wait
+            if self.requests_per_minute is not None:
+                state["requests"] -= 1
+            if self.tokens_per_minute is not None:
+                state["tokens"] -= tokens
+            return 0.0
+        return self._update(acquire)
+
+    def record_usage(self, estimated_tokens: int, used_tokens: Optional[int]) -> None:
+        """
+        Corrects the token bucket once the actual usage of a request is known.
+        """
+        if self.tokens_per_minute is None or used_tokens is None:
+            return
+
+        def correct(state: dict, now: float) -> float:
+            state["tokens"] -= used_tokens - estimated_tokens
+            return 0.0
+        self._update(correct)
+
+    def backoff(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        """
+        Blocks all callers after a rate limit error, returning seconds until they may retry.
+        Honors retry_after if given, otherwise waits exponentially longer with each attempt.
+        """
+        if retry_after is not None:
+            wait = retry_after + random.uniform(0, self.base_wait)
+        else:
+            wait = random.uniform(0, min(self.max_wait, self.base_wait * 2 ** attempt))
+
+        def block(state: dict, now: float) -> float:
+            state["blocked_until"] = max(state["blocked_until"], now + wait)
+            return state["blocked_until"] - now
+        return self._update(block)
+
+    def wait(self, tokens: int = 0) -> None:
+        while True:
+            wait = self.try_acquire(tokens)
+            if wait == 0:
+                return
+            time.sleep(wait)
+
+
+def get_retry_after(headers) -> Optional[float]:
+    """
+    Reads retry-after hints in seconds from response headers.
+    """
+    if not headers:
+        return None
+    for key, scale in [("retry-after-ms", 1e-3), ("retry-after", 1.0)]:
+        value = headers.get(key) or headers.get(key.title())
+        if value is None:
+            continue
+        try:
+            return float(value) * scale
+        except ValueError:
+            # HTTP dates aren't sent by OpenAI, fall back to backoff
+            return None
+    return None
+
+
+def get_default_state_path() -> str:
+    return os.path.join(tempfile.gettempdir(), f"tooltalk-rate-limit-{os.getpid()}.json")
@@ -0,0 +1,151 @@
+"""
+Copyright (c) Microsoft Corporation.
+Licensed under the MIT license.
+
+Records responses of LLM calls on disk keyed by a hash of the request, so reruns replay them without network.
+"""
+import os
+import json
+import zlib
+import asyncio
+import hashlib
+import logging
+import threading
+from enum import Enum
+from typing import Awaitable, Callable, Optional
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    # no advisory locks on Windows, concurrent writers may then interleave records
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+class CacheModes(str, Enum):
+    OFF = "off"
+    RECORD = "record"
+    REPLAY = "replay"
+    READ_THROUGH = "read_through"
+
+
+class ResponseCacheMiss(Exception):
+    pass
+
+
+def hash_request(request: dict) -> str:
+    return hashlib.sha256(json.dumps(request, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class ResponseStore:
+    """
+    Append only on-disk store of responses.
+
+    Responses are appended zlib compressed to responses.bin and only then recorded in keys.txt as
+    "<request hash> <offset> <length>", later records of a request superseding earlier ones.
+    Readers never take file locks, writers serialize appends with an exclusive lock on a lock file.
+    Within a process, reads and writes may run on several threads and are serialized by a thread lock.
+    """
+    def __init__(self, cache_dir: str) -> None:
+        os.makedirs(cache_dir, exist_ok=True)
+        self.keys_path = os.path.join(cache_dir, "keys.txt")
+        self.data_path = os.path.join(cache_dir, "responses.bin")
+        self.lock_path = os.path.join(cache_dir, "lock")
+        self.records = dict()
+        self.keys_offset = 0
+        self.thread_lock = threading.Lock()
+        self.refresh()
+
+    def refresh(self) -> None:
+        """
+        Reads keys appended since last refresh.
+        """
+        with self.thread_lock:
+            if not os.path.exists(self.keys_path):
+                return
+            with open(self.keys_path, 'rb') as reader:
+                reader.seek(self.keys_offset)
+                data = reader.read()
+            # ignore trailing partial line of a write in progress
+            complete = data[:data.rfind(b"\n") + 1]
+            for line in complete.decode("utf-8").splitlines():
+                key, offset, length = line.split()
+                self.records[key] = (int(offset), int(length))
+            self.keys_offset += len(complete)
+
+    def get(self, key: str) -> Optional[dict]:
+        if key not in self.records:
+            # other processes may have added it since
+            self.refresh()
+            if key not in self.records:
+                return None
+        offset, length = self.records[key]
+        with open(self.data_path, 'rb') as reader:
+            reader.seek(offset)
+            return json.loads(zlib.decompress(reader.read(length)))
+
+    def put(self, key: str, response: dict) -> None:
+        record = zlib.compress(json.dumps(response, separators=(',', ':')).encode("utf-8"))
+        with self.thread_lock, open(self.lock_path, 'a') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(self.data_path, 'ab') as writer:
+                    offset = writer.tell()
+                    writer.write(record)
+                    writer.flush()
+                    os.fsync(writer.fileno())
+                with open(self.keys_path, 'a', encoding='utf-8') as writer:
+                    writer.write(f"{key} {offset} {len(record)}\n")
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+            self.records[key] = (offset, len(record))
+
+
+class ResponseCache:
+    """
+    Record and replay layer in front of an LLM call.
+
+    Modes:
+        off: always call
+        record: always call, storing responses
+        replay: only return stored responses, raising ResponseCacheMiss for requests not stored
+        read_through: return stored responses, calling and storing on a miss
+    """
+    def __init__(self, cache_dir: Optional[str], mode: str = CacheModes.READ_THROUGH) -> None:
+        self.mode = CacheModes(mode)
+        if self.mode != CacheModes.OFF and cache_dir is None:
+            raise ValueError(f"Response cache mode {self.mode.value} requires a cache directory")
+        self.store = ResponseStore(cache_dir) if self.mode != CacheModes.OFF else None
+
+    def _lookup(self, key: str) -> Optional[dict]:
+        if self.mode in (CacheModes.REPLAY, CacheModes.READ_THROUGH):
+            response = self.store.get(key)
+            if response is not None:
+                return response
+            if self.mode == CacheModes.REPLAY:
+                raise ResponseCacheMiss(f"No recorded response for request {key}")
+        return None
+
+    def __call__(self, func: Callable[..., dict], request: dict) -> dict:
+        if self.mode == CacheModes.OFF:
+            return func(**request)
+        key = hash_request(request)
+        response = self._lookup(key)
+        if response is None:
+            response = func(**request)
+            self.store.put(key, response)
+        return response
+
+    async def call_async(self, func: Callable[..., Awaitable[dict]], request: dict) -> dict:
+        if self.mode == CacheModes.OFF:
+            return await func(**request)
+        key = hash_request(request)
+        # file reads and fsynced writes run on threads so other requests in flight are not blocked
+        response = await asyncio.to_thread(self._lookup, key)
+        if response is None:
+            response = await func(**request)
+            await asyncio.to_thread(self.store.put, key, response)
+        return response
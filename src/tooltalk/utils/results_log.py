@@ -0,0 +1,230 @@
+"""
+Copyright (c) Microsoft Corporation.
+Licensed under the MIT license.
+
+Sinks for evaluated conversations, either a directory of json files or an append only log.
+"""
+import os
+import json
+import time
+import logging
+from typing import Dict, Iterator, Optional, Tuple
+
+from tooltalk.utils.metadata_blobs import BlobStore
+
+logger = logging.getLogger(__name__)
+
+LOG_FILE = "results.jsonl"
+INDEX_FILE = "results.index.jsonl"
+# files kept next to results in a hidden directory, so readers of a directory of json files skip them
+STATE_DIR = ".tooltalk"
+CACHE_KEYS_FILE = "cache_keys.jsonl"
+
+
+class ResultsDirectory:
+    """
+    Writes each conversation to its own pretty-printed json file named after the dataset file.
+    Cache and evaluation keys of written conversations are appended to .tooltalk/cache_keys.jsonl, metadata blobs to
+    .tooltalk/blobs.jsonl.
+    """
+    def __init__(self, output_dir: str) -> None:
+        self.output_dir = output_dir
+        os.makedirs(os.path.join(output_dir, STATE_DIR), exist_ok=True)
+        self.blobs = BlobStore(os.path.join(output_dir, STATE_DIR), writable=True)
+        self.cache_keys_path = os.path.join(output_dir, STATE_DIR, CACHE_KEYS_FILE)
+        self.entries = dict()
+        if os.path.exists(self.cache_keys_path):
+            with open(self.cache_keys_path, 'rb') as reader:
+                for line in reader:
+                    if line.endswith(b"\n"):
+                        entry = json.loads(line)
+                        self.entries[entry["name"]] = entry
+
+    def __contains__(self, name: str) -> bool:
+        return os.path.exists(os.path.join(self.output_dir, name))
+
+    def get_cache_key(self, name: str) -> Optional[str]:
+        return self.entries[name]["key"] if name in self.entries and name in self else None
+
+    def get_evaluation_key(self, name: str) -> Optional[str]:
+        return self.entries[name].get("evaluation_key") if name in self.entries and name in self else None
+
+    def load(self, name: str) -> dict:
+        with open(os.path.join(self.output_dir, name), 'r', encoding='utf-8') as reader:
+            return json.load(reader)
+
+    def get_metrics(self, name: str) -> Optional[dict]:
+        return self.load(name).get("metrics")
+
+    def write(
+            self,
+            name: str,
+            conversation: dict,
+            metrics: Optional[dict],
+            cache_key: Optional[str] = None,
+            blobs: Optional[Dict[str, dict]] = None,
+            evaluation_key: Optional[str] = None
+    ) -> None:
+        # blobs go first so a written conversation never references a missing blob
+        self.blobs.write(blobs or dict())
+        with open(os.path.join(self.output_dir, name), 'w', encoding='utf-8') as writer:
+            json.dump(conversation, writer, indent=4)
+        # keys are recorded after the file is complete, an interrupted write is never reused
+        entry = {"name": name, "key": cache_key, "evaluation_key": evaluation_key}
+        with open(self.cache_keys_path, 'a', encoding='utf-8') as writer:
+            writer.write(json.dumps(entry) + "\n")
+        self.entries[name] = entry
+
+    def load_blobs(self) -> Dict[str, dict]:
+        return self.blobs.load()
+
+    def reset(self) -> None:
+        # existing files are overwritten as conversations finish
+        pass
+
+    def close(self) -> None:
+        self.blobs.close()
+
+
+class ResultsLog:
+    """
+    Append only log of conversations, one compact json record per line in results.jsonl.
+
+    Every record is followed by a line in results.index.jsonl with its name, conversation_id, offset, length, cache
+    and evaluation keys and metrics, so resuming and aggregating only read the index. A conversation written again
+    supersedes its earlier record. Records without an index line, e.g. after a crash, are truncated when the log is
+    next opened for writing. Metadata blobs referenced by records are appended to .tooltalk/blobs.jsonl before them.
+    """
+    def __init__(self, output_dir: str, writable: bool = False, fsync_interval: float = 5.0) -> None:
+        self.output_dir = output_dir
+        self.log_path = os.path.join(output_dir, LOG_FILE)
+        self.index_path = os.path.join(output_dir, INDEX_FILE)
+        self.fsync_interval = fsync_interval
+        self.entries = dict()
+        self.log_writer = None
+        self.index_writer = None
+        self.last_fsync = time.monotonic()
+        self.blobs = BlobStore(os.path.join(output_dir, STATE_DIR), writable=writable)
+
+        if writable:
+            os.makedirs(output_dir, exist_ok=True)
+        log_size, index_size = self._load_index()
+        if writable:
+            # drop partial lines and records left by an interrupted run before appending
+            self.log_writer = open(self.log_path, 'ab')
+            self.index_writer = open(self.index_path, 'ab')
+            self._truncate(log_size, index_size)
+
+    def _load_index(self) -> Tuple[int, int]:
+        """
+        Reads complete index lines whose records are in the log, returns valid sizes of log and index.
+        """
+        if not os.path.exists(self.index_path):
+            return 0, 0
+        log_size = os.path.getsize(self.log_path) if os.path.exists(self.log_path) else 0
+        valid_log_size = 0
+        valid_index_size = 0
+        with open(self.index_path, 'rb') as reader:
+            for line in reader:
+                if not line.endswith(b"\n"):
+                    break
+                entry = json.loads(line)
+                if entry["offset"] + entry["length"] > log_size:
+                    break
+                self.entries[entry["name"]] = entry
+                valid_log_size = max(valid_log_size, entry["offset"] + entry["length"])
+                valid_index_size += len(line)
+        return valid_log_size, valid_index_size
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    @property
+    def names(self):
+        return sorted(self.entries)
+
+    def get_metrics(self, name: str) -> Optional[dict]:
+        return self.entries[name]["metrics"]
+
+    def get_cache_key(self, name: str) -> Optional[str]:
+        return self.entries[name].get("key") if name in self.entries else None
+
+    def get_evaluation_key(self, name: str) -> Optional[str]:
+        return self.entries[name].get("evaluation_key") if name in self.entries else None
+
+    def load(self, name: str) -> dict:
+        entry = self.entries[name]
+        with open(self.log_path, 'rb') as reader:
+            reader.seek(entry["offset"])
+            return json.loads(reader.read(entry["length"]))
+
+    def __iter__(self) -> Iterator[Tuple[str, dict]]:
+        # records are read in name order, matching iteration over a dataset
+        with open(self.log_path, 'rb') as reader:
+            for name in self.names:
+                entry = self.entries[name]
+                reader.seek(entry["offset"])
+                yield name, json.loads(reader.read(entry["length"]))
+
+    def load_blobs(self) -> Dict[str, dict]:
+        return self.blobs.load()
+
+    def write(
+            self,
+            name: str,
+            conversation: dict,
+            metrics: Optional[dict],
+            cache_key: Optional[str] = None,
+            blobs: Optional[Dict[str, dict]] = None,
+            evaluation_key: Optional[str] = None
+    ) -> None:
+        self.blobs.write(blobs or dict())
+        record = json.dumps(conversation, separators=(',', ':')).encode('utf-8') + b"\n"
+        entry = {
+            "name": name,
+            "conversation_id": conversation.get("conversation_id"),
+            "offset": self.log_writer.tell(),
+            "length": len(record),
+            "key": cache_key,
+            "evaluation_key": evaluation_key,
+            "metrics": metrics
+        }
+        self.log_writer.write(record)
+        self.log_writer.flush()
+        self.index_writer.write(json.dumps(entry).encode('utf-8') + b"\n")
+        self.index_writer.flush()
+        self.entries[name] = entry
+        if time.monotonic() - self.last_fsync >= self.fsync_interval:
+            self.sync()
+
+    def sync(self) -> None:
+        # blobs and log first, so a synced index line never points past the synced log or a missing blob
+        self.blobs.sync()
+        os.fsync(self.log_writer.fileno())
+        os.fsync(self.index_writer.fileno())
+        self.last_fsync = time.monotonic()
+
+    def _truncate(self, log_size: int, index_size: int) -> None:
+        for writer, size in [(self.log_writer, log_size), (self.index_writer, index_size)]:
+            writer.truncate(size)
+            writer.seek(size)
+
+    def reset(self) -> None:
+        self._truncate(0, 0)
+        self.entries = dict()
+
+    def close(self) -> None:
+        if self.log_writer is not None:
+            self.sync()
+            self.log_writer.close()
+            self.index_writer.close()
+            self.log_writer = None
+            self.index_writer = None
+        self.blobs.close()
+
+
+def is_results_log(path: str) -> bool:
+    return os.path.isfile(os.path.join(path, INDEX_FILE))
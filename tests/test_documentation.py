@@ -4,9 +4,12 @@ Licensed under the MIT license.
 
 Ensure tool documentation is complete
 """
+import json
+import hashlib
 import inspect
 
-from tooltalk.apis import ALL_APIS
+from tooltalk.apis import ALL_APIS, ALL_SUITES
+from tooltalk.apis.api import get_openai_docs
 
 
 def test_missing_documentation():
@@ -29,3 +32,22 @@ def test_missing_documentation():
 
         assert doc_params == sig_params, \
             f"API {api} has mismatched parameters between documentation and implementation"
+
+
+def test_cached_openai_docs():
+    for disable_doc in [False, True]:
+        docs = get_openai_docs(ALL_APIS, disable_doc)
+        assert docs is get_openai_docs(list(ALL_APIS), disable_doc)
+        assert docs.docs == [api._make_openai_doc(disable_doc) for api in ALL_APIS]
+        assert json.loads(docs.json) == docs.docs
+        assert docs.digest == hashlib.sha256(docs.json.encode('utf-8')).hexdigest()
+    assert get_openai_docs(ALL_APIS, True).digest != get_openai_docs(ALL_APIS, False).digest
+    for suite in ALL_SUITES:
+        assert suite.to_openai_doc() == [api._make_openai_doc(False) for api in suite.apis]
+        assert suite.to_docstring().endswith("\n".join(api._make_docstring() for api in suite.apis))
+
+    # callers get copies, changing them leaves the shared docs alone
+    ALL_APIS[0].to_openai_doc()["parameters"]["properties"].clear()
+    ALL_SUITES[0].to_openai_doc()[0]["parameters"]["properties"]["changed"] = dict()
+    assert get_openai_docs(ALL_APIS).docs == [api._make_openai_doc(False) for api in ALL_APIS]
+    assert ALL_SUITES[0].to_openai_doc() == [api._make_openai_doc(False) for api in ALL_SUITES[0].apis]
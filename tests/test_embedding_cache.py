@@ -0,0 +1,75 @@
+"""
+Copyright (c) Microsoft Corporation.
+Licensed under the MIT license.
+
+Ensure embeddings persist across cache instances and processes
+"""
+import os
+import json
+import multiprocessing
+
+import numpy as np
+
+from tooltalk.apis import utils
+from tooltalk.evaluation.embedding_index import EmbeddingIndex, build_embedding_index
+from tooltalk.utils.embedding_cache import EmbeddingCache
+
+DATA_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "data"))
+
+
+def _put_texts(cache_dir: str, offset: int) -> None:
+    cache = EmbeddingCache("test-model", cache_dir)
+    texts = [f"text {i}" for i in range(offset, offset + 50)]
+    cache.put_many(texts, np.arange(offset, offset + 50, dtype=np.float32)[:, None].repeat(4, axis=1))
+
+
+def test_embedding_cache_persists(tmp_path):
+    cache = EmbeddingCache("test-model", str(tmp_path), max_entries=2)
+    vectors = np.random.rand(3, 4).astype(np.float32)
+    cache.put_many(["a", "b", "c"], vectors)
+    assert len(cache.memory) == 2
+
+    reloaded = EmbeddingCache("test-model", str(tmp_path))
+    found = reloaded.get_many(["a", "b", "c", "d"])
+    assert set(found) == {"a", "b", "c"}
+    for text, vector in zip("abc", vectors):
+        assert np.array_equal(found[text], vector)
+    assert EmbeddingCache("other-model", str(tmp_path)).get_many(["a"]) == {}
+
+
+def test_embedding_cache_concurrent_writers(tmp_path):
+    processes = [multiprocessing.Process(target=_put_texts, args=(str(tmp_path), i * 25)) for i in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+    texts = [f"text {i}" for i in range(125)]
+    found = EmbeddingCache("test-model", str(tmp_path)).get_many(texts)
+    assert len(found) == 125
+    for i, text in enumerate(texts):
+        assert np.all(found[text] == i)
+
+
+def test_embedding_index(tmp_path):
+    utils.set_semantic_backend("char_ngram")
+    try:
+        dataset = os.path.join(DATA_DIR, "tooltalk")
+        build_embedding_index(dataset, str(tmp_path))
+        index = EmbeddingIndex(str(tmp_path))
+        with open(os.path.join(dataset, "golden_conversation_1.json"), 'r', encoding='utf-8') as reader:
+            conversation = json.load(reader)
+        known_vectors = index.get_conversation_vectors(conversation)
+        assert known_vectors
+        for text, vector in known_vectors.items():
+            assert np.array_equal(vector, utils.embed_texts([text])[0])
+
+        # edited ground truth is not looked up in the index
+        for turn in conversation["conversation"]:
+            for api_call in turn.get("apis", list()):
+                for key, value in api_call["request"]["parameters"].items():
+                    if isinstance(value, str) and value in known_vectors:
+                        api_call["request"]["parameters"][key] = value + " edited"
+        assert not index.get_conversation_vectors(conversation)
+    finally:
+        utils.set_semantic_backend("sent2vec")
@@ -0,0 +1,89 @@
+"""
+Copyright (c) Microsoft Corporation.
+Licensed under the MIT license.
+
+Ensure predictions are matched to ground truth API calls of the same name, each ground truth matched at most once
+"""
+import os
+
+from tooltalk.evaluation.tool_executor import ToolExecutor
+
+DATABASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "data", "databases"))
+WEATHER = {"weather": {"date": "2023-09-11", "high": 70, "low": 60, "conditions": "sunny"}}
+
+
+def api_call(api_name: str, parameters: dict, response, exception: str = None) -> dict:
+    return {"request": {"api_name": api_name, "parameters": parameters}, "response": response, "exception": exception}
+
+
+def evaluate(ground_truths: list, predictions: list) -> dict:
+    conversation = {"conversation": [
+        {"role": "user", "text": "hi"},
+        {
+            "role": "assistant",
+            "text": "done",
+            "apis": ground_truths,
+            "predictions": [dict(prediction, role="api") for prediction in predictions]
+            + [{"role": "assistant", "text": "done"}],
+        },
+    ]}
+    return ToolExecutor(init_database_dir=DATABASE_DIR).evaluate_predictions(conversation)
+
+
+def test_matches_only_same_api_name():
+    ground_truths = [
+        api_call("CurrentWeather", {"location": "london"}, WEATHER),
+        api_call("HistoricWeather", {"location": "london"}, WEATHER),
+    ]
+    # both have the request and response of the first ground truth, but only match ground truths of their own api
+    predictions = [
+        api_call("HistoricWeather", {"location": "london"}, WEATHER),
+        api_call("ForecastWeather", {"location": "london"}, WEATHER),
+    ]
+    result = evaluate(ground_truths, predictions)
+    assert [api["match"] for api in result["conversation"][1]["apis"]] == [False, True]
+    assert [prediction.get("match") for prediction in result["conversation"][1]["predictions"]] == [True, False, None]
+    assert result["metrics"]["matches"] == 1
+    assert result["metrics"]["recall"] == 0.5
+    assert result["metrics"]["precision"] == 0.5
+    assert result["metrics"]["bad_actions"] == 0
+
+
+def test_duplicate_ground_truths():
+    ground_truths = [
+        api_call("AddAlarm", {"session_token": "token", "time": "07:00:00"}, {"alarm_id": "1"}),
+        api_call("AddAlarm", {"session_token": "token", "time": "08:00:00"}, {"alarm_id": "2"}),
+        api_call("AddAlarm", {"session_token": "token", "time": "07:00:00"}, {"alarm_id": "3"}),
+    ]
+    # identical predictions reuse comparisons, but each still needs its own ground truth
+    predictions = [api_call("AddAlarm", {"session_token": "token", "time": "07:00:00"}, {"alarm_id": "4"})] * 3
+    result = evaluate(ground_truths, [dict(prediction) for prediction in predictions])
+    assert [api["match"] for api in result["conversation"][1]["apis"]] == [True, False, True]
+    turn_predictions = result["conversation"][1]["predictions"][:3]
+    assert [prediction["match"] for prediction in turn_predictions] == [True, True, False]
+    assert [prediction["bad_action"] for prediction in turn_predictions] == [False, False, True]
+    assert result["metrics"]["matches"] == 2
+    assert result["metrics"]["valid_actions"] == 2
+    assert result["metrics"]["bad_actions"] == 1
+    assert not result["metrics"]["success"]
+
+
+def test_unmatched_actions():
+    ground_truths = [api_call("CurrentWeather", {"location": "london"}, WEATHER)]
+    predictions = [
+        api_call("CurrentWeather", {"location": "london"}, WEATHER),
+        # successful action without a matching ground truth changes state the user did not ask for
+        api_call("AddAlarm", {"session_token": "token", "time": "07:00:00"}, {"alarm_id": "1"}),
+        # failed actions and unmatched retrievals are not bad actions
+        api_call("DeleteAlarm", {"session_token": "token", "alarm_id": "2"}, None, "Alarm 2 not found"),
+        api_call("ForecastWeather", {"location": "london"}, {"forecast": []}),
+    ]
+    result = evaluate(ground_truths, predictions)
+    turn_predictions = result["conversation"][1]["predictions"][:4]
+    assert [prediction["match"] for prediction in turn_predictions] == [True, False, False, False]
+    assert [prediction["bad_action"] for prediction in turn_predictions] == [False, True, False, False]
+    assert result["metrics"]["actions"] == 2
+    assert result["metrics"]["bad_action_rate"] == 0.5
+    assert result["metrics"]["recall"] == 1.0
+    assert not result["metrics"]["success"]
+    assert result["metrics"]["soft_success"] == 0.5
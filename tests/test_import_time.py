@@ -0,0 +1,20 @@
+"""
+Copyright (c) Microsoft Corporation.
+Licensed under the MIT license.
+
+Ensure importing tooltalk defers heavy dependencies until they are used
+"""
+import sys
+import json
+import subprocess
+
+HEAVY_MODULES = ["numpy", "openai", "sent2vec", "torch", "transformers"]
+
+
+def test_import_defers_heavy_modules():
+    code = "import sys, json\n" \
+           "import tooltalk.apis, tooltalk.evaluation.calculate_error_types, tooltalk.evaluation.evaluate_openai\n" \
+           f"print(json.dumps([name for name in {HEAVY_MODULES} if name in sys.modules]))"
+    output = subprocess.run([sys.executable, "-c", code], check=True, capture_output=True, text=True).stdout
+    assert json.loads(output) == []
+
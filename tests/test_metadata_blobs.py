@@ -0,0 +1,105 @@
+"""
+Copyright (c) Microsoft Corporation.
+Licensed under the MIT license.
+
+Ensure deduplicated prediction metadata restores the full OpenAI requests
+"""
+import os
+import json
+import copy
+
+from tooltalk.apis import ALL_APIS
+from tooltalk.apis.api import get_openai_docs
+from tooltalk.evaluation.evaluate_openai import OpenAIPredictor
+from tooltalk.evaluation.oracle_predictor import OraclePredictor
+from tooltalk.evaluation.tool_executor import ToolExecutor
+from tooltalk.utils.metadata_blobs import BLOBS_FILE, MetadataLevels, expand_metadata
+from tooltalk.utils.results_log import STATE_DIR, ResultsLog
+
+DATA_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "data"))
+
+
+class RecordingPredictor(OpenAIPredictor):
+    """
+    Answers like the oracle without calling OpenAI, recording every request.
+    """
+    def __init__(self, conversation: dict, metadata_level: str) -> None:
+        super().__init__("gpt-4", ALL_APIS, metadata_level=metadata_level)
+        self.oracle = OraclePredictor(conversation)
+        self.requests = list()
+
+    def predict(self, metadata: dict, conversation_history: dict) -> dict:
+        openai_request = self.get_openai_request(metadata, conversation_history)
+        self.requests.append(copy.deepcopy(openai_request))
+        prediction = self.oracle.predict(metadata, conversation_history)
+        prediction["metadata"] = self.get_metadata(openai_request, {"choices": []})
+        return prediction
+
+
+def test_dedup_metadata(tmp_path):
+    with open(os.path.join(DATA_DIR, "tooltalk", "golden_conversation_1.json"), 'r', encoding='utf-8') as reader:
+        conversation = json.load(reader)
+    tool_executor = ToolExecutor(init_database_dir=os.path.join(DATA_DIR, "databases"))
+
+    results = ResultsLog(str(tmp_path), writable=True)
+    predictor = RecordingPredictor(conversation, MetadataLevels.DEDUP)
+    first = tool_executor.run_conversation(copy.deepcopy(conversation), predictor)
+    first_blobs = predictor.pop_blobs()
+    results.write("first.json", first, None, blobs=first_blobs)
+    # a second conversation with the same functions only adds its messages
+    predictor = RecordingPredictor(conversation, MetadataLevels.DEDUP)
+    second = tool_executor.run_conversation(copy.deepcopy(conversation), predictor)
+    results.write("second.json", second, None, blobs=predictor.pop_blobs())
+    results.close()
+
+    # one blob of functions plus one of new messages per request
+    assert len(first_blobs) == len(predictor.requests) + 1
+    with open(os.path.join(tmp_path, STATE_DIR, BLOBS_FILE), 'rb') as reader:
+        assert len(reader.readlines()) == len(first_blobs)
+
+    results = ResultsLog(str(tmp_path))
+    blobs = results.load_blobs()
+    expanded = expand_metadata(results.load("second.json"), blobs)
+    requests = [
+        prediction["metadata"]["openai_request"]
+        for turn in expanded["conversation"] for prediction in turn.get("predictions", list())
+    ]
+    assert requests == predictor.requests
+    assert all("functions" not in request and "messages" not in request for request in [
+        prediction["metadata"]["openai_request"]
+        for turn in results.load("first.json")["conversation"] for prediction in turn.get("predictions", list())
+    ])
+
+
+def test_metadata_levels():
+    with open(os.path.join(DATA_DIR, "tooltalk", "golden_conversation_1.json"), 'r', encoding='utf-8') as reader:
+        conversation = json.load(reader)
+    tool_executor = ToolExecutor(init_database_dir=os.path.join(DATA_DIR, "databases"))
+    expected_metadata = [(MetadataLevels.RESPONSE, {"openai_response": {"choices": []}}), (MetadataLevels.NONE, None)]
+    for level, expected in expected_metadata:
+        predictor = RecordingPredictor(conversation, level)
+        result = tool_executor.run_conversation(copy.deepcopy(conversation), predictor)
+        for turn in result["conversation"]:
+            for prediction in turn.get("predictions", list()):
+                assert prediction["metadata"] == expected
+        assert predictor.pop_blobs() == dict()
+
+
+def test_full_metadata_copies_docs():
+    with open(os.path.join(DATA_DIR, "tooltalk", "golden_conversation_1.json"), 'r', encoding='utf-8') as reader:
+        conversation = json.load(reader)
+    tool_executor = ToolExecutor(init_database_dir=os.path.join(DATA_DIR, "databases"))
+    predictor = RecordingPredictor(conversation, MetadataLevels.FULL)
+    api_docs = copy.deepcopy(predictor.api_docs)
+    result = tool_executor.run_conversation(copy.deepcopy(conversation), predictor)
+
+    predictions = [prediction for turn in result["conversation"] for prediction in turn.get("predictions", list())]
+    assert predictions
+    for prediction in predictions:
+        functions = prediction["metadata"]["openai_request"]["functions"]
+        assert functions == api_docs
+        functions[0]["description"] = "edited"
+        functions.pop()
+    # docs cached by get_openai_docs are untouched
+    assert predictor.api_docs == api_docs
+    assert get_openai_docs(ALL_APIS, False).docs == api_docs
@@ -0,0 +1,170 @@
+"""
+Copyright (c) Microsoft Corporation.
+Licensed under the MIT license.
+
+Ensure the oracle server answers OpenAI requests like OraclePredictor
+"""
+import os
+import copy
+import json
+import threading
+import urllib.error
+import urllib.request
+
+import openai
+import pytest
+
+from tooltalk.apis import ALL_APIS
+from tooltalk.apis import utils
+from tooltalk.evaluation import calculate_error_types, evaluate_openai
+from tooltalk.evaluation.evaluate_openai import OpenAIPredictor
+from tooltalk.evaluation.oracle_predictor import OraclePredictor
+from tooltalk.evaluation.oracle_server import get_arg_parser, make_server
+from tooltalk.evaluation.tool_executor import ToolExecutor
+from tooltalk.utils.results_log import ResultsDirectory
+
+DATA_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "data"))
+DATASET_DIR = os.path.join(DATA_DIR, "tooltalk")
+
+
+@pytest.fixture
+def server_url(request):
+    args = get_arg_parser().parse_args(["--dataset", DATASET_DIR, "--port", "0"] + getattr(request, "param", []))
+    server = make_server(args)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}/v1"
+    server.shutdown()
+    server.server_close()
+
+
+def test_oracle_server_matches_oracle(server_url, monkeypatch):
+    monkeypatch.setattr(openai, "api_base", server_url)
+    monkeypatch.setattr(openai, "api_key", "unused")
+    with open(os.path.join(DATASET_DIR, "golden_conversation_1.json"), 'r', encoding='utf-8') as reader:
+        conversation = json.load(reader)
+
+    tool_executor = ToolExecutor(init_database_dir=os.path.join(DATA_DIR, "databases"))
+    expected = tool_executor.run_conversation(copy.deepcopy(conversation), OraclePredictor(conversation))
+    served = tool_executor.run_conversation(copy.deepcopy(conversation), OpenAIPredictor("gpt-4", ALL_APIS))
+    for expected_turn, served_turn in zip(expected["conversation"], served["conversation"]):
+        for prediction in served_turn.get("predictions", list()):
+            prediction.pop("metadata", None)
+        for prediction in expected_turn.get("predictions", list()):
+            prediction.pop("metadata", None)
+        assert served_turn.get("predictions") == expected_turn.get("predictions")
+
+
+@pytest.mark.parametrize("server_url", [["--requests_per_minute", "1", "--burst", "1"]], indirect=True)
+def test_oracle_server_rate_limit(server_url):
+    def post():
+        request = urllib.request.Request(f"{server_url}/chat/completions", data=b"{}", method="POST",
+                                         headers={"Content-Type": "application/json"})
+        return urllib.request.urlopen(request)
+
+    with pytest.raises(urllib.error.HTTPError) as error:
+        # first request takes the only token, though is not a valid completion request
+        post()
+    assert error.value.code == 400
+    with pytest.raises(urllib.error.HTTPError) as error:
+        post()
+    assert error.value.code == 429
+    assert float(error.value.headers["Retry-After"]) > 0
+
+
+def test_evaluate_then_calculate_error_types(server_url, tmp_path, monkeypatch):
+    # main configures openai globally, patched here so the settings are undone after the test
+    monkeypatch.setattr(openai, "api_base", server_url)
+    monkeypatch.setattr(openai, "api_key", "unused")
+    monkeypatch.setenv("OPENAI_KEY", "unused")
+    output_dir = str(tmp_path / "output")
+    flags = [
+        "--dataset", os.path.join(DATASET_DIR, "golden_conversation_1.json"),
+        "--database", os.path.join(DATA_DIR, "databases"),
+        "--api_base", server_url,
+        "--output_dir", output_dir,
+        "--semantic_backend", "char_ngram",
+        "--metadata", "dedup",
+    ]
+    # replaying an empty response cache fails on any OpenAI request
+    no_requests = ["--response_cache", str(tmp_path / "empty"), "--response_cache_mode", "replay"]
+    try:
+        evaluate_openai.main(flags)
+        results = ResultsDirectory(output_dir)
+        cache_key = results.get_cache_key("golden_conversation_1.json")
+        evaluation_key = results.get_evaluation_key("golden_conversation_1.json")
+        # predictions are reused, only evaluated again when evaluation settings change
+        evaluate_openai.main(flags + no_requests)
+        evaluate_openai.main(flags + no_requests + ["--semantic_threshold", "SendEmail.body=0.5"])
+    finally:
+        utils.set_semantic_backend("sent2vec")
+
+    results = ResultsDirectory(output_dir)
+    assert results.get_cache_key("golden_conversation_1.json") == cache_key
+    assert results.get_evaluation_key("golden_conversation_1.json") != evaluation_key
+    # only conversations are in the output directory, so it can be read as a dataset
+    assert [name for name in os.listdir(output_dir) if name != ".tooltalk"] == ["golden_conversation_1.json"]
+    metrics_path = str(tmp_path / "error_types.json")
+    calculate_error_types.main(["--dataset", output_dir, "--metrics", metrics_path])
+    with open(metrics_path, 'r', encoding='utf-8') as reader:
+        assert json.load(reader) == {"over-trigger": 0, "bad planning": 0, "bad call": 0}
+
+
+def test_predict_after_run_without_predict(server_url, tmp_path, monkeypatch):
+    monkeypatch.setattr(openai, "api_base", server_url)
+    monkeypatch.setattr(openai, "api_key", "unused")
+    monkeypatch.setenv("OPENAI_KEY", "unused")
+    output_dir = str(tmp_path / "output")
+    flags = [
+        "--dataset", os.path.join(DATASET_DIR, "golden_conversation_1.json"),
+        "--database", os.path.join(DATA_DIR, "databases"),
+        "--api_base", server_url,
+        "--output_dir", output_dir,
+        "--semantic_backend", "char_ngram",
+    ]
+    predictions = list()
+    try:
+        # evaluating conversations without predictions would divide by zero in the summary
+        for modes in [["validate"], ["predict", "evaluate"]]:
+            evaluate_openai.main(flags + ["--modes"] + modes)
+            conversation = ResultsDirectory(output_dir).load("golden_conversation_1.json")
+            predictions.append([prediction for turn in conversation["conversation"]
+                                for prediction in turn.get("predictions", list())])
+    finally:
+        utils.set_semantic_backend("sent2vec")
+
+    # conversations stored without predicting are predicted once predict is requested
+    assert predictions[0] == []
+    assert predictions[1]
+
+
+def test_workers_match_serial(server_url, tmp_path, monkeypatch, caplog):
+    monkeypatch.setattr(openai, "api_base", server_url)
+    monkeypatch.setattr(openai, "api_key", "unused")
+    monkeypatch.setenv("OPENAI_KEY", "unused")
+    flags = [
+        "--dataset", DATASET_DIR,
+        "--database", os.path.join(DATA_DIR, "databases"),
+        "--api_base", server_url,
+        "--semantic_backend", "char_ngram",
+        # responses of the oracle server have unique ids and timestamps
+        "--metadata", "none",
+    ]
+    metrics = dict()
+    try:
+        for name, parallel_flags in [("serial", []), ("workers", ["--workers", "2"])]:
+            caplog.clear()
+            with caplog.at_level("INFO", logger=evaluate_openai.logger.name):
+                evaluate_openai.main(flags + ["--output_dir", str(tmp_path / name)] + parallel_flags)
+            metrics[name] = [record.getMessage() for record in caplog.records if "Metrics:" in record.getMessage()]
+    finally:
+        utils.set_semantic_backend("sent2vec")
+
+    assert len(metrics["serial"]) == 1 and metrics["workers"] == metrics["serial"]
+    file_names = sorted(name for name in os.listdir(DATASET_DIR) if name.endswith(".json"))
+    for output_dir in ["serial", "workers"]:
+        assert sorted(name for name in os.listdir(tmp_path / output_dir) if name != ".tooltalk") == file_names
+    for file_name in file_names:
+        with open(tmp_path / "serial" / file_name, 'rb') as serial:
+            with open(tmp_path / "workers" / file_name, 'rb') as workers:
+                assert workers.read() == serial.read(), file_name
@@ -0,0 +1,30 @@
+"""
+Copyright (c) Microsoft Corporation.
+Licensed under the MIT license.
+
+Ensure packed datasets load the same conversations as dataset directories
+"""
+import os
+
+from tooltalk.utils.packed_dataset import DirectoryDataset, PackedDataset, open_dataset, pack_dataset
+
+DATA_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "data"))
+
+
+def test_packed_dataset(tmp_path):
+    dataset_path = os.path.join(DATA_DIR, "tooltalk")
+    pack_dataset(dataset_path, str(tmp_path), shard_size=64 * 1024)
+    directory_dataset = open_dataset(dataset_path)
+    packed_dataset = open_dataset(str(tmp_path))
+    assert isinstance(directory_dataset, DirectoryDataset)
+    assert isinstance(packed_dataset, PackedDataset)
+    assert len(packed_dataset.shards) > 1
+
+    conversations = list(directory_dataset)
+    assert [name for name, _ in conversations] == sorted(os.listdir(dataset_path))
+    assert list(packed_dataset) == conversations
+    for name, conversation in reversed(conversations):
+        assert packed_dataset.load(name) == conversation
+        assert packed_dataset.get(conversation["conversation_id"]) == conversation
+    assert directory_dataset.get(conversations[-1][1]["conversation_id"]) == conversations[-1][1]
+    packed_dataset.close()
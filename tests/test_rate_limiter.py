@@ -0,0 +1,61 @@
+"""
+Copyright (c) Microsoft Corporation.
+Licensed under the MIT license.
+
+Ensure rate limits are shared and rate limit errors are retried
+"""
+import time
+import asyncio
+
+import openai
+import pytest
+
+from tooltalk.utils import openai_utils
+from tooltalk.utils.rate_limiter import RateLimiter, get_retry_after
+
+
+def test_rate_limiter_budgets(tmp_path):
+    state_path = str(tmp_path / "rate_limit.json")
+    first = RateLimiter(requests_per_minute=2, tokens_per_minute=600, state_path=state_path)
+    second = RateLimiter(requests_per_minute=2, tokens_per_minute=600, state_path=state_path)
+    assert first.try_acquire(100) == 0
+    # budget is shared through the state file
+    assert second.try_acquire(100) == 0
+    assert 0 < first.try_acquire(100) <= 30
+
+    limiter = RateLimiter(tokens_per_minute=600)
+    assert limiter.try_acquire(500) == 0
+    assert limiter.try_acquire(500) == pytest.approx(40, abs=1)
+    limiter.record_usage(500, 100)
+    assert limiter.try_acquire(500) == 0
+
+    assert 5 <= limiter.backoff(0, retry_after=5) <= 5 + limiter.base_wait
+    assert limiter.try_acquire() > 4
+    assert get_retry_after({"retry-after-ms": "1500"}) == 1.5
+    assert get_retry_after({"Retry-After": "2"}) == 2.0
+    assert get_retry_after(None) is None
+
+
+def test_rate_limited_retries(monkeypatch):
+    calls = list()
+
+    def create(**request):
+        calls.append(time.monotonic())
+        if len(calls) < 3:
+            raise openai.error.RateLimitError("slow down", headers={"retry-after-ms": "10"})
+        return {"choices": [], "usage": {"total_tokens": 10}}
+
+    async def acreate(**request):
+        return create(**request)
+
+    monkeypatch.setattr(openai.ChatCompletion, "create", create)
+    monkeypatch.setattr(openai.ChatCompletion, "acreate", acreate)
+    monkeypatch.setattr(openai_utils, "_rate_limiter", RateLimiter(max_retries=2, base_wait=0.01))
+    assert openai_utils.openai_chat_completion(model="gpt-4", messages=[])["usage"]["total_tokens"] == 10
+    assert len(calls) == 3
+
+    calls.clear()
+    monkeypatch.setattr(openai_utils, "_rate_limiter", RateLimiter(max_retries=1, base_wait=0.01))
+    with pytest.raises(openai.error.RateLimitError):
+        asyncio.run(openai_utils.openai_chat_completion_async(model="gpt-4", messages=[]))
+    assert len(calls) == 2
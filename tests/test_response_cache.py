@@ -0,0 +1,77 @@
+"""
+Copyright (c) Microsoft Corporation.
+Licensed under the MIT license.
+
+Ensure recorded responses are replayed without calling the model
+"""
+import asyncio
+import threading
+
+import pytest
+
+from tooltalk.utils.response_cache import ResponseCache, ResponseCacheMiss
+
+
+def test_response_cache_modes(tmp_path):
+    calls = list()
+
+    def chat_completion(**request):
+        calls.append(request)
+        return {"choices": [{"message": {"role": "assistant", "content": f"call {len(calls)}"}}]}
+
+    async def chat_completion_async(**request):
+        return chat_completion(**request)
+
+    request = {"model": "gpt-4", "messages": [{"role": "user", "content": "hi"}], "functions": []}
+    other_request = {"model": "gpt-4", "messages": [{"role": "user", "content": "bye"}], "functions": []}
+
+    assert ResponseCache(None, "off")(chat_completion, request)["choices"][0]["message"]["content"] == "call 1"
+    record = ResponseCache(str(tmp_path), "record")
+    assert record(chat_completion, request)["choices"][0]["message"]["content"] == "call 2"
+    assert record(chat_completion, request)["choices"][0]["message"]["content"] == "call 3"
+
+    replay = ResponseCache(str(tmp_path), "replay")
+    assert replay(chat_completion, request)["choices"][0]["message"]["content"] == "call 3"
+    with pytest.raises(ResponseCacheMiss):
+        replay(chat_completion, other_request)
+    assert len(calls) == 3
+
+    read_through = ResponseCache(str(tmp_path), "read_through")
+    response = asyncio.run(read_through.call_async(chat_completion_async, other_request))
+    assert response["choices"][0]["message"]["content"] == "call 4"
+    assert read_through(chat_completion, other_request) == response
+    # entries recorded by other caches since opening are found too
+    assert replay(chat_completion, other_request) == response
+    assert len(calls) == 4
+
+
+def test_response_cache_async_io_off_event_loop(tmp_path):
+    cache = ResponseCache(str(tmp_path), "read_through")
+    io_threads = list()
+    put = cache.store.put
+    get = cache.store.get
+
+    def recording_put(key, response):
+        io_threads.append(threading.current_thread())
+        put(key, response)
+
+    def recording_get(key):
+        io_threads.append(threading.current_thread())
+        return get(key)
+
+    cache.store.put = recording_put
+    cache.store.get = recording_get
+
+    async def chat_completion_async(**request):
+        return {"choices": [{"message": {"role": "assistant", "content": request["messages"][0]["content"]}}]}
+
+    async def run():
+        requests = [{"model": "gpt-4", "messages": [{"role": "user", "content": str(i)}]} for i in range(20)]
+        return await asyncio.gather(*[cache.call_async(chat_completion_async, request) for request in requests])
+
+    responses = asyncio.run(run())
+    assert [response["choices"][0]["message"]["content"] for response in responses] == [str(i) for i in range(20)]
+    assert len(io_threads) == 40 and threading.main_thread() not in io_threads
+    # every concurrent write was recorded
+    replay = ResponseCache(str(tmp_path), "replay")
+    assert replay(None, {"model": "gpt-4", "messages": [{"role": "user", "content": "7"}]}) == responses[7]
@@ -0,0 +1,49 @@
+"""
+Copyright (c) Microsoft Corporation.
+Licensed under the MIT license.
+
+Ensure results logs resume after interrupted writes
+"""
+import os
+
+from tooltalk.utils.packed_dataset import open_dataset
+from tooltalk.utils.results_log import INDEX_FILE, LOG_FILE, ResultsDirectory, ResultsLog
+
+
+def test_results_log_resume(tmp_path):
+    results = ResultsLog(str(tmp_path), writable=True)
+    for i in range(3):
+        results.write(f"conversation_{i}.json", {"conversation_id": str(i), "turns": [i]}, {"success": i % 2}, str(i))
+    results.write("conversation_1.json", {"conversation_id": "1", "turns": [1, 1]}, {"success": True})
+    results.close()
+
+    # simulate a crash while writing another conversation
+    with open(os.path.join(tmp_path, LOG_FILE), 'ab') as writer:
+        writer.write(b'{"conversation_id": "3", "tu')
+    with open(os.path.join(tmp_path, INDEX_FILE), 'ab') as writer:
+        writer.write(b'{"name": "conversation_3.json"')
+
+    results = ResultsLog(str(tmp_path), writable=True)
+    assert results.names == ["conversation_0.json", "conversation_1.json", "conversation_2.json"]
+    assert results.get_metrics("conversation_1.json") == {"success": True}
+    assert results.get_cache_key("conversation_2.json") == "2"
+    assert results.get_cache_key("conversation_3.json") is None
+    results.write("conversation_3.json", {"conversation_id": "3", "turns": [3]}, None)
+    results.close()
+
+    dataset = open_dataset(str(tmp_path))
+    assert isinstance(dataset, ResultsLog)
+    assert [conversation["turns"] for _, conversation in dataset] == [[0], [1, 1], [2], [3]]
+    assert dataset.load("conversation_3.json") == {"conversation_id": "3", "turns": [3]}
+
+
+def test_results_directory_cache_keys(tmp_path):
+    results = ResultsDirectory(str(tmp_path))
+    results.write("conversation_0.json", {"conversation_id": "0", "metrics": {"success": True}}, None, "key")
+    os.remove(os.path.join(tmp_path, "conversation_0.json"))
+    results.write("conversation_1.json", {"conversation_id": "1", "metrics": {"success": False}}, None, "key")
+
+    results = ResultsDirectory(str(tmp_path))
+    assert results.get_cache_key("conversation_0.json") is None
+    assert results.get_cache_key("conversation_1.json") == "key"
+    assert results.get_metrics("conversation_1.json") == {"success": False}
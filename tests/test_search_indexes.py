@@ -0,0 +1,318 @@
+"""
+Copyright (c) Microsoft Corporation.
+Licensed under the MIT license.
+
+Ensure indexed search APIs return the same results as scanning every record
+"""
+import copy
+import pickle
+from datetime import datetime, timedelta
+from random import Random
+
+import pytest
+
+from tooltalk.apis import (
+    AddAlarm,
+    CreateEvent,
+    DeleteAccount,
+    DeleteAlarm,
+    DeleteEvent,
+    FindAlarms,
+    ModifyEvent,
+    QueryCalendar,
+    QueryUser,
+    RegisterUser,
+    SearchInbox,
+    SearchMessages,
+    UpdateAccountInformation
+)
+from tooltalk.apis.alarm import AlarmDatabase
+from tooltalk.apis.api import AccountDatabase
+from tooltalk.apis.calendar import CalendarDatabase
+from tooltalk.apis.exceptions import APIException
+
+NOW = "2023-09-10 12:00:00"
+WORDS = ["flight", "hotel", "deal", "invoice", "meeting", "weather", "Hawaii", "a", "an", "ing", "light"]
+ACCOUNT_DATABASE = {
+    "alice": {"username": "alice", "session_token": "alice-token", "email": "alice@example.com"},
+    "bob": {"username": "bob", "session_token": "bob-token", "email": "bob@example.com"},
+}
+
+
+def random_date(random: Random) -> str:
+    # coarse dates so ties are common
+    date = datetime(2023, 9, 1) + timedelta(hours=random.randint(0, 15 * 24 // 6) * 6)
+    return date.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def random_text(random: Random) -> str:
+    return " ".join(random.choice(WORDS) for _ in range(random.randint(0, 6)))
+
+
+def scan(records: dict, date_key: str, text_keys: list, now: datetime, query, match_type, sender, start_date,
+         end_date) -> list:
+    """
+    Search of SearchInbox and SearchMessages before they were indexed.
+    """
+    if start_date is not None:
+        start_date = datetime.strptime(start_date, '%Y-%m-%d %H:%M:%S')
+    if end_date is not None:
+        end_date = datetime.strptime(end_date, '%Y-%m-%d %H:%M:%S')
+    keywords = query.lower().split() if query else None
+    matched_records = []
+    for record in records.values():
+        record_date = datetime.strptime(record[date_key], '%Y-%m-%d %H:%M:%S')
+        if now < record_date:
+            continue
+        if sender is not None and sender != record['sender']:
+            continue
+        if start_date is not None and start_date > record_date:
+            continue
+        if end_date is not None and end_date < record_date:
+            continue
+        if keywords is not None:
+            keyword_matches = [any(keyword in record[key].lower() for key in text_keys) for keyword in keywords]
+            if not (any(keyword_matches) if match_type == "any" else all(keyword_matches)):
+                continue
+        matched_records.append(record)
+    matched_records.sort(key=lambda x: datetime.strptime(x[date_key], '%Y-%m-%d %H:%M:%S'), reverse=True)
+    return matched_records[:5]
+
+
+def check_search(tool, database: dict, senders: list, date_key: str, text_keys: list, results_key: str) -> None:
+    random = Random(1)
+    expected_database = copy.deepcopy(database)
+    for _ in range(500):
+        username = random.choice(["alice", "bob"])
+        parameters = {
+            "query": random.choice([None, "", " ", random_text(random), random.choice(WORDS).upper()[1:]]),
+            "match_type": random.choice(["any", "all"]),
+            "sender": random.choice([None] + senders),
+            "start_date": random.choice([None, random_date(random)]),
+            "end_date": random.choice([None, random_date(random)]),
+        }
+        result = tool(session_token=f"{username}-token", **parameters)
+        if result["exception"] is None:
+            expected = scan(database[username], date_key, text_keys, tool.now_timestamp, **parameters)
+            assert result["response"][results_key] == expected, parameters
+        else:
+            assert all(parameters[key] is None for key in ["query", "sender", "start_date", "end_date"]) \
+                or parameters["start_date"] > parameters["end_date"]
+    assert database == expected_database
+
+    with pytest.raises(APIException):
+        tool.call(session_token="alice-token", query="deal", match_type="some")
+
+
+def test_search_inbox():
+    random = Random(0)
+    senders = ["sara@example.com", "deals@example.com", "bob@example.com"]
+    database = {"alice": dict(), "bob": dict()}
+    for i in range(300):
+        database[random.choice(["alice", "alice", "bob"])][str(i)] = {
+            "email_id": str(i),
+            "date": random_date(random),
+            "sender": random.choice(senders),
+            "receivers": ["alice@example.com"],
+            "subject": random_text(random).title(),
+            "body": random_text(random),
+        }
+    tool = SearchInbox(AccountDatabase(copy.deepcopy(ACCOUNT_DATABASE)), NOW, database)
+    check_search(tool, database, senders, "date", ["body", "subject"], "emails")
+
+
+def test_search_messages():
+    random = Random(0)
+    senders = ["alice", "bob", "carol"]
+    database = {"alice": dict(), "bob": dict()}
+    for i in range(300):
+        database[random.choice(["alice", "alice", "bob"])][str(i)] = {
+            "message_id": str(i),
+            "timestamp": random_date(random),
+            "sender": random.choice(senders),
+            "message": random_text(random),
+        }
+    tool = SearchMessages(AccountDatabase(copy.deepcopy(ACCOUNT_DATABASE)), NOW, database)
+    check_search(tool, database, senders, "timestamp", ["message"], "messages")
+
+
+def scan_calendar(events: dict, start_time: str, end_time: str) -> list:
+    """
+    Search of QueryCalendar before it was indexed.
+    """
+    start_time = datetime.strptime(start_time, '%Y-%m-%d %H:%M:%S')
+    end_time = datetime.strptime(end_time, '%Y-%m-%d %H:%M:%S')
+    matched_events = []
+    for event in events.values():
+        event_start = datetime.strptime(event["start_time"], '%Y-%m-%d %H:%M:%S')
+        event_end = datetime.strptime(event["end_time"], '%Y-%m-%d %H:%M:%S')
+        if start_time <= event_start <= end_time or start_time <= event_end <= end_time \
+                or (event_start <= start_time and event_end >= end_time):
+            matched_events.append(event)
+    return matched_events
+
+
+def random_interval(random: Random) -> tuple:
+    start = datetime(2023, 9, 10, 12) + timedelta(minutes=random.randint(0, 10 * 24 * 4) * 15)
+    end = start + timedelta(minutes=random.choice([0, 15, 30, 60, 90, 24 * 60, 3 * 24 * 60]))
+    return start.strftime("%Y-%m-%d %H:%M:%S"), end.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def test_query_calendar():
+    random = Random(0)
+    events = dict()
+    for i in range(200):
+        start_time, end_time = random_interval(random)
+        if i % 50 == 0:
+            # malformed events ending before they start are still matched like before
+            start_time, end_time = end_time, start_time
+        events[str(i)] = {"event_id": str(i), "name": str(i), "start_time": start_time, "end_time": end_time}
+    database = CalendarDatabase({"alice": events})
+    account_database = AccountDatabase(copy.deepcopy(ACCOUNT_DATABASE))
+    tools = {
+        api.__name__: api(account_database, NOW, database)
+        for api in [CreateEvent, DeleteEvent, ModifyEvent, QueryCalendar]
+    }
+    assert all(tool.database is database for tool in tools.values())
+
+    for _ in range(500):
+        operation = random.choice(["create", "delete", "modify", "query", "query"])
+        event_ids = list(database.get("bob", dict())) + list(database["alice"])
+        username = random.choice(["alice", "bob"])
+        start_time, end_time = random_interval(random)
+        if operation == "create":
+            tools["CreateEvent"](session_token=f"{username}-token", name="event", event_type="event",
+                                 start_time=start_time, end_time=end_time)
+        elif operation == "delete" and event_ids:
+            tools["DeleteEvent"](session_token=f"{username}-token", event_id=random.choice(event_ids))
+        elif operation == "modify" and event_ids:
+            tools["ModifyEvent"](session_token=f"{username}-token", event_id=random.choice(event_ids),
+                                 new_start_time=start_time, new_end_time=end_time)
+        elif operation == "query":
+            result = tools["QueryCalendar"](session_token=f"{username}-token", start_time=start_time,
+                                            end_time=end_time)
+            if username in database:
+                assert result["response"]["events"] == scan_calendar(database[username], start_time, end_time)
+
+    # indexes survive the pickled snapshots ToolExecutor restores databases from
+    restored = pickle.loads(pickle.dumps(database))
+    start_time, end_time = random_interval(random)
+    assert restored.find_events("alice", datetime.strptime(start_time, "%Y-%m-%d %H:%M:%S"),
+                                datetime.strptime(end_time, "%Y-%m-%d %H:%M:%S")) \
+        == scan_calendar(database["alice"], start_time, end_time)
+
+
+def scan_alarms(alarms: dict, start_range, end_range) -> list:
+    """
+    Search of FindAlarms before it was indexed, with ranges wrapping around midnight split in two.
+    """
+    if start_range is not None and end_range is not None and start_range > end_range:
+        matched_ids = {alarm["alarm_id"] for alarm in scan_alarms(alarms, start_range, None)
+                       + scan_alarms(alarms, None, end_range)}
+        return [alarm for alarm in alarms.values() if alarm["alarm_id"] in matched_ids]
+    matched_alarms = []
+    for alarm in alarms.values():
+        alarm_time = datetime.strptime(alarm['time'], '%H:%M:%S')
+        if start_range is not None and alarm_time < datetime.strptime(start_range, '%H:%M:%S'):
+            continue
+        if end_range is not None and alarm_time > datetime.strptime(end_range, '%H:%M:%S'):
+            continue
+        matched_alarms.append(alarm)
+    return matched_alarms
+
+
+def random_time(random: Random) -> str:
+    return f"{random.randint(0, 23):02d}:{random.choice([0, 30]):02d}:00"
+
+
+def test_find_alarms():
+    random = Random(0)
+    database = AlarmDatabase({
+        "alice": {str(i): {"alarm_id": str(i), "time": random_time(random)} for i in range(100)}
+    })
+    account_database = AccountDatabase(copy.deepcopy(ACCOUNT_DATABASE))
+    tools = {api.__name__: api(account_database, NOW, database) for api in [AddAlarm, DeleteAlarm, FindAlarms]}
+    assert all(tool.database is database for tool in tools.values())
+
+    for _ in range(500):
+        operation = random.choice(["add", "delete", "find", "find"])
+        username = random.choice(["alice", "bob"])
+        alarm_ids = list(database.get(username, dict()))
+        if operation == "add":
+            tools["AddAlarm"](session_token=f"{username}-token", time=random_time(random))
+        elif operation == "delete" and alarm_ids:
+            tools["DeleteAlarm"](session_token=f"{username}-token", alarm_id=random.choice(alarm_ids))
+        elif operation == "find":
+            start_range = random.choice([None, random_time(random)])
+            end_range = random.choice([None, random_time(random)])
+            result = tools["FindAlarms"](session_token=f"{username}-token", start_range=start_range,
+                                         end_range=end_range)
+            assert result["exception"] is None
+            expected = scan_alarms(database.get(username, dict()), start_range, end_range)
+            assert result["response"]["alarms"] == expected
+
+    # ranges wrapping around midnight used to fail with "Start range must be earlier than end range."
+    result = tools["FindAlarms"](session_token="alice-token", start_range="23:00:00", end_range="01:00:00")
+    assert result["exception"] is None
+    assert result["response"]["alarms"] == scan_alarms(database["alice"], "23:00:00", "01:00:00") != list()
+
+
+def test_query_user_by_email():
+    random = Random(0)
+    emails = [f"user{i}@example.com" for i in range(5)]
+    database = AccountDatabase({
+        f"user{i}": {"username": f"user{i}", "password": "password", "session_token": f"user{i}-token",
+                     "email": random.choice(emails), "phone": None, "name": None}
+        for i in range(20)
+    })
+    tools = {
+        api.__name__: api(database, NOW)
+        for api in [RegisterUser, UpdateAccountInformation, DeleteAccount, QueryUser]
+    }
+    assert all(tool.database is database for tool in tools.values())
+
+    for _ in range(500):
+        operation = random.choice(["register", "update", "delete", "query", "query"])
+        session_token = random.choice([user_data["session_token"] for user_data in database.values()])
+        if operation == "register":
+            tools["RegisterUser"](username=random.choice(["user", "new"]) + str(random.randint(0, 40)),
+                                  password="password", email=random.choice(emails))
+        elif operation == "update":
+            tools["UpdateAccountInformation"](session_token=session_token, password="password",
+                                              new_email=random.choice(emails))
+        elif operation == "delete" and len(database) > 1:
+            tools["DeleteAccount"](session_token=session_token, password="password")
+        elif operation == "query":
+            email = random.choice(emails)
+            result = tools["QueryUser"](session_token=session_token, email=email)
+            expected = [username for username, user_data in database.items() if user_data["email"] == email]
+            assert [user["username"] for user in result["response"]["users"]] == expected
+
+    # index survives the pickled snapshots ToolExecutor restores databases from
+    restored = pickle.loads(pickle.dumps(database))
+    for email in emails:
+        assert restored.get_usernames_by_email(email) == database.get_usernames_by_email(email)
+
+
+def test_session_token_first_match():
+    database = AccountDatabase({
+        username: {"username": username, "password": "password", "session_token": "token", "email": None}
+        for username in ["carol", "alice", "bob"]
+    })
+    query_user = QueryUser(database, NOW)
+    assert query_user.check_session_token("token")["username"] == "carol"
+    database.set_session_token("carol", None)
+    assert query_user.check_session_token("token")["username"] == "alice"
+    # replaced users keep their place in the database
+    database.add_user({"username": "carol", "password": "password", "session_token": "token", "email": None})
+    assert query_user.check_session_token("token")["username"] == "carol"
+    database.delete_user("carol")
+    database.add_user({"username": "carol", "password": "password", "session_token": "token", "email": None})
+    assert query_user.check_session_token("token")["username"] == "alice"
+
+
+def test_databases_not_copied():
+    with pytest.raises(TypeError):
+        QueryUser(copy.deepcopy(ACCOUNT_DATABASE), NOW)
+    with pytest.raises(TypeError):
+        FindAlarms(AccountDatabase(copy.deepcopy(ACCOUNT_DATABASE)), NOW, {"alice": dict()})
@@ -0,0 +1,107 @@
+"""
+Copyright (c) Microsoft Corporation.
+Licensed under the MIT license.
+
+Ensure semantic comparisons honor the selected backend and its thresholds
+"""
+import numpy as np
+import pytest
+
+from tooltalk.apis import utils
+from tooltalk.apis.email import SendEmail
+
+
+def test_char_ngram_backend():
+    utils.set_semantic_backend("char_ngram", {"SendEmail.body": 0.3})
+    try:
+        assert utils.semantic_str_compare("Lunch with Alice", "lunch  with alice") > 0.99
+        assert utils.semantic_str_compare("Lunch with Alice", "Renew passport") < 0.5
+        scores = utils.semantic_str_compare_batch([("Buy milk", "buy some milk"), ("Buy milk", "Renew passport")])
+        assert scores[0] == utils.semantic_str_compare("Buy milk", "buy some milk")
+        assert scores[0] > scores[1]
+
+        assert SendEmail.semantic_threshold("body") == 0.3
+        assert SendEmail.semantic_threshold("subject") == utils._CharNgramVectorizer.thresholds["SendEmail.subject"]
+    finally:
+        utils.set_semantic_backend("sent2vec")
+    assert SendEmail.semantic_threshold("body") == SendEmail.semantic_parameters["body"]
+
+
+# mixed lengths so batches would need padding
+MIXED_LENGTH_PAIRS = [
+    ("Buy milk", "buy some milk"),
+    ("Lunch with Alice at noon on Friday in the cafeteria", "Lunch with Alice"),
+    ("Renew passport", "Renew my passport before the trip to Japan next month"),
+    ("ok", "Team meeting"),
+    ("Team meeting", "Buy milk"),
+]
+
+
+def _assert_batch_matches_pairwise(reset_backend):
+    # reset between runs so batches don't reuse embeddings cached by the pairwise comparisons
+    reset_backend()
+    pairwise = [utils.semantic_str_compare(first, second) for first, second in MIXED_LENGTH_PAIRS]
+    reset_backend()
+    batch = utils.semantic_str_compare_batch(MIXED_LENGTH_PAIRS)
+    assert np.allclose(batch, pairwise, atol=1e-6)
+    reset_backend()
+    with utils.precompute_semantic_scores(MIXED_LENGTH_PAIRS):
+        precomputed = [utils.semantic_str_compare(first, second) for first, second in MIXED_LENGTH_PAIRS]
+    assert np.allclose(precomputed, pairwise, atol=1e-6)
+
+
+def test_char_ngram_batch_matches_pairwise():
+    try:
+        _assert_batch_matches_pairwise(lambda: utils.set_semantic_backend("char_ngram"))
+    finally:
+        utils.set_semantic_backend("sent2vec")
+
+
+class _PaddingSensitiveVectorizer:
+    """
+    Mimics sent2vec running BERT without an attention mask: vectors change with the longest text of the batch.
+    """
+    class Model:
+        pretrained_weights = "padding-sensitive"
+
+        class tokenizer:
+            @staticmethod
+            def encode(text, add_special_tokens=True):
+                return text.split() + ["[CLS]", "[SEP]"] * add_special_tokens
+
+    def __init__(self):
+        self.vectorizer = self.Model()
+        self.vectors = list()
+
+    def run(self, texts):
+        padded_length = max(len(self.vectorizer.tokenizer.encode(text)) for text in texts)
+        for text in texts:
+            length = len(self.vectorizer.tokenizer.encode(text))
+            vector = [length, len(text), sum(map(ord, text)) % 97, padded_length - length]
+            self.vectors.append(np.array(vector, dtype=float))
+
+
+def _use_padding_sensitive_vectorizer():
+    vectorize_text = utils._TextVectorizer.__new__(utils._TextVectorizer)
+    vectorize_text.vectorizer = _PaddingSensitiveVectorizer()
+    utils._TextEmbedder.__init__(vectorize_text, "sent2vec/padding-sensitive")
+    utils._vectorize_text = vectorize_text
+
+
+def test_sent2vec_length_buckets_match_pairwise():
+    try:
+        _assert_batch_matches_pairwise(_use_padding_sensitive_vectorizer)
+    finally:
+        utils.set_semantic_backend("sent2vec")
+
+
+def test_sent2vec_batch_matches_pairwise():
+    utils.set_semantic_backend("sent2vec")
+    try:
+        utils.get_semantic_model_name()
+    except Exception as error:
+        pytest.skip(f"sent2vec model unavailable: {error}")
+    try:
+        _assert_batch_matches_pairwise(lambda: utils.set_semantic_backend("sent2vec"))
+    finally:
+        utils.set_semantic_backend("sent2vec")
@@ -0,0 +1,158 @@
+"""
+Copyright (c) Microsoft Corporation.
+Licensed under the MIT license.
+
+Ensure ToolExecutor state handling is isolated between conversations
+"""
+import os
+import copy
+import json
+import asyncio
+
+from tooltalk.apis.api import AccountDatabase
+from tooltalk.evaluation.tool_executor import ToolExecutor
+from tooltalk.evaluation.oracle_predictor import OraclePredictor
+
+DATA_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "data"))
+DATABASE_DIR = os.path.join(DATA_DIR, "databases")
+
+
+def test_reset_restores_databases():
+    tool_executor = ToolExecutor(init_database_dir=DATABASE_DIR)
+    metadata = {"timestamp": "2023-09-11 09:00:00"}
+    user_data = {"username": "justinkool", "session_token": "98a5a87a-7714-b404"}
+    tool_executor.init_conversation_state(metadata, [], user_data)
+    _, response = tool_executor.execute_tool("AddAlarm", {"time": "07:00:00"})
+    alarm_id = response["response"]["alarm_id"]
+    assert alarm_id in tool_executor.get_database("Alarm")["justinkool"]
+    assert alarm_id not in tool_executor.init_databases["Alarm"].get("justinkool", {})
+
+    tool_executor.init_conversation_state(metadata, [], user_data)
+    assert alarm_id not in tool_executor.get_database("Alarm").get("justinkool", {})
+    account = tool_executor.get_database("Account")["justinkool"]
+    assert account["session_token"] == user_data["session_token"]
+    assert tool_executor.init_databases["Account"]["justinkool"]["session_token"] is None
+
+
+def test_load_state_matches_replay():
+    tool_executor = ToolExecutor(init_database_dir=DATABASE_DIR)
+    metadata = {"timestamp": "2023-09-11 09:00:00"}
+    user_data = {"username": "justinkool", "session_token": "98a5a87a-7714-b404"}
+    api_history = [{"request": {"api_name": "AddAlarm", "parameters": {"time": "07:00:00"}}}]
+
+    tool_executor.init_conversation_state(metadata, api_history, user_data)
+    checkpoint = tool_executor.save_state()
+    _, replayed = tool_executor.execute_tool("AddAlarm", {"time": "08:00:00"})
+
+    tool_executor.load_state(checkpoint)
+    _, resumed = tool_executor.execute_tool("AddAlarm", {"time": "08:00:00"})
+    assert resumed == replayed
+    assert len(tool_executor.get_database("Alarm")["justinkool"]) == \
+        len(tool_executor.init_databases["Alarm"].get("justinkool", {})) + 2
+
+
+def test_checkpoints_pickle_changed_databases():
+    tool_executor = ToolExecutor(init_database_dir=DATABASE_DIR)
+    user_data = {"username": "justinkool", "session_token": "98a5a87a-7714-b404"}
+    tool_executor.init_conversation_state({"timestamp": "2023-09-11 09:00:00"}, [], user_data)
+    tool_executor.execute_tool("AddAlarm", {"time": "07:00:00"})
+    first = tool_executor.save_state()
+    tool_executor.execute_tool("FindAlarms", {})
+    second = tool_executor.save_state()
+    assert second["databases"]["Alarm"] is first["databases"]["Alarm"]
+    assert first["databases"]["Calendar"] is tool_executor.database_snapshots["Calendar"]
+
+    # unchanged working copies are kept, changed ones are restored from the checkpoint
+    alarm_database = tool_executor.get_database("Alarm")
+    tool_executor.load_state(second)
+    assert tool_executor.get_database("Alarm") is alarm_database
+    tool_executor.execute_tool("AddAlarm", {"time": "08:00:00"})
+    tool_executor.load_state(second)
+    assert tool_executor.get_database("Alarm") is not alarm_database
+    assert len(tool_executor.get_database("Alarm")["justinkool"]) == \
+        len(tool_executor.init_databases["Alarm"].get("justinkool", {})) + 1
+
+
+def test_run_conversation_async_matches_sync():
+    class AsyncOraclePredictor(OraclePredictor):
+        async def __call__(self, metadata: dict, conversation_history: dict) -> dict:
+            return self.predict(metadata, conversation_history)
+
+    tool_executor = ToolExecutor(init_database_dir=DATABASE_DIR)
+    with open(os.path.join(DATA_DIR, "tooltalk", "golden_conversation_1.json"), 'r', encoding='utf-8') as reader:
+        conversation = json.load(reader)
+    async_conversation = copy.deepcopy(conversation)
+
+    conversation = tool_executor.run_conversation(conversation, OraclePredictor(conversation))
+    async_conversation = asyncio.run(
+        tool_executor.run_conversation_async(async_conversation, AsyncOraclePredictor(async_conversation))
+    )
+    assert async_conversation == conversation
+
+
+def test_session_token_index():
+    tool_executor = ToolExecutor(init_database_dir=DATABASE_DIR)
+    tool_executor.init_conversation_state({"timestamp": "2023-09-11 09:00:00"}, [], {})
+    account_database = tool_executor.get_database("Account")
+
+    _, response = tool_executor.execute_tool("RegisterUser", {
+        "username": "newuser", "password": "pass", "email": "new@user.com"
+    })
+    session_token = response["response"]["session_token"]
+    assert account_database.session_tokens[session_token] == {"newuser"}
+
+    _, response = tool_executor.execute_tool("LogoutUser", {})
+    assert response["exception"] is None
+    assert session_token not in account_database.session_tokens
+
+    _, response = tool_executor.execute_tool("UserLogin", {"username": "newuser", "password": "pass"})
+    session_token = response["response"]["session_token"]
+    assert account_database.get_user_by_session_token(session_token)["username"] == "newuser"
+
+    _, response = tool_executor.execute_tool("DeleteAccount", {"password": "pass"})
+    assert response["exception"] is None
+    assert "newuser" not in account_database
+    assert session_token not in account_database.session_tokens
+
+
+def test_account_changes_rolled_back():
+    tool_executor = ToolExecutor(init_database_dir=DATABASE_DIR)
+    init_account = AccountDatabase(copy.deepcopy(tool_executor.init_databases["Account"]))
+    user_data = {"username": "justinkool", "session_token": "98a5a87a-7714-b404", "verification_code": "123456"}
+    tool_executor.init_conversation_state({"timestamp": "2023-09-11 09:00:00"}, [], user_data)
+    tool_executor.execute_tool("UpdateAccountInformation", {
+        "password": "justforkicks123", "new_phone_number": "123-456-0000", "new_name": "Justin"
+    })
+    checkpoint = tool_executor.save_state()
+    tool_executor.execute_tool("DeleteAccount", {"password": "justforkicks123"})
+    tool_executor.execute_tool("RegisterUser", {"username": "newuser", "password": "pass", "email": "new@user.com"})
+
+    tool_executor.load_state(checkpoint)
+    account_database = tool_executor.get_database("Account")
+    assert list(account_database) == list(init_account)
+    assert account_database["justinkool"]["name"] == "Justin"
+    assert account_database.get_user_by_session_token(user_data["session_token"])["username"] == "justinkool"
+
+    tool_executor.reset_executor()
+    assert tool_executor.get_database("Account") is account_database
+    assert list(account_database.items()) == list(init_account.items())
+    assert (account_database.orders, account_database.session_tokens, account_database.emails) == \
+        (init_account.orders, init_account.session_tokens, init_account.emails)
+
+
+def test_read_only_databases_shared():
+    tool_executor = ToolExecutor(init_database_dir=DATABASE_DIR)
+    tool_executor.init_conversation_state({"timestamp": "2023-09-11 09:00:00"}, [], {})
+    current_weather = tool_executor.get_init_tool("CurrentWeather")
+    historic_weather = tool_executor.get_init_tool("HistoricWeather")
+
+    tool_executor.init_conversation_state({"timestamp": "2023-09-11 09:00:00"}, [], {})
+    assert tool_executor.get_init_tool("ForecastWeather").database is current_weather.database
+    assert tool_executor.get_init_tool("HistoricWeather").database is historic_weather.database
+
+    # responses are copies, so changing them leaves the shared databases alone
+    for tool, parameters in [(current_weather, {"location": "london"}),
+                             (historic_weather, {"location": "london", "month": "september"})]:
+        response = tool(**parameters)["response"]
+        response["weather"]["changed"] = True
+        assert "changed" not in tool(**parameters)["response"]["weather"]